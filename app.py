@@ -4,18 +4,46 @@
 修复搜索功能问题
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify, abort, Response, Request
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 import mysql.connector
-from mysql.connector import Error
-import uuid
-from PIL import Image
+from mysql.connector import Error, InterfaceError, OperationalError, errorcode
 import math
+import time
+import click
+import re
+import atexit
+import multiprocessing
+import hashlib
+import base64
+import functools
+import mimetypes
+import tempfile
+import uuid
+from contextlib import contextmanager
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from db_pool import ConnectionPool, PoolExhaustedError
+from circuit_breaker import CircuitBreaker, OPEN
+from cache import TTLCache, GenerationalCache
+from view_counter import ViewCounter, UniqueViewerTracker
+from hyperloglog import HyperLogLog
+from search_engine import FulltextSearch, LIKES_BUCKETS
+from suggest_index import SuggestIndex
+from image_jobs import JobQueue, ProcessRunner
+from disk_cache import DiskCache
+from chunked_upload import ChunkStore, ChunkRejected, QuotaExceeded, UploadInProgress, UploadNotFound
+import blob_store
+import image_processing
+import media_tasks
+import storage
 
 # ====================== 1. 初始化Flask应用 ======================
 app = Flask(__name__, static_folder='static', static_url_path='/static')
@@ -26,15 +54,117 @@ DB_CONFIG = {
     'user': 'pic_share_user',
     'password': '123456',
     'database': 'pic_share_db',
-    'charset': 'utf8mb4'
+    'charset': 'utf8mb4',
+    # 超时（秒）：数据库卡住时尽快失败，避免工作线程堆积
+    'connection_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 3)),
+    'read_timeout': int(os.environ.get('DB_READ_TIMEOUT', 10)),
+    'write_timeout': int(os.environ.get('DB_WRITE_TIMEOUT', 10))
 }
 
 # ====================== 3. 基础配置 ======================
 app.config['SECRET_KEY'] = 'dev-pic-share-2025-123456'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+# 上传直接流式写到磁盘（见 UploadRequest），请求体大小不影响内存占用
+app.config['UPLOAD_MAX_SIZE'] = int(os.environ.get('UPLOAD_MAX_SIZE', 64 * 1024 * 1024))  # 单张图片上限，64MB
+app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_MAX_SIZE'] + 1024 * 1024  # 图片加上表单里的其他字段
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static', 'uploads')
 
+# 上传文件存储：local 存在 UPLOAD_FOLDER；s3 存在兼容S3 API的对象存储，多台Web节点、Serverless部署共用
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')  # local 或 s3
+app.config['STORAGE_S3_ENDPOINT'] = os.environ.get('STORAGE_S3_ENDPOINT', 'http://127.0.0.1:9000')
+app.config['STORAGE_S3_BUCKET'] = os.environ.get('STORAGE_S3_BUCKET', 'pic-share')
+app.config['STORAGE_S3_REGION'] = os.environ.get('STORAGE_S3_REGION', 'us-east-1')
+app.config['STORAGE_S3_ACCESS_KEY'] = os.environ.get('STORAGE_S3_ACCESS_KEY', '')
+app.config['STORAGE_S3_SECRET_KEY'] = os.environ.get('STORAGE_S3_SECRET_KEY', '')
+app.config['STORAGE_S3_PREFIX'] = os.environ.get('STORAGE_S3_PREFIX', '')  # 对象key的公共前缀
+app.config['STORAGE_PUBLIC_URL'] = os.environ.get('STORAGE_PUBLIC_URL', '')  # 原图直接指向这个地址（CDN/公开读的bucket，含前缀），为空时由 /uploads/ 转发
+
+# 本地存储的文件发送方式（/uploads/、/media/ 等）：
+#   direct  Python进程发送，WSGI服务器提供 wsgi.file_wrapper 时（gunicorn等）用sendfile零拷贝
+#   accel   返回 X-Accel-Redirect 由nginx发送，Python只做检查、条件请求和响应头；nginx里需要配置：
+#               location /_uploads/ {
+#                   internal;
+#                   alias /path/to/static/uploads/;
+#                   etag off;                              # 内部跳转时nginx只保留Content-Type、Cache-Control等少数上游头，
+#                   add_header ETag $upstream_http_etag;   # ETag 和 Vary 要显式带上：用应用给的内容哈希强ETag，
+#                   add_header Vary $upstream_http_vary;   # /media/ 按Accept协商格式，CDN需要按Accept区分缓存
+#               }
+#           缺少后两行时 /media/ 的 Vary: Accept 会丢失，CDN可能把AVIF发给不支持的浏览器
+#   sendfile 返回 X-Sendfile 由Apache(mod_xsendfile)/lighttpd发送
+# 交给前端代理时，Range请求由代理处理
+app.config['UPLOAD_SERVE_MODE'] = os.environ.get('UPLOAD_SERVE_MODE', 'direct')
+app.config['UPLOAD_ACCEL_PREFIX'] = os.environ.get('UPLOAD_ACCEL_PREFIX', '/_uploads/')  # nginx里internal的location
+
+# 数据库连接池配置
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_POOL_MAX_LIFETIME'] = int(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))  # 秒
+app.config['DB_POOL_MAX_IDLE'] = int(os.environ.get('DB_POOL_MAX_IDLE', 300))  # 秒
+app.config['DB_POOL_PING_INTERVAL'] = int(os.environ.get('DB_POOL_PING_INTERVAL', 30))  # 秒
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))  # 借连接最长等待秒数
+
+# 登录用户缓存配置
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))  # 秒
+
+# 浏览量写回配置
+app.config['VIEW_FLUSH_INTERVAL_MS'] = int(os.environ.get('VIEW_FLUSH_INTERVAL_MS', 2000))
+app.config['VIEW_FLUSH_MAX_PENDING'] = int(os.environ.get('VIEW_FLUSH_MAX_PENDING', 500))
+
+app.config['UNIQUE_VIEW_FLUSH_INTERVAL'] = int(os.environ.get('UNIQUE_VIEW_FLUSH_INTERVAL', 30))  # 秒
+
+# 首页每页图片数
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 30))
+
+# 搜索结果缓存配置（图片增删时整体失效）
+app.config['SEARCH_CACHE_SIZE'] = int(os.environ.get('SEARCH_CACHE_SIZE', 2048))
+app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL', 60))  # 秒，结果页
+app.config['SEARCH_COUNT_CACHE_TTL'] = int(os.environ.get('SEARCH_COUNT_CACHE_TTL', 300))  # 秒，总数
+
+# 搜索联想配置
+app.config['SUGGEST_REFRESH_INTERVAL'] = int(os.environ.get('SUGGEST_REFRESH_INTERVAL', 600))  # 秒
+app.config['SUGGEST_MAX_IMAGES'] = int(os.environ.get('SUGGEST_MAX_IMAGES', 100000))  # 只索引最热门的这些图片标题
+
+# "我是否点赞过"状态缓存配置
+app.config['LIKED_CACHE_SIZE'] = int(os.environ.get('LIKED_CACHE_SIZE', 2048))  # 缓存的用户数
+app.config['LIKED_CACHE_TTL'] = int(os.environ.get('LIKED_CACHE_TTL', 300))  # 秒
+
+# 数据库熔断配置
+app.config['DB_BREAKER_THRESHOLD'] = int(os.environ.get('DB_BREAKER_THRESHOLD', 3))  # 连续失败次数
+app.config['DB_BREAKER_RESET_TIMEOUT'] = int(os.environ.get('DB_BREAKER_RESET_TIMEOUT', 30))  # 秒
+
+# 后台图片处理配置
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', min(4, os.cpu_count() or 1)))  # 处理进程数
+app.config['IMAGE_JOB_MAX_ATTEMPTS'] = int(os.environ.get('IMAGE_JOB_MAX_ATTEMPTS', 5))
+app.config['IMAGE_JOB_POLL_INTERVAL'] = int(os.environ.get('IMAGE_JOB_POLL_INTERVAL', 5))  # 秒
+app.config['IMAGE_JOB_LEASE'] = int(os.environ.get('IMAGE_JOB_LEASE', 300))  # 秒，超时视为执行进程已退出
+
+# 多尺寸图片宽度（像素），前端按 srcset 选择合适的一张
+app.config['RENDITION_WIDTHS'] = [int(w) for w in os.environ.get('RENDITION_WIDTHS', '320,640,1280,2048').split(',') if w.strip()]
+app.config['RENDITION_CACHE_SIZE'] = int(os.environ.get('RENDITION_CACHE_SIZE', 10000))  # 缓存的图片数
+
+# 缩略图/多尺寸图片的浏览器缓存时间（文件名带UUID，内容不会变）
+app.config['MEDIA_CACHE_MAX_AGE'] = int(os.environ.get('MEDIA_CACHE_MAX_AGE', 30 * 24 * 3600))  # 秒
+
+# 按需变换（/img/<id>）配置：只允许这些宽高，防止任意尺寸把缓存撑爆
+app.config['TRANSFORM_SIZES'] = sorted({int(v) for v in os.environ.get(
+    'TRANSFORM_SIZES', '64,96,128,160,200,240,300,320,400,480,640,800,960,1024,1280,1600,1920,2048').split(',') if v.strip()})
+app.config['TRANSFORM_CACHE_DIR'] = os.environ.get('TRANSFORM_CACHE_DIR', os.path.join(app.root_path, 'cache', 'img'))
+app.config['TRANSFORM_CACHE_MAX_BYTES'] = int(os.environ.get('TRANSFORM_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 1GB
+app.config['TRANSFORM_WORKERS'] = int(os.environ.get('TRANSFORM_WORKERS', 2))  # 处理进程数
+app.config['TRANSFORM_TIMEOUT'] = int(os.environ.get('TRANSFORM_TIMEOUT', 30))  # 秒
+
+# 分块断点续传：大文件在手机网络下分块上传，断了只重传缺的块
+app.config['UPLOAD_CHUNK_DIR'] = os.environ.get('UPLOAD_CHUNK_DIR', os.path.join(app.root_path, 'cache', 'chunks'))
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # 每块字节数
+app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))  # 秒，最后一块上传后多久过期
+app.config['UPLOAD_MAX_SESSIONS_PER_USER'] = int(os.environ.get('UPLOAD_MAX_SESSIONS_PER_USER', 10))  # 每个用户同时未完成的分块上传个数
+app.config['UPLOAD_MAX_RESERVED_PER_USER'] = int(os.environ.get('UPLOAD_MAX_RESERVED_PER_USER', 4 * app.config['UPLOAD_MAX_SIZE']))  # 每个用户未完成的分块上传总字节数
+
+# 解码预算：上传时只读文件头检查，超出的直接拒绝；处理进程解码前再检查一次
+app.config['IMAGE_MAX_PIXELS'] = int(os.environ.get('IMAGE_MAX_PIXELS', 40 * 1000 * 1000))  # 像素数，RGBA约160MB
+app.config['IMAGE_MAX_FRAMES'] = int(os.environ.get('IMAGE_MAX_FRAMES', 200))  # 动图帧数
+app.config['IMAGE_DECODE_CONCURRENCY'] = int(os.environ.get('IMAGE_DECODE_CONCURRENCY', 2))  # 所有处理进程同时解码的图片数
+
 # ====================== 4. 日志配置 ======================
 logging.basicConfig(
     level=logging.INFO,
@@ -51,26 +181,62 @@ login_manager.login_message = '请先登录以访问该页面！'
 login_manager.login_message_category = 'warning'
 
 # ====================== 6. 数据库辅助函数 ======================
-def get_db_connection():
-    """获取数据库连接"""
+# 这些错误说明是账号问题，数据库本身可达，才值得用root账号再试一次
+AUTH_ERRNOS = (errorcode.ER_ACCESS_DENIED_ERROR, errorcode.ER_DBACCESS_DENIED_ERROR)
+
+db_breaker = CircuitBreaker(
+    'mysql',
+    failure_threshold=app.config['DB_BREAKER_THRESHOLD'],
+    reset_timeout=app.config['DB_BREAKER_RESET_TIMEOUT']
+)
+
+def _connect_mysql():
+    """新建一个物理连接（连接池内部使用）"""
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = mysql.connector.connect(autocommit=True, **DB_CONFIG)
+        db_breaker.record_success()
         return conn
     except Error as e:
         logger.error(f"数据库连接失败: {e}")
+        if e.errno not in AUTH_ERRNOS:
+            # 网络不通或超时，换账号也连不上，直接记一次失败
+            db_breaker.record_failure()
+            return None
         try:
             backup_config = DB_CONFIG.copy()
             backup_config['user'] = 'root'
             backup_config['password'] = '123456'
-            conn = mysql.connector.connect(**backup_config)
+            conn = mysql.connector.connect(autocommit=True, **backup_config)
             logger.info("使用root用户连接数据库成功")
+            db_breaker.record_success()
             return conn
         except Error as e2:
             logger.error(f"备用连接也失败: {e2}")
+        db_breaker.record_failure()
+        return None
+
+db_pool = ConnectionPool(
+    _connect_mysql,
+    size=app.config['DB_POOL_SIZE'],
+    max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+    max_idle=app.config['DB_POOL_MAX_IDLE'],
+    ping_interval=app.config['DB_POOL_PING_INTERVAL'],
+    borrow_timeout=app.config['DB_POOL_TIMEOUT']
+)
+atexit.register(db_pool.close_all)
+
+def get_db_connection():
+    """从连接池借出数据库连接，用完调用close()归还；熔断打开时直接返回None"""
+    if not db_breaker.allow_request():
+        return None
+    try:
+        return db_pool.get_connection()
+    except PoolExhaustedError as e:
+        logger.error(f"获取数据库连接失败: {e}, 连接池状态: {db_pool.stats()}")
         return None
 
-def execute_query(query, params=None, fetch_one=False, fetch_all=False, commit=False):
-    """执行SQL查询"""
+def execute_query(query, params=None, fetch_one=False, fetch_all=False, commit=False, rowcount=False):
+    """执行SQL查询；rowcount=True 时返回受影响行数（失败返回None）"""
     conn = get_db_connection()
     if conn is None:
         return None
@@ -87,18 +253,29 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, commit=F
             result = cursor.fetchone()
         elif fetch_all:
             result = cursor.fetchall()
+        elif rowcount:
+            result = cursor.rowcount
         elif commit:
             result = cursor.lastrowid
         else:
             result = None
 
+        db_breaker.record_success()
         return result
     except Error as e:
         logger.error(f"SQL执行失败: {e}")
         logger.error(f"SQL查询: {query}")
         logger.error(f"参数: {params}")
-        if conn:
-            conn.rollback()
+        if isinstance(e, (InterfaceError, OperationalError)):
+            # 连接层错误，归还时丢弃该连接
+            conn.invalidate()
+            db_breaker.record_failure()
+        else:
+            db_breaker.record_success()
+            try:
+                conn.rollback()
+            except Error:
+                conn.invalidate()
         return None
     finally:
         if cursor:
@@ -106,8 +283,53 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, commit=F
         if conn:
             conn.close()
 
+@contextmanager
+def db_transaction():
+    """
+    在同一个连接上执行一组语句：正常结束提交，出错回滚并继续抛出异常
+    用法: with db_transaction() as cursor: cursor.execute(...)
+    """
+    conn = get_db_connection()
+    if conn is None:
+        raise OperationalError("数据库不可用")
+
+    cursor = None
+    try:
+        conn.start_transaction()
+        cursor = conn.cursor(dictionary=True)
+        yield cursor
+        conn.commit()
+        db_breaker.record_success()
+    except Exception as e:
+        if isinstance(e, (InterfaceError, OperationalError)):
+            conn.invalidate()
+            db_breaker.record_failure()
+        else:
+            try:
+                conn.rollback()
+            except Error:
+                conn.invalidate()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+
 # ====================== 7. 数据模型 ======================
-class User(UserMixin):
+# 已登录用户缓存：user_loader 每个请求都要用，避免每次都查一遍users表
+# 直接改数据库（比如 fix_admin_id.py、禁用用户）最多 USER_CACHE_TTL 秒后生效
+user_cache = TTLCache(
+    maxsize=app.config['USER_CACHE_SIZE'],
+    ttl=app.config['USER_CACHE_TTL']
+)
+
+class User:
+    """
+    登录用户，实现Flask-Login需要的接口
+    使用__slots__而不是UserMixin，缓存中每个用户对象只保留这几个字段
+    """
+    __slots__ = ('id', 'username', 'email', 'password_hash', 'created_at', '_is_active')
+
     def __init__(self, id, username, email, password_hash, created_at=None, is_active=True):
         self.id = id
         self.username = username
@@ -120,60 +342,72 @@ class User(UserMixin):
     def is_active(self):
         return self._is_active
 
+    @is_active.setter
+    def is_active(self, value):
+        self._is_active = value
+
+    @property
+    def is_authenticated(self):
+        return self.is_active
+
+    @property
+    def is_anonymous(self):
+        return False
+
     @property
     def is_admin(self):
         """判断是否为管理员"""
         # 用户名为admin或ID为1的用户视为管理员
         return self.username == 'admin' or self.id == 1
 
-    @is_active.setter
-    def is_active(self, value):
-        self._is_active = value
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @staticmethod
+    def _from_row(result):
+        if not result:
+            return None
+        return User(
+            id=result['id'],
+            username=result['username'],
+            email=result['email'],
+            password_hash=result['password_hash'],
+            created_at=result.get('created_at'),
+            is_active=bool(result.get('is_active', True))
+        )
 
     @staticmethod
     def get_by_id(user_id):
         query = "SELECT * FROM users WHERE id = %s"
-        result = execute_query(query, (user_id,), fetch_one=True)
-        if result:
-            return User(
-                id=result['id'],
-                username=result['username'],
-                email=result['email'],
-                password_hash=result['password_hash'],
-                created_at=result.get('created_at'),
-                is_active=bool(result.get('is_active', True))
-            )
-        return None
+        return User._from_row(execute_query(query, (user_id,), fetch_one=True))
+
+    @staticmethod
+    def get_cached(user_id):
+        """按ID取用户，优先走缓存（供user_loader使用）"""
+        user = user_cache.get(user_id)
+        if user is None:
+            user = User.get_by_id(user_id)
+            if user is not None:
+                user_cache.set(user_id, user)
+        return user
 
     @staticmethod
     def get_by_username(username):
         query = "SELECT * FROM users WHERE username = %s"
-        result = execute_query(query, (username,), fetch_one=True)
-        if result:
-            return User(
-                id=result['id'],
-                username=result['username'],
-                email=result['email'],
-                password_hash=result['password_hash'],
-                created_at=result.get('created_at'),
-                is_active=bool(result.get('is_active', True))
-            )
-        return None
+        return User._from_row(execute_query(query, (username,), fetch_one=True))
 
     @staticmethod
     def get_by_email(email):
         query = "SELECT * FROM users WHERE email = %s"
-        result = execute_query(query, (email,), fetch_one=True)
-        if result:
-            return User(
-                id=result['id'],
-                username=result['username'],
-                email=result['email'],
-                password_hash=result['password_hash'],
-                created_at=result.get('created_at'),
-                is_active=bool(result.get('is_active', True))
-            )
-        return None
+        return User._from_row(execute_query(query, (email,), fetch_one=True))
 
     @staticmethod
     def create(username, password, email=None):
@@ -194,40 +428,392 @@ class User(UserMixin):
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return User.get_by_id(int(user_id))
+        return User.get_cached(int(user_id))
     except:
         return None
 
+# ====================== 8.1 浏览量写回 ======================
+def flush_view_counts(deltas):
+    """把多张图片的浏览增量合并成一条UPDATE写回"""
+    image_ids = sorted(deltas)  # 固定加锁顺序，避免并发写回时死锁
+    cases = ' '.join(['WHEN %s THEN %s'] * len(image_ids))
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    query = f"UPDATE images SET views = views + CASE id {cases} END WHERE id IN ({placeholders})"
+    params = []
+    for image_id in image_ids:
+        params.extend((image_id, deltas[image_id]))
+    params.extend(image_ids)
+    return execute_query(query, tuple(params), commit=True, rowcount=True) is not None
+
+def flush_unique_viewers(sketches):
+    """把内存中的HyperLogLog草图与数据库中的寄存器合并后写回"""
+    image_ids = sorted(sketches)
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    try:
+        with db_transaction() as cursor:
+            cursor.execute(
+                f"SELECT image_id, registers FROM image_unique_viewers "
+                f"WHERE image_id IN ({placeholders}) FOR UPDATE",
+                tuple(image_ids)
+            )
+            stored = {row['image_id']: row['registers'] for row in cursor.fetchall()}
+
+            rows = []
+            for image_id in image_ids:
+                sketch = sketches[image_id]
+                if stored.get(image_id):
+                    sketch = HyperLogLog.from_bytes(stored[image_id]).merge(sketch)
+                rows.append((image_id, sketch.to_bytes(), sketch.count()))
+
+            cursor.executemany("""
+                INSERT INTO image_unique_viewers (image_id, registers, unique_views)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE registers = VALUES(registers), unique_views = VALUES(unique_views)
+            """, rows)
+        return True
+    except Error as e:
+        logger.error(f"独立访客写回失败: {e}")
+        return False
+
+def viewer_key():
+    """访客标识：登录用户用ID，匿名访客用IP+UA的哈希指纹"""
+    if current_user.is_authenticated:
+        return f"u:{current_user.id}"
+    raw = f"{app.config['SECRET_KEY']}|{request.remote_addr}|{request.user_agent.string}"
+    return 'a:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+view_counter = ViewCounter(
+    flush_view_counts,
+    flush_interval=app.config['VIEW_FLUSH_INTERVAL_MS'] / 1000,
+    max_pending=app.config['VIEW_FLUSH_MAX_PENDING']
+)
+atexit.register(view_counter.shutdown)
+
+unique_viewers = UniqueViewerTracker(
+    flush_unique_viewers,
+    flush_interval=app.config['UNIQUE_VIEW_FLUSH_INTERVAL']
+)
+atexit.register(unique_viewers.shutdown)
+
+# ====================== 8.2 后台图片处理 ======================
+# 图片处理状态：上传后为processing，缩略图生成后为ready，重试用完仍失败为failed（仍可显示原图）
+PROCESSING, READY, PROCESSING_FAILED = 'processing', 'ready', 'failed'
+
+# 上传文件的存储后端，处理进程里的任务也通过它读写文件
+upload_storage = storage.create_storage(app.config)
+
+# 后台任务和按需变换的进程池共用解码名额：进程数可以多一些（编码、写文件不占名额），
+# 同时解码的大图数量仍然有上限，内存峰值约为 名额数 x IMAGE_MAX_PIXELS x 4字节
+decode_slots = multiprocessing.get_context('spawn').BoundedSemaphore(app.config['IMAGE_DECODE_CONCURRENCY'])
+worker_initargs = (decode_slots, app.config['IMAGE_MAX_PIXELS'], app.config['IMAGE_MAX_FRAMES'])
+
+job_queue = JobQueue(
+    execute_query,
+    workers=app.config['IMAGE_WORKERS'],
+    poll_interval=app.config['IMAGE_JOB_POLL_INTERVAL'],
+    max_attempts=app.config['IMAGE_JOB_MAX_ATTEMPTS'],
+    lease=app.config['IMAGE_JOB_LEASE'],
+    initializer=image_processing.init_worker,
+    initargs=worker_initargs
+)
+atexit.register(job_queue.shutdown)
+
+def on_thumbnail_ready(image_id, thumbnail_name):
+    """缩略图生成完成，回写路径和状态"""
+    with db_transaction() as cursor:
+        # 按行是否存在判断图片有没有被删除：重新执行的任务写入相同的值时 UPDATE 的影响行数也是0
+        cursor.execute("SELECT id FROM images WHERE id = %s FOR UPDATE", (image_id,))
+        if cursor.fetchone() is None:
+            # 处理期间图片已被删除，清理刚生成的缩略图
+            remove_upload_files([thumbnail_name])
+            return
+        cursor.execute("UPDATE images SET thumbnail_path = %s, processing_status = %s WHERE id = %s",
+                       (f"uploads/{thumbnail_name}", READY, image_id))
+    search_cache.bump()
+
+def on_thumbnail_failed(image_id, error):
+    update_query = "UPDATE images SET processing_status = %s WHERE id = %s"
+    execute_query(update_query, (PROCESSING_FAILED, image_id), commit=True)
+
+job_queue.register('thumbnail', image_processing.make_thumbnail, on_thumbnail_ready, on_thumbnail_failed,
+                   fatal=(image_processing.ImageRejected,))
+
+def upload_path(filename):
+    """文件在上传目录里的分片位置（ab/cd/<文件名>），只用于本地存储"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], *blob_store.shard_path(filename).split('/'))
+
+def find_upload(filename):
+    """文件实际所在的位置：uploads-migrate 跑完之前，旧文件可能还在上传目录根下"""
+    path = upload_path(filename)
+    if not os.path.exists(path):
+        flat_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if os.path.exists(flat_path):
+            return flat_path
+    return path
+
+def upload_key(filename):
+    """文件在存储后端里的key；本地存储时同样会找到还没迁移的平铺文件"""
+    if upload_storage.local_root:
+        return os.path.relpath(find_upload(filename), app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    return blob_store.shard_path(filename)
+
+def send_upload(filename, mimetype=None, max_age=None):
+    """
+    返回上传的文件：本地存储按 UPLOAD_SERVE_MODE 发送或交给前端代理，对象存储边读边转发
+    按内容命名的文件用内容哈希做强ETag，不用stat出来的修改时间，多台机器、重新上传后都一样
+    """
+    if upload_storage.local_root is None:
+        return stream_upload(blob_store.shard_path(filename), mimetype, max_age)
+    path = find_upload(filename)
+    etag = blob_store.content_etag(os.path.basename(path))
+    if app.config['UPLOAD_SERVE_MODE'] in ('accel', 'sendfile'):
+        return offload_upload(path, mimetype, max_age, etag)
+    return send_from_directory(os.path.dirname(path), os.path.basename(path), mimetype=mimetype, max_age=max_age,
+                               etag=etag or True)
+
+def offload_upload(path, mimetype=None, max_age=None, etag=None):
+    """
+    只返回响应头，文件内容由前端代理发送；条件请求在这里直接返回304，代理不用再读文件
+    nginx 只有按 UPLOAD_SERVE_MODE 注释里的配置才会把这里的 ETag 和 Vary 发给客户端
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+    response = Response(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response.set_etag(etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    response.last_modified = stat.st_mtime
+    response.accept_ranges = 'bytes'
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    response.make_conditional(request)
+    # 304时不能带转发头，否则代理仍会发送整个文件
+    if response.status_code == 200:
+        if app.config['UPLOAD_SERVE_MODE'] == 'accel':
+            relative = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relative)
+        else:
+            response.headers['X-Sendfile'] = path
+    return response
+
+def stream_upload(key, mimetype=None, max_age=None):
+    """从对象存储流式转发，支持单段Range请求（视频拖动、断点续传）和ETag/Last-Modified条件请求"""
+    start = end = None
+    byte_range = request.range
+    if byte_range and byte_range.units == 'bytes' and len(byte_range.ranges) == 1 and byte_range.ranges[0][0] >= 0:
+        start, stop = byte_range.ranges[0]
+        end = stop - 1 if stop is not None else None
+    try:
+        obj = upload_storage.get(key, start, end)
+    except storage.ObjectNotFound:
+        abort(404)
+    except storage.RangeNotSatisfiable:
+        abort(416)
+    except storage.StorageError as e:
+        logger.error(f"读取对象存储失败: {key}: {e}")
+        abort(502)
+
+    partial = start is not None
+    response = Response(obj.body, status=206 if partial else 200, direct_passthrough=True,
+                        mimetype=mimetype or obj.content_type or mimetypes.guess_type(key)[0])
+    response.call_on_close(obj.close)
+    response.content_length = obj.length
+    response.accept_ranges = 'bytes'
+    if partial:
+        response.content_range = f"bytes {obj.start}-{obj.end}/{obj.size}"
+    etag = blob_store.content_etag(key.rsplit('/', 1)[-1])
+    if etag:
+        response.set_etag(etag)
+    elif obj.etag:
+        response.headers['ETag'] = obj.etag
+    response.last_modified = obj.last_modified
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    if not partial:
+        response.make_conditional(request)
+    return response
+
+def remove_upload_files(filenames):
+    """删除存储里的文件，连同它们的AVIF/WebP版本"""
+    keys = []
+    for filename in filenames:
+        for name in [filename] + image_processing.variant_names(filename):
+            keys.append(blob_store.shard_path(name))
+            if upload_storage.local_root:
+                keys.append(name)  # 还没迁移的平铺文件
+        media_variants.delete(filename)
+    upload_storage.delete_many(keys)
+
+def on_renditions_ready(image_id, result):
+    """缩略图和多尺寸版本生成完成，记录到数据库"""
+    renditions = result['renditions']
+    with db_transaction() as cursor:
+        # 按行是否存在判断图片有没有被删除：重新生成时写入的值和原来一样，UPDATE 的影响行数也是0
+        # 锁住这一行直到提交，期间删除图片的请求会等待
+        cursor.execute("SELECT id FROM images WHERE id = %s FOR UPDATE", (image_id,))
+        if cursor.fetchone() is None:
+            # 处理期间图片已被删除，没有其他图片引用同样的内容时清理刚生成的文件
+            content_hash = blob_store.content_hash_of(result['thumbnail'])
+            if content_hash is None or not blob_store.is_referenced(cursor, content_hash):
+                remove_upload_files([result['thumbnail']] + [r['filename'] for r in renditions])
+            return
+        cursor.execute(
+            "UPDATE images SET thumbnail_path = %s, processing_status = %s WHERE id = %s",
+            (f"uploads/{blob_store.shard_path(result['thumbnail'])}", READY, image_id))
+        cursor.execute("DELETE FROM image_renditions WHERE image_id = %s", (image_id,))
+        if renditions:
+            cursor.executemany("""
+                INSERT INTO image_renditions (image_id, width, height, filename, file_size)
+                VALUES (%s, %s, %s, %s, %s)
+            """, [(image_id, r['width'], r['height'], r['filename'], r['file_size']) for r in renditions])
+    rendition_cache.delete(image_id)
+    search_cache.bump()
+
+job_queue.register('renditions', functools.partial(media_tasks.make_renditions, upload_storage),
+                   on_renditions_ready, on_thumbnail_failed, fatal=(image_processing.ImageRejected,))
+
+def copy_renditions(cursor, image_id, content_hash):
+    """
+    在调用方事务里把同样内容的另一张已处理完的图片的缩略图和多尺寸记录复制给新图片
+    文件按内容命名，本来就是同一份；没有处理完的同内容图片时返回False
+    """
+    cursor.execute("""
+        SELECT id, thumbnail_path FROM images
+        WHERE content_hash = %s AND processing_status = %s AND id <> %s
+        LIMIT 1
+    """, (content_hash, READY, image_id))
+    source = cursor.fetchone()
+    if source is None or not source['thumbnail_path']:
+        return False
+    cursor.execute("UPDATE images SET thumbnail_path = %s, processing_status = %s WHERE id = %s",
+                   (source['thumbnail_path'], READY, image_id))
+    cursor.execute("""
+        INSERT INTO image_renditions (image_id, width, height, filename, file_size)
+        SELECT %s, width, height, filename, file_size FROM image_renditions WHERE image_id = %s
+    """, (image_id, source['id']))
+    return True
+
+def submit_renditions(cursor, image_id, filename):
+    """在调用方事务里提交生成缩略图和多尺寸版本的任务"""
+    return job_queue.enqueue(cursor, 'renditions', image_id, key=upload_key(filename),
+                             widths=app.config['RENDITION_WIDTHS'])
+
+# 图片ID -> 多尺寸版本列表；生成后不会变，删除图片或重新生成时失效
+rendition_cache = TTLCache(maxsize=app.config['RENDITION_CACHE_SIZE'], ttl=3600)
+
+def attach_renditions(images):
+    """给图片列表中的每一项加上 renditions 字段（按宽度从小到大），缓存没有的用一条IN查询补齐"""
+    if not images:
+        return
+    found = {}
+    missing = []
+    for image in images:
+        cached = rendition_cache.get(image['id'])
+        if cached is None:
+            missing.append(image['id'])
+        else:
+            found[image['id']] = cached
+    if missing:
+        placeholders = ', '.join(['%s'] * len(missing))
+        rows = execute_query(f"""
+            SELECT image_id, width, height, filename FROM image_renditions
+            WHERE image_id IN ({placeholders})
+            ORDER BY image_id, width
+        """, tuple(missing), fetch_all=True)
+        loaded = {}
+        for row in rows or []:
+            loaded.setdefault(row['image_id'], []).append(
+                {'width': row['width'], 'height': row['height'], 'filename': row['filename']})
+        # 还没有生成的不缓存，处理完成后马上能看到
+        for image_id, renditions in loaded.items():
+            rendition_cache.set(image_id, renditions)
+        found.update(loaded)
+    for image in images:
+        image['renditions'] = found.get(image['id'], [])
+
+def rendition_srcset(image):
+    """生成 srcset 属性值，没有多尺寸版本时返回空字符串"""
+    return ', '.join(f"/media/{r['filename']} {r['width']}w" for r in image.get('renditions') or [])
+
+# 按压缩率从高到低尝试的格式
+MEDIA_FORMATS = (('avif', 'image/avif'), ('webp', 'image/webp'))
+
+# 文件名 -> {格式: 字节数}，原格式的键是None；缓存各版本的大小，避免每个请求都stat（对象存储是一次HEAD请求）
+media_variants = TTLCache(maxsize=app.config['RENDITION_CACHE_SIZE'], ttl=300)
+
+def available_variants(filename):
+    """存储里已有的各格式版本和它们的大小，不存在的格式不出现"""
+    variants = media_variants.get(filename)
+    if variants is None:
+        variants = {}
+        for ext, name in [(None, filename)] + [(ext, image_processing.variant_name(filename, ext))
+                                               for ext, _ in MEDIA_FORMATS]:
+            size = upload_storage.size(upload_key(name))
+            if size is not None:
+                variants[ext] = size
+        media_variants.set(filename, variants)
+    return variants
+
+@app.template_global()
+def upload_url(file_path):
+    """
+    原图的URL，file_path 是数据库里的 uploads/ab/cd/<文件名>
+    本地存储走静态文件；对象存储配置了公开地址时直接指向它，否则由 /uploads/ 转发
+    """
+    if upload_storage.local_root:
+        return url_for('static', filename=file_path)
+    key = file_path.split('/', 1)[1]
+    if app.config['STORAGE_PUBLIC_URL']:
+        return f"{app.config['STORAGE_PUBLIC_URL'].rstrip('/')}/{key}"
+    return url_for('uploaded_file', filename=key.split('/')[-1])
+
+def client_accepts(mimetype):
+    """Accept头里明确列出了该类型（只有 */* 的老客户端不算）"""
+    return any(value == mimetype and quality > 0 for value, quality in request.accept_mimetypes)
+
 # ====================== 9. 辅助函数 ======================
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
 def ensure_upload_folder():
+    if upload_storage.local_root is None:
+        return
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         logger.info(f"创建上传文件夹：{app.config['UPLOAD_FOLDER']}")
 
-def create_thumbnail(image_path, max_size=(300, 200)):
-    """创建缩略图"""
-    try:
-        with Image.open(image_path) as img:
-            img.thumbnail(max_size)
-            thumbnail_name = f"thumb_{os.path.basename(image_path)}"
-            thumbnail_path = os.path.join(app.config['UPLOAD_FOLDER'], thumbnail_name)
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1])
-                img = background
-
-            if thumbnail_name.lower().endswith('.jpg') or thumbnail_name.lower().endswith('.jpeg'):
-                img.save(thumbnail_path, 'JPEG', quality=85)
-            else:
-                img.save(thumbnail_path, 'PNG')
-            return thumbnail_name
-    except Exception as e:
-        logger.error(f"创建缩略图失败: {e}")
-        return None
+# 这些路由的上传文件由表单解析器直接写进 TempBlob，不经过Werkzeug自己的内存缓冲/临时文件：
+# 请求体只读一遍，大小、SHA-256和文件头在写入时就得到了
+STREAMING_UPLOAD_ENDPOINTS = {'upload'}
+
+def new_upload_blob():
+    """
+    新建接收上传内容的临时文件，请求结束时没有移到存储里的自动删除
+    本地存储的临时文件和上传目录在同一个文件系统上，放到最终位置只是一次重命名
+    """
+    ensure_upload_folder()
+    blob = blob_store.TempBlob(upload_storage.local_root or tempfile.gettempdir(), image_processing.SNIFF_BYTES)
+    if not hasattr(request, 'upload_blobs'):
+        request.upload_blobs = []
+    request.upload_blobs.append(blob)
+    return blob
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in STREAMING_UPLOAD_ENDPOINTS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return new_upload_blob()
+
+app.request_class = UploadRequest
+
+@app.teardown_request
+def discard_upload_blobs(error=None):
+    """没有移到存储里的临时文件（校验没通过、保存失败、表单里多余的文件字段）在请求结束时删除"""
+    for blob in getattr(request, 'upload_blobs', ()):
+        blob.discard()
 
 # ====================== 10. 上下文处理器 ======================
 @app.context_processor
@@ -241,48 +827,182 @@ def inject_music_config():
         'enable_music': True,  # 控制是否启用音乐播放器
         'default_playlist': '3778678',  # 默认播放列表ID
     }
+# ====================== 10.1 数据库熔断降级 ======================
+# 不依赖数据库的端点，熔断时照常处理；/img/ 最近查过的图片（image_source_cache）照常返回缓存的变体，
+# 其余由 transformed_image 返回503
+DB_FREE_ENDPOINTS = {'static', 'uploaded_file', 'legacy_upload', 'media_file', 'health', 'api_suggest',
+                     'transformed_image'}
+
+# 最近一次成功查询到的首页数据，数据库不可用时作为降级内容
+_feed_snapshot = {'images': None, 'time': None}
+
+@app.before_request
+def fail_fast_when_db_down():
+    """熔断打开时不再尝试连接数据库：首页返回缓存内容，其余返回503"""
+    if request.endpoint in DB_FREE_ENDPOINTS or db_breaker.state != OPEN:
+        return None
+
+    retry_after = db_breaker.retry_after()
+    if request.endpoint == 'index' and _feed_snapshot['images'] is not None:
+        flash('数据库暂时不可用，当前显示的是缓存内容', 'warning')
+        # 复制一份再加当前用户的点赞状态（熔断时只能用缓存里的），快照本身不带任何用户的状态
+        images = [dict(image) for image in _feed_snapshot['images']]
+        attach_liked_state(images)
+        response = app.make_response(render_template('index.html', images=images))
+    else:
+        response = app.make_response((render_template('index.html', error_503=True), 503))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.route('/health')
+def health():
+    """健康检查：数据库熔断状态与连接池指标"""
+    breaker = db_breaker.snapshot()
+    status = 503 if breaker['state'] == OPEN else 200
+    return jsonify({
+        'database': breaker,
+        'pool': db_pool.stats(),
+        'search_cache': search_cache.stats(),
+        'image_jobs': job_queue.stats(),
+        'transform_cache': transform_cache.stats()
+    }), status
+
 # ====================== 11. 核心路由 ======================
+# ---------- 游标分页 ----------
+def encode_cursor(sort_value, image_id):
+    """把排序键 (排序值, id) 编码成URL安全的游标，排序值是时间或相关度分数"""
+    if isinstance(sort_value, datetime):
+        value = sort_value.isoformat()
+    else:
+        value = repr(float(sort_value))
+    raw = f"{value}|{image_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """解析游标，格式不对返回None"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        value, image_id = raw.rsplit('|', 1)
+        try:
+            sort_value = datetime.fromisoformat(value)
+        except ValueError:
+            sort_value = float(value)
+        return sort_value, int(image_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def fetch_feed_page(cursor=None, limit=None):
+    """
+    按 (upload_time, id) 倒序取一页公开图片，走idx_upload_time索引定位起点，深翻页和第一页一样快
+    返回 (图片列表, 下一页游标)；查询失败时图片列表为None
+    """
+    limit = limit or app.config['FEED_PAGE_SIZE']
+    conditions = ["(i.is_active = TRUE OR i.is_active IS NULL)"]
+    params = []
+
+    position = decode_cursor(cursor)
+    if position:
+        conditions.append("(i.upload_time < %s OR (i.upload_time = %s AND i.id < %s))")
+        params.extend((position[0], position[0], position[1]))
+
+    query = f"""
+        SELECT i.id, i.filename, i.original_name, i.file_path, i.thumbnail_path,
+               i.title, i.description, i.user_id, i.upload_time, i.views, i.likes,
+               u.username
+        FROM images i
+        LEFT JOIN users u ON i.user_id = u.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY i.upload_time DESC, i.id DESC
+        LIMIT %s
+    """
+    params.append(limit + 1)  # 多取一条判断是否还有下一页
+    results = execute_query(query, tuple(params), fetch_all=True)
+    if results is None:
+        return None, None
+
+    images = []
+    for row in results[:limit]:
+        file_path = row['file_path']
+        if file_path.startswith('/'):
+            file_path = file_path[1:]
+
+        thumbnail_path = row.get('thumbnail_path')
+        if thumbnail_path and thumbnail_path.startswith('/'):
+            thumbnail_path = thumbnail_path[1:]
+
+        image = {
+            'id': row['id'],
+            'filename': row['filename'],
+            'original_filename': row['original_name'],
+            'title': row['title'] or row['original_name'],
+            'description': row['description'] or '',
+            'user_id': row['user_id'],
+            'upload_time': row['upload_time'],
+            'views': row.get('views', 0),
+            'likes': row.get('likes', 0),
+            'username': row['username'],
+            'file_path': file_path,
+            'thumbnail_path': thumbnail_path,
+            'author': {'username': row['username']}
+        }
+        images.append(image)
+
+    next_cursor = None
+    if len(results) > limit and images:
+        last = images[-1]
+        next_cursor = encode_cursor(last['upload_time'], last['id'])
+    return images, next_cursor
+
 @app.route('/')
 def index():
-    """首页 - 展示所有公开图片"""
+    """首页 - 展示所有公开图片（?cursor= 翻到后面的页，供无JS时使用）"""
+    cursor = request.args.get('cursor')
+    next_cursor = None
     try:
-        query = """
-            SELECT i.*, u.username 
-            FROM images i 
-            LEFT JOIN users u ON i.user_id = u.id 
-            WHERE i.is_active = TRUE OR i.is_active IS NULL
-            ORDER BY i.upload_time DESC
-            LIMIT 30
-        """
-        results = execute_query(query, fetch_all=True)
-
-        images = []
-        if results:
-            for row in results:
-                file_path = row['file_path']
-                if file_path.startswith('/'):
-                    file_path = file_path[1:]
-
-                image = {
-                    'id': row['id'],
-                    'filename': row['filename'],
-                    'original_filename': row['original_name'],
-                    'title': row['title'] or row['original_name'],
-                    'description': row['description'] or '',
-                    'user_id': row['user_id'],
-                    'upload_time': row['upload_time'],
-                    'views': row.get('views', 0),
-                    'likes': row.get('likes', 0),
-                    'username': row['username'],
-                    'file_path': file_path,
-                    'author': {'username': row['username']}
-                }
-                images.append(image)
+        images, next_cursor = fetch_feed_page(cursor)
+        if images is None:
+            images = []
     except Exception as e:
         logger.error(f"获取图片失败: {e}")
         images = []
 
-    return render_template('index.html', images=images)
+    attach_renditions(images)
+    if images and not cursor:
+        # 快照只保存所有人都一样的字段，每个请求的点赞状态加在各自的副本上
+        _feed_snapshot.update(images=[dict(image) for image in images], time=datetime.now())
+    attach_liked_state(images)
+    return render_template('index.html', images=images, next_cursor=next_cursor)
+
+@app.route('/api/feed')
+def api_feed():
+    """首页无限滚动接口：只返回卡片需要的字段"""
+    images, next_cursor = fetch_feed_page(request.args.get('cursor'))
+    if images is None:
+        return jsonify({'error': '获取图片失败，请稍后重试'}), 503
+
+    attach_liked_state(images)
+    attach_renditions(images)
+    items = []
+    for image in images:
+        thumb = image['thumbnail_path'].split('/')[-1] if image['thumbnail_path'] else None
+        items.append({
+            'id': image['id'],
+            'title': image['title'],
+            'description': image['description'],
+            'username': image['username'],
+            'upload_time': image['upload_time'].strftime('%Y-%m-%d') if image['upload_time'] else None,
+            'views': image['views'],
+            'likes': image['likes'],
+            'liked_by_me': image['liked_by_me'],
+            'image_url': upload_url(image['file_path']),
+            'thumbnail_url': f"/media/{thumb}" if thumb else None,
+            'srcset': rendition_srcset(image),
+            'can_delete': current_user.is_authenticated and (
+                current_user.id == image['user_id'] or current_user.is_admin),
+        })
+    return jsonify({'items': items, 'next_cursor': next_cursor})
 
 @app.route('/music-settings')
 @login_required
@@ -347,6 +1067,7 @@ def register():
             else:
                 user = User.create(username, password, email)
                 if user:
+                    suggest_index.add('user', user.username, user.id)
                     flash('注册成功！请登录', 'success')
                     return redirect(url_for('login'))
                 else:
@@ -362,6 +1083,110 @@ def logout():
     flash(f'再见，{username}！已成功退出', 'info')
     return redirect(url_for('index'))
 
+def save_image(blob, client_filename, title, description):
+    """
+    校验临时文件里的图片并保存：图片记录、内容引用和处理任务写入数据库，文件放进存储
+    表单上传和分块上传都走这里；返回 (image_id, reused)，保存失败时 image_id 为None
+    图片不合格时抛出ImageRejected
+    """
+    # 真实格式看文件开头的魔数，不看扩展名和Content-Type；
+    # 再只读文件头：解压后可能有几个GB的图片（比如大片纯色的PNG）在解码之前就拒绝
+    fmt = image_processing.sniff_format(blob.head)
+    if fmt is None:
+        raise image_processing.ImageRejected('文件内容不是PNG/JPG/GIF/WEBP图片')
+    info = image_processing.inspect_image(blob, max_pixels=app.config['IMAGE_MAX_PIXELS'],
+                                          max_frames=app.config['IMAGE_MAX_FRAMES'], formats=[fmt])
+    blob.close()
+
+    original_filename = secure_filename(client_filename)
+
+    # 按内容命名：相同内容的图片共用一份文件
+    content_hash, file_size = blob.sha256, blob.size
+    ext = image_processing.FORMAT_EXTENSIONS[fmt]
+    unique_filename = blob_store.blob_filename(content_hash, ext)
+    mime_type = info['mime_type']
+
+    title = title.strip()
+    if not title:
+        title = original_filename.rsplit('.', 1)[0]
+
+    description = description.strip()
+
+    insert_query = """
+        INSERT INTO images 
+        (filename, original_name, file_path, file_size, mime_type, 
+         title, description, user_id, upload_time, views, likes, is_active, processing_status, content_hash)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+
+    params = (
+        unique_filename,
+        original_filename,
+        f"uploads/{blob_store.shard_path(unique_filename)}",
+        file_size,
+        mime_type,
+        title,
+        description,
+        current_user.id,
+        datetime.now(),
+        0,
+        0,
+        True,
+        PROCESSING,
+        content_hash
+    )
+
+    # 文件先写入存储，再开事务：上传对象存储可能要几秒，不能一直占着连接池的连接和 image_blobs 的行锁
+    # 已经存在时也覆盖（内容相同）；任务在事务提交后才能被取走，这时文件已经在了
+    key = blob_store.shard_path(unique_filename)
+    try:
+        upload_storage.put_file(key, blob.path, content_type=mime_type, move=True)
+    except (storage.StorageError, OSError) as e:
+        logger.error(f"保存图片文件失败: {e}")
+        return None, False
+
+    # 图片记录、内容引用和缩略图任务在同一个事务里写入，不会出现没有任务的processing图片
+    # 同样的内容已经处理过时直接复用它的缩略图和多尺寸版本，不再提交任务
+    reused = False
+    try:
+        with db_transaction() as cursor:
+            existed = blob_store.acquire(cursor, content_hash, unique_filename, file_size)
+            # 新内容：上传之后、acquire 之前，同内容的最后一张图片可能刚被删除并删掉了文件
+            # （删除在持有行锁时删文件，acquire 会等它提交），这时回滚，不留下没有文件的记录
+            if not existed and not upload_storage.exists(key):
+                raise storage.ObjectNotFound(f"文件在写入数据库前被并发删除: {key}")
+            cursor.execute(insert_query, params)
+            image_id = cursor.lastrowid
+            reused = existed and copy_renditions(cursor, image_id, content_hash)
+            if not reused:
+                submit_renditions(cursor, image_id, unique_filename)
+    except (Error, storage.StorageError, OSError) as e:
+        logger.error(f"保存图片失败: {e}")
+        discard_unreferenced_upload(content_hash, unique_filename)
+        return None, False
+
+    if not reused:
+        job_queue.notify()
+    suggest_index.add('image', title, image_id)
+    search_cache.bump()
+    return image_id, reused
+
+def discard_unreferenced_upload(content_hash, filename):
+    """
+    保存失败、事务回滚后，没有图片引用这份内容时删掉刚写入存储的文件
+    数据库也不可用时只能留下这个文件：没有记录指向它，不影响正确性，同样内容再次上传时会覆盖复用
+    """
+    try:
+        with db_transaction() as cursor:
+            # 加锁读：没有引用时锁住这个sha256，检查和删除期间同内容的上传不能 acquire
+            if not blob_store.is_referenced(cursor, content_hash, lock=True):
+                remove_upload_files([filename])
+    except (Error, storage.StorageError, OSError) as e:
+        logger.warning(f"清理未引用的上传文件 {filename} 失败: {e}")
+
+def upload_success_message(reused):
+    return '图片上传成功！' if reused else '图片上传成功！缩略图正在后台生成'
+
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
@@ -378,71 +1203,154 @@ def upload():
             return redirect(request.url)
 
         if file and allowed_file(file.filename):
-            original_filename = secure_filename(file.filename)
-            ext = original_filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{uuid.uuid4().hex}.{ext}"
-
-            ensure_upload_folder()
-
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-
-            thumbnail_name = create_thumbnail(filepath)
-
-            file_size = os.path.getsize(filepath)
-            mime_type = file.content_type or f"image/{ext}"
-
-            title = request.form.get('title', '').strip()
-            if not title:
-                title = original_filename.rsplit('.', 1)[0]
-
-            description = request.form.get('description', '').strip()
-
-            insert_query = """
-                INSERT INTO images 
-                (filename, original_name, file_path, file_size, mime_type, 
-                 title, description, user_id, upload_time, views, likes, is_active)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-
-            params = (
-                unique_filename,
-                original_filename,
-                f"uploads/{unique_filename}",
-                file_size,
-                mime_type,
-                title,
-                description,
-                current_user.id,
-                datetime.now(),
-                0,
-                0,
-                True
-            )
-
-            result = execute_query(insert_query, params, commit=True)
-
-            if result:
-                if thumbnail_name:
-                    update_query = "UPDATE images SET thumbnail_path = %s WHERE id = %s"
-                    execute_query(update_query, (f"uploads/{thumbnail_name}", result), commit=True)
-
-                flash('图片上传成功！', 'success')
+            # 文件已经在解析表单时写进了临时文件（见 UploadRequest），同时算好了大小和SHA-256
+            try:
+                image_id, reused = save_image(file.stream, file.filename, request.form.get('title', ''),
+                                              request.form.get('description', ''))
+            except image_processing.ImageRejected as e:
+                logger.warning(f"拒绝上传的图片 {file.filename}: {e}")
+                flash(f'图片无法处理：{e}', 'danger')
+                return redirect(request.url)
+
+            if image_id:
+                flash(upload_success_message(reused), 'success')
                 return redirect(url_for('index'))
             else:
-                flash('图片保存失败，数据库错误', 'danger')
+                flash('图片保存失败，请稍后重试', 'danger')
         else:
             flash('不支持的文件格式！仅支持PNG/JPG/JPEG/GIF/WEBP', 'danger')
 
     return render_template('upload.html')
 
+# ---------- 分块断点续传 ----------
+# POST /api/uploads                      创建上传 {filename, size, title, description}
+# GET  /api/uploads/<id>                 查询已收到的分块，断线或刷新页面后只补传缺的
+# PUT  /api/uploads/<id>/chunks/<序号>    请求体是这一块的原始字节
+# POST /api/uploads/<id>/finalize        合并并保存，和表单上传写入同样的图片记录
+# DELETE /api/uploads/<id>               放弃上传
+chunk_store = ChunkStore(app.config['UPLOAD_CHUNK_DIR'], app.config['UPLOAD_CHUNK_SIZE'],
+                         app.config['UPLOAD_MAX_SIZE'], app.config['UPLOAD_SESSION_TTL'],
+                         max_sessions=app.config['UPLOAD_MAX_SESSIONS_PER_USER'],
+                         max_reserved=app.config['UPLOAD_MAX_RESERVED_PER_USER'])
+
+def upload_in_progress_response():
+    """另一个请求正在合并这个上传：409，客户端稍后查询或重试"""
+    response = jsonify({'error': '上传正在合并，请稍候', 'finalizing': True})
+    response.headers['Retry-After'] = '5'
+    return response, 409
+
+def upload_session_json(meta):
+    return {
+        'upload_id': meta['id'],
+        'size': meta['size'],
+        'chunk_size': meta['chunk_size'],
+        'chunks': chunk_store.chunk_count(meta),
+        'received': chunk_store.received(meta),
+    }
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def api_upload_create():
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename') or '')
+    size = data.get('size')
+    if not allowed_file(filename):
+        return jsonify({'error': '不支持的文件格式！仅支持PNG/JPG/JPEG/GIF/WEBP'}), 400
+    if not isinstance(size, int):
+        return jsonify({'error': 'size 必须是整数'}), 400
+    try:
+        meta = chunk_store.create(current_user.id, filename, size,
+                                  title=str(data.get('title') or ''), description=str(data.get('description') or ''))
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 429
+    except ChunkRejected as e:
+        return jsonify({'error': str(e)}), 413 if size > 0 else 400
+    return jsonify(upload_session_json(meta)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def api_upload_status(upload_id):
+    try:
+        meta = chunk_store.load(upload_id, current_user.id)
+        return jsonify(upload_session_json(meta))
+    except UploadNotFound:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    except UploadInProgress:
+        return upload_in_progress_response()
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def api_upload_chunk(upload_id, index):
+    try:
+        meta = chunk_store.load(upload_id, current_user.id)
+        chunk_store.write_chunk(meta, index, request.stream)
+    except UploadNotFound:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    except UploadInProgress:
+        return upload_in_progress_response()
+    except ChunkRejected as e:
+        return jsonify({'error': str(e)}), 400
+    return '', 204
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def api_upload_abort(upload_id):
+    try:
+        chunk_store.load(upload_id, current_user.id)
+    except UploadNotFound:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    except UploadInProgress:
+        return upload_in_progress_response()
+    chunk_store.discard(upload_id)
+    return '', 204
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def api_upload_finalize(upload_id):
+    """把分块按顺序拼接到上传临时文件（边拼边算SHA-256），然后和表单上传一样校验、保存"""
+    try:
+        meta = chunk_store.load(upload_id, current_user.id)
+        claimed = chunk_store.claim(meta)
+    except UploadNotFound:
+        return jsonify({'error': '上传不存在或已过期'}), 404
+    except UploadInProgress:
+        return upload_in_progress_response()
+    except ChunkRejected as e:
+        return jsonify({'error': str(e), 'received': chunk_store.received(meta)}), 409
+
+    try:
+        blob = new_upload_blob()
+        chunk_store.assemble(meta, claimed, blob)
+        blob.seek(0)
+        image_id, reused = save_image(blob, meta['filename'], meta['title'], meta['description'])
+    except image_processing.ImageRejected as e:
+        logger.warning(f"拒绝上传的图片 {meta['filename']}: {e}")
+        chunk_store.discard(upload_id)
+        return jsonify({'error': f'图片无法处理：{e}'}), 422
+    except Exception as e:
+        # 其他任何异常都要把分块放回去，否则重试的 finalize 在 CLAIM_TIMEOUT 内一直返回409
+        logger.error(f"合并分块或保存图片失败: {upload_id}: {e}")
+        image_id = None
+
+    if not image_id:
+        # 数据库或存储暂时不可用：分块放回去，客户端稍后重试 finalize 即可
+        chunk_store.unclaim(meta)
+        response = jsonify({'error': '图片保存失败，请稍后重试'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    chunk_store.discard(upload_id)
+    flash(upload_success_message(reused), 'success')
+    return jsonify({'image_id': image_id, 'url': url_for('image_detail', image_id=image_id)}), 201
+
 @app.route('/image/<int:image_id>')
 def image_detail(image_id):
     """图片详情页"""
     query = """
-        SELECT i.*, u.username 
+        SELECT i.*, u.username, uv.unique_views
         FROM images i 
         LEFT JOIN users u ON i.user_id = u.id 
+        LEFT JOIN image_unique_viewers uv ON uv.image_id = i.id
         WHERE i.id = %s
     """
     result = execute_query(query, (image_id,), fetch_one=True)
@@ -451,8 +1359,8 @@ def image_detail(image_id):
         flash('图片不存在！', 'danger')
         return redirect(url_for('index'))
 
-    update_query = "UPDATE images SET views = views + 1 WHERE id = %s"
-    execute_query(update_query, (image_id,), commit=True)
+    view_counter.add(image_id)
+    unique_viewers.add(image_id, viewer_key())
 
     file_path = result['file_path']
     if file_path.startswith('/'):
@@ -470,50 +1378,144 @@ def image_detail(image_id):
         'description': result['description'] or '',
         'user_id': result['user_id'],
         'upload_time': result.get('upload_time', datetime.now()),
-        'views': result.get('views', 0) + 1,
+        'views': (result.get('views') or 0) + view_counter.pending(image_id),
+        'unique_views': result.get('unique_views') or 0,
         'likes': result.get('likes', 0),
         'username': result['username'],
         'file_path': file_path,
         'thumbnail_path': thumbnail_path,
         'file_size': result.get('file_size', 0),
         'mime_type': result.get('mime_type', 'image/jpeg'),
+        'processing_status': result.get('processing_status') or READY,
         'author': {'username': result['username']}
     }
+    attach_renditions([image])
 
     return render_template('image_detail.html', image=image)
 
+@app.route('/api/image/<int:image_id>/status')
+def api_image_status(image_id):
+    """图片处理状态，上传后页面轮询用"""
+    query = "SELECT id, thumbnail_path, processing_status FROM images WHERE id = %s"
+    result = execute_query(query, (image_id,), fetch_one=True)
+    if not result:
+        return jsonify({'error': '图片不存在'}), 404
+
+    thumbnail_path = result['thumbnail_path']
+    return jsonify({
+        'id': result['id'],
+        'status': result['processing_status'] or READY,
+        'thumbnail_url': url_for('media_file', filename=thumbnail_path.split('/')[-1]) if thumbnail_path else None
+    })
+
+# 每个用户已知的点赞状态 {image_id: bool}；只缓存看过的图片，超过上限就重新开始
+liked_cache = TTLCache(
+    maxsize=app.config['LIKED_CACHE_SIZE'],
+    ttl=app.config['LIKED_CACHE_TTL']
+)
+LIKED_STATES_PER_USER = 2000
+
+def get_liked_states(user_id, image_ids):
+    """批量查询用户对一组图片的点赞状态，缓存没有的部分用一条IN查询补齐"""
+    known = liked_cache.get(user_id) or {}
+    missing = [image_id for image_id in set(image_ids) if image_id not in known]
+    if missing:
+        placeholders = ', '.join(['%s'] * len(missing))
+        query = f"SELECT image_id FROM likes WHERE user_id = %s AND image_id IN ({placeholders})"
+        rows = execute_query(query, (user_id, *missing), fetch_all=True)
+        if rows is not None:
+            liked = {row['image_id'] for row in rows}
+            # 复制后再写回，其他线程读到的旧字典不受影响
+            known = dict(known) if len(known) < LIKED_STATES_PER_USER else {}
+            for image_id in missing:
+                known[image_id] = image_id in liked
+            liked_cache.set(user_id, known)
+    return {image_id: known.get(image_id, False) for image_id in image_ids}
+
+def remember_liked_state(user_id, image_id, liked):
+    """点赞/取消后同步更新缓存"""
+    known = liked_cache.get(user_id)
+    if known is not None:
+        known = dict(known)
+        known[image_id] = liked
+        liked_cache.set(user_id, known)
+
+def attach_liked_state(images):
+    """给图片列表中的每一项加上 liked_by_me 字段"""
+    if not images:
+        return
+    states = {}
+    if current_user.is_authenticated:
+        states = get_liked_states(current_user.id, [image['id'] for image in images])
+    for image in images:
+        image['liked_by_me'] = states.get(image['id'], False)
+
+def toggle_like(user_id, image_id):
+    """
+    在一个事务里切换点赞状态，计数增减由实际受影响的行数决定，并发重复点击也不会把计数算错
+    返回 (是否已点赞, 最新点赞数)；图片不存在返回None
+    """
+    with db_transaction() as cursor:
+        # 先对图片行加排他锁：同一张图片的并发切换排队执行。
+        # 不能用 INSERT ... SELECT FROM images：它在图片行上加的是共享锁，两个请求都拿到共享锁后
+        # 都要升级成排他锁去 UPDATE likes 计数，互相等待，InnoDB 只能回滚其中一个
+        cursor.execute("SELECT id FROM images WHERE id = %s FOR UPDATE", (image_id,))
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute("INSERT IGNORE INTO likes (user_id, image_id) VALUES (%s, %s)", (user_id, image_id))
+        if cursor.rowcount == 1:
+            liked = True
+            cursor.execute("UPDATE images SET likes = likes + 1 WHERE id = %s", (image_id,))
+        else:
+            cursor.execute("DELETE FROM likes WHERE user_id = %s AND image_id = %s", (user_id, image_id))
+            liked = False
+            cursor.execute("UPDATE images SET likes = GREATEST(0, likes - 1) WHERE id = %s", (image_id,))
+
+        cursor.execute("SELECT likes FROM images WHERE id = %s", (image_id,))
+        row = cursor.fetchone()
+    remember_liked_state(user_id, image_id, liked)
+    return liked, (row['likes'] if row else 0)
+
 @app.route('/like/<int:image_id>')
 @login_required
 def like_image(image_id):
-    """图片点赞"""
-    check_query = "SELECT * FROM images WHERE id = %s"
-    image = execute_query(check_query, (image_id,), fetch_one=True)
+    """图片点赞（无JS时的回退方式，处理完跳回原页面）"""
+    try:
+        result = toggle_like(current_user.id, image_id)
+    except Error as e:
+        logger.error(f"点赞失败: {e}")
+        flash('操作失败，请稍后重试', 'danger')
+        return redirect(request.referrer or url_for('index'))
 
-    if not image:
+    if result is None:
         flash('图片不存在！', 'danger')
         return redirect(url_for('index'))
 
-    check_like_query = """
-        SELECT id FROM likes WHERE user_id = %s AND image_id = %s
-    """
-    existing_like = execute_query(check_like_query, (current_user.id, image_id), fetch_one=True)
+    liked, _ = result
+    if liked:
+        flash('点赞成功！', 'success')
+    else:
+        flash('已取消点赞！', 'info')
 
-    if existing_like:
-        delete_like_query = "DELETE FROM likes WHERE user_id = %s AND image_id = %s"
-        execute_query(delete_like_query, (current_user.id, image_id), commit=True)
+    return redirect(request.referrer or url_for('index'))
 
-        update_query = "UPDATE images SET likes = GREATEST(0, likes - 1) WHERE id = %s"
-        execute_query(update_query, (image_id,), commit=True)
-        flash('已取消点赞！', 'info')
-    else:
-        like_query = "INSERT INTO likes (user_id, image_id) VALUES (%s, %s)"
-        execute_query(like_query, (current_user.id, image_id), commit=True)
+@app.route('/api/like/<int:image_id>', methods=['POST'])
+def api_like_image(image_id):
+    """图片点赞（XHR接口），返回最新状态，页面无需刷新"""
+    if not current_user.is_authenticated:
+        return jsonify({'error': '请先登录', 'login_url': url_for('login')}), 401
 
-        update_query = "UPDATE images SET likes = likes + 1 WHERE id = %s"
-        execute_query(update_query, (image_id,), commit=True)
-        flash('点赞成功！', 'success')
+    try:
+        result = toggle_like(current_user.id, image_id)
+    except Error as e:
+        logger.error(f"点赞失败: {e}")
+        return jsonify({'error': '操作失败，请稍后重试'}), 503
 
-    return redirect(request.referrer or url_for('index'))
+    if result is None:
+        return jsonify({'error': '图片不存在'}), 404
+
+    liked, likes = result
+    return jsonify({'image_id': image_id, 'liked': liked, 'likes': likes})
 
 @app.route('/delete/<int:image_id>', methods=['POST'])
 @login_required
@@ -532,22 +1534,45 @@ def delete_image(image_id):
         return redirect(url_for('image_detail', image_id=image_id))
 
     try:
-        filename = result['filename']
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-
-        if result.get('thumbnail_path'):
-            thumb_filename = result['thumbnail_path'].split('/')[-1]
-            thumb_path = os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename)
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-
-        delete_query = "DELETE FROM images WHERE id = %s"
-        execute_query(delete_query, (image_id,), commit=True)
-
-        delete_likes_query = "DELETE FROM likes WHERE image_id = %s"
-        execute_query(delete_likes_query, (image_id,), commit=True)
+        released = False
+        with db_transaction() as cursor:
+            # 在事务里加锁重新读取：同一张图片的并发删除（重复提交、作者和管理员同时删）只有一个能读到这一行，
+            # 另一个等它提交后读不到，不会重复减少引用计数、删掉别的图片还在用的文件；
+            # 缩略图路径也以这时为准（上面读取之后缩略图可能刚生成）
+            cursor.execute("SELECT filename, thumbnail_path, content_hash FROM images WHERE id = %s FOR UPDATE",
+                           (image_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute("DELETE FROM images WHERE id = %s", (image_id,))
+                cursor.execute("DELETE FROM likes WHERE image_id = %s", (image_id,))
+                cursor.execute("DELETE FROM image_unique_viewers WHERE image_id = %s", (image_id,))
+                cursor.execute("DELETE FROM image_jobs WHERE image_id = %s AND status = 'pending'", (image_id,))
+                cursor.execute("SELECT filename FROM image_renditions WHERE image_id = %s", (image_id,))
+                filenames = [r['filename'] for r in cursor.fetchall()]
+                cursor.execute("DELETE FROM image_renditions WHERE image_id = %s", (image_id,))
+
+                # 同样内容的图片共用文件，最后一个引用删除时才删文件；
+                # 在提交前删，期间持有的行锁让同内容的并发上传等删除结束后再写入文件
+                content_hash = row.get('content_hash')
+                if not content_hash or blob_store.release(cursor, content_hash):
+                    released = True
+                    filenames.append(row['filename'])
+                    if row.get('thumbnail_path'):
+                        filenames.append(row['thumbnail_path'].split('/')[-1])
+                    remove_upload_files(filenames)
+        if row is None:
+            flash('图片不存在！', 'danger')
+            return redirect(url_for('index'))
+        rendition_cache.delete(image_id)
+
+        # 变体缓存按原图文件名存放，还有其他图片引用同一文件时留给它们用；
+        # 删除的图片ID在 image_source 里已经查不到，不会再返回这些变体
+        image_source_cache.delete(image_id)
+        if released:
+            transform_cache.delete_dir(row['filename'])
+
+        suggest_index.remove('image', result['title'] or result['original_name'], image_id)
+        search_cache.bump()
 
         flash('图片删除成功！', 'success')
     except Exception as e:
@@ -592,22 +1617,451 @@ def my_images():
             }
             images.append(image)
 
+    attach_liked_state(images)
+    attach_renditions(images)
     return render_template('my_images.html', images=images)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """提供上传图片的访问"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_upload(filename)
+
+@app.route('/static/uploads/<filename>')
+def legacy_upload(filename):
+    """
+    迁移前的平铺路径（数据库和缓存里可能还有）：文件已经移到分片目录时也能找到
+    分片后的路径（/static/uploads/ab/cd/...）仍由静态文件处理，生产环境可以直接交给nginx
+    """
+    return send_upload(filename)
+
+# ---------- 按需变换 ----------
+TRANSFORM_FITS = ('contain', 'cover')
+# URL按图片ID寻址，图片删除后不能再被CDN/浏览器长期留着：缓存一小时，之后用ETag重新验证
+TRANSFORM_MAX_AGE = 3600
+
+transform_runner = ProcessRunner(app.config['TRANSFORM_WORKERS'], image_processing.init_worker, worker_initargs)
+atexit.register(transform_runner.shutdown)
+
+transform_cache = DiskCache(app.config['TRANSFORM_CACHE_DIR'], app.config['TRANSFORM_CACHE_MAX_BYTES'])
+
+# 图片ID -> {'id', 'filename', 'renditions'}；/img/ 每个请求（包括磁盘缓存命中）都要先确认图片还在，
+# 这里缓存查询结果。图片删除时只清本进程的，其他进程/节点最多 ttl 秒后不再返回已删除图片的变体
+image_source_cache = TTLCache(maxsize=app.config['RENDITION_CACHE_SIZE'], ttl=300)
+
+def parse_transform_args(args):
+    """校验变换参数，返回 (width, height, fit, fmt)，不合法时抛出ValueError"""
+    sizes = app.config['TRANSFORM_SIZES']
+    dimensions = []
+    for name in ('w', 'h'):
+        raw = args.get(name)
+        if raw is None:
+            dimensions.append(None)
+            continue
+        if not raw.isdigit() or int(raw) not in sizes:
+            raise ValueError(f"{name} 只能是 {', '.join(map(str, sizes))} 之一")
+        dimensions.append(int(raw))
+    width, height = dimensions
+    if width is None and height is None:
+        raise ValueError('至少需要指定 w 或 h')
+
+    fit = args.get('fit', 'contain')
+    if fit not in TRANSFORM_FITS:
+        raise ValueError(f"fit 只能是 {', '.join(TRANSFORM_FITS)} 之一")
+
+    fmt = args.get('fmt', 'auto')
+    if fmt != 'auto' and fmt not in image_processing.TRANSFORM_FORMATS:
+        raise ValueError(f"fmt 只能是 auto, {', '.join(image_processing.TRANSFORM_FORMATS)} 之一")
+    return width, height, fit, fmt
+
+def negotiate_transform_format():
+    """fmt=auto 时按Accept头选择，都不支持时用JPEG"""
+    for ext, mimetype in MEDIA_FORMATS:
+        if ext in image_processing.TRANSFORM_FORMATS and client_accepts(mimetype):
+            return ext
+    return 'jpeg'
+
+def image_source(image_id, refresh=False):
+    """
+    图片的原图文件名和多尺寸版本，图片不存在返回None
+    数据库不可用时抛出 mysql.connector.Error（不当成图片不存在，避免返回404被CDN缓存）
+    refresh=True 时不用缓存，直接查数据库
+    """
+    source = None if refresh else image_source_cache.get(image_id)
+    if source is None:
+        with db_transaction() as cursor:
+            cursor.execute("SELECT id, filename FROM images WHERE id = %s", (image_id,))
+            row = cursor.fetchone()
+        if not row:
+            image_source_cache.delete(image_id)
+            return None
+        source = {'id': row['id'], 'filename': row['filename']}
+        attach_renditions([source])
+        image_source_cache.set(image_id, source)
+    return source
+
+def transform_source(source, width, height, fit):
+    """
+    变换用的源文件在存储里的key
+    已有的多尺寸版本足够大时用它代替原图，解码一张1280宽的图比解码原图快得多
+    """
+    for r in source['renditions']:
+        if width and height:
+            # cover 要两边都够大；contain 只要有一边达到框的大小
+            large_enough = (r['width'] >= width and r['height'] >= height) if fit == 'cover' \
+                else (r['width'] >= width or r['height'] >= height)
+        else:
+            large_enough = r['width'] >= width if width else r['height'] >= height
+        if large_enough:
+            return upload_key(r['filename'])
+    return upload_key(source['filename'])
+
+@app.route('/img/<int:image_id>')
+def transformed_image(image_id):
+    """
+    按需生成的图片变体：/img/12?w=640&h=480&fit=cover&fmt=webp
+    第一次请求时在进程池里生成并写入磁盘缓存，之后直接从磁盘返回；同一变体的并发请求只生成一次
+    磁盘缓存按原图文件名（内容哈希）存放，不按图片ID：每个请求都先由 image_source 确认图片还在，
+    已删除的图片找不到原图文件名，也就取不到缓存里的变体，不管缓存在哪个节点上
+    """
+    try:
+        width, height, fit, fmt = parse_transform_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    negotiated = fmt == 'auto'
+    if negotiated:
+        fmt = negotiate_transform_format()
+
+    def produce(dest_path):
+        source_key = transform_source(source, width, height, fit)
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            future = transform_runner.submit(media_tasks.transform_image, upload_storage, source_key, tmp_path,
+                                             width=width, height=height, fit=fit, fmt=fmt)
+            future.result(timeout=app.config['TRANSFORM_TIMEOUT'])
+            # 生成期间图片可能已被删除：重新查一次再放进缓存
+            if image_source(image_id, refresh=True) is None:
+                raise LookupError(image_id)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    try:
+        source = image_source(image_id)
+        if source is None:
+            raise LookupError(image_id)
+        key = os.path.join(source['filename'], f"{width or 0}x{height or 0}_{fit}.{fmt}")
+        path = transform_cache.get_or_create(key, produce)
+    except (LookupError, FileNotFoundError):
+        return jsonify({'error': '图片不存在'}), 404
+    except Error as e:
+        logger.error(f"查询变换源图失败: image={image_id}: {e}")
+        response = jsonify({'error': '数据库暂时不可用，请稍后重试'})
+        response.headers['Retry-After'] = str(db_breaker.retry_after() or 5)
+        return response, 503
+    except image_processing.ImageRejected as e:
+        # 预算收紧之前上传的超大图片
+        logger.warning(f"图片超出解码预算，不做变换: image={image_id}: {e}")
+        return jsonify({'error': str(e)}), 422
+    except (FutureTimeoutError, BrokenProcessPool) as e:
+        if isinstance(e, BrokenProcessPool):
+            transform_runner.reset()
+        logger.error(f"图片变换超时或处理进程异常: image={image_id}, {width}x{height} {fit} {fmt}")
+        response = jsonify({'error': '图片处理繁忙，请稍后重试'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except Exception as e:
+        logger.error(f"图片变换失败: image={image_id}, {width}x{height} {fit} {fmt}: {e}")
+        return jsonify({'error': '图片处理失败'}), 500
+
+    response = send_from_directory(app.config['TRANSFORM_CACHE_DIR'], os.path.relpath(path, app.config['TRANSFORM_CACHE_DIR']),
+                                   mimetype=image_processing.TRANSFORM_FORMATS[fmt][2], max_age=TRANSFORM_MAX_AGE)
+    response.cache_control.public = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+@app.route('/media/<filename>')
+def media_file(filename):
+    """
+    缩略图和多尺寸图片：在客户端接受的AVIF/WebP版本和原格式中按文件大小选最小的一种
+    小图或者本来就压缩得很好的图，AVIF/WebP 可能比原格式还大；大小相同时按 MEDIA_FORMATS 的顺序优先
+    """
+    variants = available_variants(filename)
+    max_age = app.config['MEDIA_CACHE_MAX_AGE']
+    candidates = [(variants[ext], rank, ext, mimetype) for rank, (ext, mimetype) in enumerate(MEDIA_FORMATS)
+                  if ext in variants and client_accepts(mimetype)]
+    if None in variants:
+        candidates.append((variants[None], len(MEDIA_FORMATS), None, None))
+    best = min(candidates) if candidates else None
+    if best and best[2] is not None:
+        response = send_upload(image_processing.variant_name(filename, best[2]), mimetype=best[3], max_age=max_age)
+    else:
+        response = send_upload(filename, max_age=max_age)
+    # 同一个URL按Accept返回不同内容，CDN和浏览器缓存需要按Accept区分
+    response.vary.add('Accept')
+    return response
+
+CONTENT_MAX_AGE = 365 * 24 * 3600
+CONTENT_ENDPOINTS = {'static', 'uploaded_file', 'legacy_upload', 'media_file'}
+
+@app.after_request
+def cache_content_addressed(response):
+    """按内容（SHA-256）命名的上传文件，URL对应的内容永远不变，允许浏览器和CDN永久缓存"""
+    if request.endpoint in CONTENT_ENDPOINTS and response.status_code in (200, 206, 304):
+        filename = os.path.basename((request.view_args or {}).get('filename', ''))
+        if blob_store.content_hash_of(filename):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = CONTENT_MAX_AGE
+            response.cache_control.immutable = True
+    return response
 
 
 # ====================== 12. 搜索功能（终极修复版） ======================
+SEARCH_PER_PAGE = 12
+SEARCH_PAGE_WINDOW = 2  # 当前页前后各显示几个页码
+SEARCH_MAX_OFFSET_PAGE = 5  # 不带游标、只带page参数的旧式链接最多按OFFSET翻到第几页
+
+search_engine = FulltextSearch(execute_query)
+
+# 搜索缓存：总数和结果页都按规范化后的关键词缓存，并发未命中只查一次数据库；
+# 本进程内图片增删时 bump() 整体失效，其他进程靠TTL过期
+search_cache = GenerationalCache(
+    maxsize=app.config['SEARCH_CACHE_SIZE'],
+    ttl=app.config['SEARCH_CACHE_TTL']
+)
+
+def normalize_search_query(text):
+    """统一空白和大小写，作为缓存键"""
+    return ' '.join(text.split()).lower()
+
+MIME_TYPE_PATTERN = re.compile(r'^image/[a-z0-9.+-]+$')
+
+def parse_search_filters(args):
+    """
+    从请求参数解析筛选条件，不合法的值直接忽略
+    user: 作者用户名；type: 文件类型；from/to: 日期（YYYY-MM-DD，含当天）；min_likes: 最少点赞数
+    返回 (filters, query_args)：filters 给搜索引擎用，query_args 是规范化后的URL参数，用于生成链接和缓存键
+    """
+    filters = {}
+    query_args = {}
+
+    username = args.get('user', '').strip()
+    if username:
+        filters['user'] = query_args['user'] = username
+
+    mime_type = args.get('type', '').strip().lower()
+    if MIME_TYPE_PATTERN.match(mime_type):
+        filters['mime_type'] = query_args['type'] = mime_type
+
+    for name in ('from', 'to'):
+        try:
+            day = datetime.strptime(args.get(name, ''), '%Y-%m-%d')
+        except ValueError:
+            continue
+        query_args[name] = day.strftime('%Y-%m-%d')
+        if name == 'from':
+            filters['date_from'] = day
+        else:
+            filters['date_to'] = day + timedelta(days=1)
+
+    min_likes = args.get('min_likes', 0, type=int)
+    if min_likes and min_likes > 0:
+        filters['min_likes'] = query_args['min_likes'] = min_likes
+
+    return filters, query_args
+
+def load_search_facets(cache_key, search_sql, params):
+    """
+    结果总数和各分面计数，一条分组查询算出，按 关键词+筛选条件 缓存
+    返回 {'total': 总数, 'type': [...], 'user': [...], 'month': [...], 'likes': [...]}，查询失败返回None
+    """
+    def load():
+        rows = execute_query(search_engine.facets(search_sql), params, fetch_all=True)
+        if rows is None:
+            return None
+        facets = {'total': 0, 'type': [], 'user': [], 'month': [], 'likes': []}
+        for row in rows:
+            if row['facet'] == 'type':
+                facets['total'] += row['hits']
+            if row['value'] is not None:
+                facets[row['facet']].append((row['value'], row['hits']))
+
+        # 点赞档位是互斥分组，转成"至少N个赞"的累计数
+        buckets = dict((int(value), hits) for value, hits in facets['likes'])
+        facets['likes'] = []
+        running = 0
+        for threshold in LIKES_BUCKETS:
+            running += buckets.get(threshold, 0)
+            if running:
+                facets['likes'].append((threshold, running))
+        facets['type'].sort(key=lambda item: item[1], reverse=True)
+        return facets
+
+    return search_cache.get_or_load(('facets', cache_key), load, ttl=app.config['SEARCH_COUNT_CACHE_TTL'])
+
+def build_facet_links(query_args, facets):
+    """每个分面值生成一个链接：未选中时加上该筛选，已选中时去掉"""
+    def link(name, value, label, hits):
+        args = {key: val for key, val in query_args.items() if key not in ('page', 'after', 'before', 'skip')}
+        active = str(args.get(name)) == str(value)
+        if active:
+            del args[name]
+        else:
+            args[name] = value
+        return {'label': label, 'hits': hits, 'active': active, 'url': url_for('search', **args)}
+
+    def month_link(month, hits):
+        args = {key: val for key, val in query_args.items() if key not in ('from', 'to')}
+        first = datetime.strptime(month, '%Y-%m')
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        active = query_args.get('from') == first.strftime('%Y-%m-%d') and query_args.get('to') == last.strftime('%Y-%m-%d')
+        if not active:
+            args['from'] = first.strftime('%Y-%m-%d')
+            args['to'] = last.strftime('%Y-%m-%d')
+        return {'label': month, 'hits': hits, 'active': active, 'url': url_for('search', **args)}
+
+    return [
+        {'title': '文件类型', 'options': [link('type', value, value.split('/')[-1].upper(), hits)
+                                      for value, hits in facets['type']]},
+        {'title': '作者', 'options': [link('user', value, value, hits) for value, hits in facets['user']]},
+        {'title': '上传时间', 'options': [month_link(value, hits) for value, hits in facets['month']]},
+        {'title': '点赞数', 'options': [link('min_likes', value, f"{value}+", hits) for value, hits in facets['likes']]},
+    ]
+
+def fetch_search_page(search_sql, params, per_page, sort='score', after=None, before=None, skip=0, offset=0):
+    """
+    按 (sort, id) 倒序做游标分页，search_sql 是搜索引擎生成的子查询，sort 是 search_engine.sort_column() 的结果
+    after: 取该位置之后的结果（下一页方向）；before: 取该位置之前的结果（上一页方向）
+    skip: 从游标位置再跳过几页（只用于窗口内的页码，最多SEARCH_PAGE_WINDOW页）
+    offset: 没有游标时的旧式偏移量（兼容只带page参数的链接）
+    """
+    conditions = []
+    query_params = list(params)
+    order = 'DESC'
+    if after:
+        conditions.append(f"(r.{sort} < %s OR (r.{sort} = %s AND r.id < %s))")
+        query_params.extend((after[0], after[0], after[1]))
+    elif before:
+        conditions.append(f"(r.{sort} > %s OR (r.{sort} = %s AND r.id > %s))")
+        query_params.extend((before[0], before[0], before[1]))
+        order = 'ASC'
+
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    page_query = f"""
+        SELECT r.* FROM ({search_sql}) r
+        {where_sql}
+        ORDER BY r.{sort} {order}, r.id {order}
+        LIMIT %s, %s
+    """
+    query_params.extend((skip * per_page if (after or before) else offset, per_page))
+    results = execute_query(page_query, tuple(query_params), fetch_all=True)
+    if results is not None and before:
+        results.reverse()
+    return results
+
+def build_search_pagination(query_args, page, pages, first_key, last_key):
+    """
+    生成窗口化的页码链接：相邻页用游标，窗口内更远的页用游标+少量skip
+    query_args: 关键词和筛选条件，翻页时原样带上
+    """
+    def page_url(target):
+        if target == 1:
+            return url_for('search', **query_args)
+        if target > page and last_key:
+            return url_for('search', **query_args, page=target,
+                           after=encode_cursor(*last_key), skip=target - page - 1)
+        if target < page and first_key:
+            return url_for('search', **query_args, page=target,
+                           before=encode_cursor(*first_key), skip=page - target - 1)
+        return None
+
+    links = []
+    for number in range(max(1, page - SEARCH_PAGE_WINDOW), min(pages, page + SEARCH_PAGE_WINDOW) + 1):
+        url = None if number == page else page_url(number)
+        if number == page or url:
+            links.append({'number': number, 'url': url, 'active': number == page})
+
+    return {
+        'links': links,
+        'show_first': bool(links) and links[0]['number'] > 1,
+        'first_url': page_url(1),
+        'prev_url': page_url(page - 1) if page > 1 else None,
+        'next_url': page_url(page + 1) if page < pages else None,
+    }
+
+# ---------- 搜索联想 ----------
+def image_popularity(likes, views):
+    """联想排序用的热度：一个赞约等于五次浏览"""
+    return (likes or 0) * 5 + (views or 0)
+
+def load_suggest_terms():
+    """全量加载联想词条：图片标题、用户名、标签名"""
+    images = execute_query("""
+        SELECT id, title, original_name, likes, views
+        FROM images
+        WHERE is_active = TRUE OR is_active IS NULL
+        ORDER BY likes DESC, views DESC
+        LIMIT %s
+    """, (app.config['SUGGEST_MAX_IMAGES'],), fetch_all=True)
+    if images is None:
+        return None
+
+    rows = [('image', row['title'] or row['original_name'], row['id'],
+             image_popularity(row['likes'], row['views'])) for row in images]
+
+    users = execute_query("""
+        SELECT u.id, u.username, SUM(i.likes) AS likes, SUM(i.views) AS views
+        FROM users u
+        LEFT JOIN images i ON i.user_id = u.id
+        GROUP BY u.id, u.username
+    """, fetch_all=True)
+    for row in users or []:
+        rows.append(('user', row['username'], row['id'], image_popularity(row['likes'], row['views'])))
+
+    # 标签表是可选的，不存在时跳过
+    tags = execute_query("""
+        SELECT t.id, t.name, COUNT(it.image_id) AS uses
+        FROM tags t
+        LEFT JOIN image_tags it ON it.tag_id = t.id
+        GROUP BY t.id, t.name
+    """, fetch_all=True)
+    for row in tags or []:
+        rows.append(('tag', row['name'], row['id'], row['uses']))
+
+    return rows
+
+suggest_index = SuggestIndex(load_suggest_terms, refresh_interval=app.config['SUGGEST_REFRESH_INTERVAL'])
+
+@app.route('/api/suggest')
+def api_suggest():
+    """搜索框联想，完全由内存索引回答"""
+    query_text = request.args.get('q', '').strip()
+    limit = min(max(1, request.args.get('limit', 8, type=int)), 20)
+    response = jsonify({'q': query_text, 'suggestions': suggest_index.suggest(query_text, limit)})
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
+
 @app.route('/search')
 def search():
-    """搜索功能 - 多字段搜索（标题、描述、用户名）和分页"""
+    """搜索功能 - 全文搜索（标题、描述）+ 用户名前缀匹配，按相关度排序（只有筛选条件时按上传时间），游标分页，支持分面筛选"""
+    query_text = request.args.get('q', '').strip()
+    filters, query_args = parse_search_filters(request.args)
+    if query_text:
+        query_args['q'] = query_text
     try:
-        query_text = request.args.get('q', '').strip()
-        page = request.args.get('page', 1, type=int)
-        per_page = 12
+        page = max(1, request.args.get('page', 1, type=int))
+        skip = min(max(0, request.args.get('skip', 0, type=int)), SEARCH_PAGE_WINDOW)
+        after = decode_cursor(request.args.get('after'))
+        before = decode_cursor(request.args.get('before'))
+        per_page = SEARCH_PER_PAGE
+
+        # 页面上的链接都带游标；只带page的旧链接或手写的 ?page=N 会走OFFSET，深页要扫描并丢弃前面所有结果，
+        # 超过上限的重定向到第一页，再按游标往后翻
+        if not after and not before and page > SEARCH_MAX_OFFSET_PAGE:
+            return redirect(url_for('search', **query_args))
 
         logger.info(f"搜索请求: query='{query_text}', page={page}")
 
@@ -617,86 +2071,87 @@ def search():
             'current_page': page,
             'total_pages': 1,
             'total_count': 0,
-            'per_page': per_page
+            'per_page': per_page,
+            'pagination': None,
+            'facets': [],
+            'filtered': bool(filters),
+            'clear_filters_url': url_for('search', q=query_text) if query_text else url_for('search')
         }
 
-        # 如果搜索关键词为空
-        if not query_text:
+        # 既没有关键词也没有筛选条件
+        if not query_text and not filters:
             logger.info("空搜索请求")
-            return render_template('search.html',
+            return render_template('search_simple.html',
                                    search_query=query_text,
                                    result_data=search_result_data)
 
         # 执行搜索
-        search_param = f"%{query_text}%"
-        offset = (page - 1) * per_page
-
-        # 搜索查询SQL
-        search_query = """
-            SELECT i.*, u.username 
-            FROM images i 
-            LEFT JOIN users u ON i.user_id = u.id 
-            WHERE (i.title LIKE %s OR i.description LIKE %s OR u.username LIKE %s)
-            ORDER BY i.upload_time DESC
-            LIMIT %s, %s
-        """
+        search_sql, search_params = search_engine.build(query_text, filters)
+        sort = search_engine.sort_column(query_text)
+
+        cache_key = (normalize_search_query(query_text), tuple(sorted(query_args.items())))
+        facets = None
+        if search_sql is not None:
+            facets = load_search_facets(cache_key, search_sql, search_params)
+        total = facets['total'] if facets else 0
+        pages = math.ceil(total / per_page) if total > 0 else 1
 
-        params = (search_param, search_param, search_param, offset, per_page)
-        results = execute_query(search_query, params, fetch_all=True)
+        results = []
+        if total:
+            page_key = ('page', cache_key, page, request.args.get('after'), request.args.get('before'), skip)
+            results = search_cache.get_or_load(page_key, lambda: fetch_search_page(
+                search_sql, search_params, per_page, sort=sort,
+                after=after, before=before, skip=skip,
+                offset=(page - 1) * per_page))
 
         # 处理搜索结果
         images_list = []
-        if results:
-            for row in results:
-                # 处理文件路径
-                file_path = row['file_path']
-                if file_path.startswith('/'):
-                    file_path = file_path[1:]
-
-                thumbnail_path = row.get('thumbnail_path')
-                if thumbnail_path and thumbnail_path.startswith('/'):
-                    thumbnail_path = thumbnail_path[1:]
-
-                # 构建图片对象
-                image_obj = {
-                    'id': row['id'],
-                    'filename': row['filename'],
-                    'original_filename': row['original_name'],
-                    'title': row['title'] or row['original_name'],
-                    'description': row['description'] or '',
-                    'upload_time': row.get('upload_time', datetime.now()),
-                    'views': row.get('views', 0),
-                    'likes': row.get('likes', 0),
-                    'username': row['username'],
-                    'file_path': file_path,
-                    'thumbnail_path': thumbnail_path,
-                    'author': {'username': row['username']}
-                }
-                images_list.append(image_obj)
-
-        # 获取总数
-        count_query = """
-            SELECT COUNT(*) as total_count 
-            FROM images i 
-            LEFT JOIN users u ON i.user_id = u.id 
-            WHERE (i.title LIKE %s OR i.description LIKE %s OR u.username LIKE %s)
-        """
-        count_result = execute_query(count_query, (search_param, search_param, search_param), fetch_one=True)
+        for row in results or []:
+            # 处理文件路径
+            file_path = row['file_path']
+            if file_path.startswith('/'):
+                file_path = file_path[1:]
+
+            thumbnail_path = row.get('thumbnail_path')
+            if thumbnail_path and thumbnail_path.startswith('/'):
+                thumbnail_path = thumbnail_path[1:]
+
+            # 构建图片对象
+            image_obj = {
+                'id': row['id'],
+                'filename': row['filename'],
+                'original_filename': row['original_name'],
+                'title': row['title'] or row['original_name'],
+                'description': row['description'] or '',
+                'upload_time': row.get('upload_time', datetime.now()),
+                'views': row.get('views', 0),
+                'likes': row.get('likes', 0),
+                'username': row['username'],
+                'file_path': file_path,
+                'thumbnail_path': thumbnail_path,
+                'author': {'username': row['username']}
+            }
+            images_list.append(image_obj)
 
-        total = count_result['total_count'] if count_result else 0
+        attach_liked_state(images_list)
+        attach_renditions(images_list)
 
-        # 计算总页数
-        pages = math.ceil(total / per_page) if total > 0 else 1
+        first_key = last_key = None
+        if results:
+            first_key = (results[0][sort], results[0]['id'])
+            last_key = (results[-1][sort], results[-1]['id'])
 
         # 更新搜索数据
         search_result_data.update({
             'items_list': images_list,
             'current_page': page,
             'total_pages': pages,
-            'total_count': total
+            'total_count': total,
+            'pagination': build_search_pagination(query_args, page, pages, first_key, last_key),
+            'facets': build_facet_links(query_args, facets) if facets else []
         })
 
-        logger.info(f"搜索成功: 关键词='{query_text}', 结果数={total}, 当前页={page}, 总页数={pages}")
+        logger.info(f"搜索成功: 关键词='{query_text}', 筛选={query_args}, 结果数={total}, 当前页={page}, 总页数={pages}")
         return render_template('search_simple.html',
                                search_query=query_text,
                                result_data=search_result_data)
@@ -711,9 +2166,13 @@ def search():
             'current_page': 1,
             'total_pages': 1,
             'total_count': 0,
-            'per_page': 12
+            'per_page': SEARCH_PER_PAGE,
+            'pagination': None,
+            'facets': [],
+            'filtered': bool(filters),
+            'clear_filters_url': url_for('search')
         }
-        return render_template('search.html',
+        return render_template('search_simple.html',
                                search_query=query_text,
                                result_data=error_data)
 
@@ -734,6 +2193,8 @@ def request_too_large(error):
 def init_app():
     """初始化应用"""
     ensure_upload_folder()
+    # 上次运行留下的过期分块上传
+    chunk_store.collect_garbage()
 
     try:
         # 检查并创建likes表
@@ -755,6 +2216,17 @@ def init_app():
             execute_query(create_likes_query, commit=True)
             logger.info("创建likes表成功")
 
+        # 独立访客HyperLogLog寄存器表（不加外键：写回批次里可能有刚被删除的图片）
+        create_viewers_query = """
+            CREATE TABLE IF NOT EXISTS image_unique_viewers (
+                image_id INT PRIMARY KEY,
+                registers VARBINARY(1024) NOT NULL,
+                unique_views INT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+        execute_query(create_viewers_query, commit=True)
+
         # 检查images表是否有likes字段
         check_likes_column = "SHOW COLUMNS FROM images LIKE 'likes'"
         has_likes_column = execute_query(check_likes_column, fetch_one=True)
@@ -773,6 +2245,71 @@ def init_app():
             execute_query(alter_query, commit=True)
             logger.info("为images表添加is_active字段成功")
 
+        # 后台图片处理任务表（不加外键：图片删除后残留的任务记录无害）
+        create_jobs_query = """
+            CREATE TABLE IF NOT EXISTS image_jobs (
+                id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                image_id INT NOT NULL,
+                kind VARCHAR(50) NOT NULL,
+                payload TEXT,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INT NOT NULL DEFAULT 0,
+                run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                locked_by VARCHAR(100),
+                locked_at DATETIME NULL,
+                last_error VARCHAR(500),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_status_run (status, run_after),
+                INDEX idx_image_id (image_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+        execute_query(create_jobs_query, commit=True)
+
+        # 多尺寸图片记录表
+        create_renditions_query = """
+            CREATE TABLE IF NOT EXISTS image_renditions (
+                image_id INT NOT NULL,
+                width INT NOT NULL,
+                height INT NOT NULL,
+                filename VARCHAR(255) NOT NULL,
+                file_size INT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (image_id, width)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+        execute_query(create_renditions_query, commit=True)
+
+        # 检查images表是否有processing_status字段
+        check_status_column = "SHOW COLUMNS FROM images LIKE 'processing_status'"
+        has_status_column = execute_query(check_status_column, fetch_one=True)
+
+        if not has_status_column:
+            alter_query = "ALTER TABLE images ADD COLUMN processing_status VARCHAR(20) NOT NULL DEFAULT 'ready'"
+            execute_query(alter_query, commit=True)
+            logger.info("为images表添加processing_status字段成功")
+
+        # 上传内容引用计数表
+        create_blobs_query = """
+            CREATE TABLE IF NOT EXISTS image_blobs (
+                sha256 CHAR(64) PRIMARY KEY,
+                filename VARCHAR(255) NOT NULL,
+                file_size BIGINT NOT NULL,
+                ref_count INT NOT NULL DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+        execute_query(create_blobs_query, commit=True)
+
+        # 检查images表是否有content_hash字段（旧图片为NULL，仍按UUID文件名独占文件）
+        check_hash_column = "SHOW COLUMNS FROM images LIKE 'content_hash'"
+        has_hash_column = execute_query(check_hash_column, fetch_one=True)
+
+        if not has_hash_column:
+            alter_query = "ALTER TABLE images ADD COLUMN content_hash CHAR(64), ADD INDEX idx_content_hash (content_hash)"
+            execute_query(alter_query, commit=True)
+            logger.info("为images表添加content_hash字段成功")
+
         # 检查images表是否有thumbnail_path字段
         check_thumbnail_column = "SHOW COLUMNS FROM images LIKE 'thumbnail_path'"
         has_thumbnail_column = execute_query(check_thumbnail_column, fetch_one=True)
@@ -782,11 +2319,176 @@ def init_app():
             execute_query(alter_query, commit=True)
             logger.info("为images表添加thumbnail_path字段成功")
 
+        # 首页游标分页按 (upload_time, id) 排序，索引需要同时包含这两列
+        feed_index_query = "SHOW INDEX FROM images WHERE Key_name = 'idx_upload_time'"
+        feed_index = execute_query(feed_index_query, fetch_all=True)
+
+        if feed_index is not None and len(feed_index) < 2:
+            drop_clause = "DROP INDEX idx_upload_time, " if feed_index else ""
+            alter_query = f"ALTER TABLE images {drop_clause}ADD INDEX idx_upload_time (upload_time DESC, id DESC)"
+            execute_query(alter_query, commit=True)
+            logger.info("更新images表idx_upload_time索引为(upload_time, id)成功")
+
+        # 搜索筛选用的组合索引：作者、文件类型、点赞数各自带上排序列
+        facet_indexes = {
+            'idx_user_time': '(user_id, upload_time DESC, id DESC)',
+            'idx_mime_time': '(mime_type, upload_time DESC, id DESC)',
+            'idx_likes': '(likes DESC, id DESC)',
+        }
+        for index_name, columns in facet_indexes.items():
+            index_query = "SHOW INDEX FROM images WHERE Key_name = %s"
+            existing = execute_query(index_query, (index_name,), fetch_all=True)
+            if existing is not None and not existing:
+                execute_query(f"ALTER TABLE images ADD INDEX {index_name} {columns}", commit=True)
+                logger.info(f"为images表添加{index_name}索引成功")
+
+        # 标题/描述全文索引（ngram分词，支持中文）
+        search_engine.ensure_index()
+
+        # 继续处理上次退出时没做完的任务
+        job_queue.start()
         logger.info("数据库初始化完成")
 
     except Exception as e:
         logger.error(f"数据库检查失败: {e}")
 
+@app.cli.command('search-rebuild')
+def search_rebuild_command():
+    """重建图片全文索引：flask --app app search-rebuild"""
+    search_engine.rebuild()
+    search_cache.bump()
+    logger.info("全文索引重建完成")
+
+@app.cli.command('renditions-backfill')
+@click.option('--batch', default=500, help='每批提交的任务数')
+@click.option('--process', is_flag=True, help='在当前进程里执行任务直到全部完成')
+@click.option('--all', 'regenerate', is_flag=True, help='已有多尺寸版本的图片也重新生成（比如新增了WebP/AVIF编码）')
+def renditions_backfill_command(batch, process, regenerate):
+    """为还没有多尺寸版本的已有图片补提交生成任务：flask --app app renditions-backfill"""
+    submitted = 0
+    last_id = 0
+    while True:
+        # 按ID分批，跳过已经有排队任务的图片，命令中断后重跑不会重复提交
+        rows = execute_query("""
+            SELECT i.id, i.filename FROM images i
+            WHERE i.id > %s
+              AND (%s OR NOT EXISTS (SELECT 1 FROM image_renditions r WHERE r.image_id = i.id))
+              AND NOT EXISTS (SELECT 1 FROM image_jobs j
+                              WHERE j.image_id = i.id AND j.kind = 'renditions' AND j.status IN ('pending', 'running'))
+            ORDER BY i.id
+            LIMIT %s
+        """, (last_id, regenerate, batch), fetch_all=True)
+        if not rows:
+            break
+        with db_transaction() as cursor:
+            for row in rows:
+                submit_renditions(cursor, row['id'], row['filename'])
+        submitted += len(rows)
+        last_id = rows[-1]['id']
+        logger.info(f"已提交 {submitted} 个多尺寸图片任务")
+
+    logger.info(f"补生成任务提交完成，共 {submitted} 个，由运行中的应用进程在后台处理")
+    if process and submitted:
+        job_queue.notify()
+        while True:
+            remaining = execute_query("""
+                SELECT COUNT(*) AS n FROM image_jobs
+                WHERE kind = 'renditions' AND status IN ('pending', 'running')
+            """, fetch_one=True)
+            if remaining is None or remaining['n'] == 0:
+                break
+            logger.info(f"剩余 {remaining['n']} 个任务")
+            time.sleep(5)
+        job_queue.shutdown()
+
+def move_to_shard(filenames):
+    """把平铺在上传目录根下的文件（连同AVIF/WebP版本）移到分片目录，已经移过的跳过，返回移动的文件数"""
+    moved = 0
+    for filename in filenames:
+        for name in [filename] + image_processing.variant_names(filename):
+            flat_path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+            if not os.path.exists(flat_path):
+                continue
+            path = upload_path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(flat_path, path)
+            moved += 1
+    return moved
+
+@app.cli.command('uploads-migrate')
+@click.option('--batch', default=500, help='每批处理的图片数')
+@click.option('--workers', default=8, help='并行移动文件的线程数')
+def uploads_migrate_command(batch, workers):
+    """
+    把上传目录根下的旧文件移到分片目录，并改写 file_path/thumbnail_path：flask --app app uploads-migrate
+    可以在应用运行时执行：先移动文件再改数据库，中间这段时间旧路径的请求由 find_upload 找到新位置；
+    中断后重跑从没迁移的图片继续。有进行中处理任务的图片先跳过，之后重跑即可；
+    查询之后才提交的任务里记录的是旧的平铺key，执行时由 media_tasks.resolve_key 找到新位置
+    """
+    if upload_storage.local_root is None:
+        raise click.ClickException('只有本地存储需要迁移，对象存储的文件一直按分片key存放')
+    migrated = moved = skipped = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = execute_query("""
+                SELECT i.id, i.filename, i.file_path, i.thumbnail_path,
+                       EXISTS (SELECT 1 FROM image_jobs j
+                               WHERE j.image_id = i.id AND j.status IN ('pending', 'running')) AS busy
+                FROM images i
+                WHERE i.id > %s AND i.file_path NOT LIKE %s
+                ORDER BY i.id
+                LIMIT %s
+            """, (last_id, blob_store.SHARDED_PATTERN, batch), fetch_all=True)
+            if rows is None:
+                raise click.ClickException('查询图片失败，请检查数据库连接后重跑')
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            ready = [row for row in rows if not row['busy']]
+            skipped += len(rows) - len(ready)
+            if not ready:
+                continue
+
+            placeholders = ', '.join(['%s'] * len(ready))
+            rendition_rows = execute_query(
+                f"SELECT image_id, filename FROM image_renditions WHERE image_id IN ({placeholders})",
+                [row['id'] for row in ready], fetch_all=True) or []
+            files = {row['id']: [row['filename']] for row in ready}
+            updates = []
+            for row in ready:
+                thumb = row['thumbnail_path'].split('/')[-1] if row['thumbnail_path'] else None
+                if thumb:
+                    files[row['id']].append(thumb)
+                updates.append((f"uploads/{blob_store.shard_path(row['filename'])}",
+                                f"uploads/{blob_store.shard_path(thumb)}" if thumb else None,
+                                row['id'], row['file_path']))
+            for r in rendition_rows:
+                files[r['image_id']].append(r['filename'])
+
+            # 移动文件是IO操作，多个线程并行；全部移完再改数据库
+            moved += sum(executor.map(move_to_shard, files.values()))
+            with db_transaction() as cursor:
+                cursor.executemany("""
+                    UPDATE images SET file_path = %s, thumbnail_path = %s
+                    WHERE id = %s AND file_path = %s
+                """, updates)
+            migrated += len(updates)
+            logger.info(f"已迁移 {migrated} 张图片（{moved} 个文件），跳过 {skipped} 张")
+
+    search_cache.bump()
+    remaining = sum(1 for entry in os.scandir(app.config['UPLOAD_FOLDER'])
+                    if entry.is_file() and not entry.name.startswith('.'))
+    logger.info(f"迁移完成：{migrated} 张图片，{moved} 个文件；{skipped} 张图片有进行中的处理任务，稍后重跑本命令")
+    if remaining:
+        logger.info(f"上传目录根下还有 {remaining} 个文件（没有对应的图片记录，或者属于跳过的图片）")
+
+# 应用加载时就启动任务调度线程：gunicorn等WSGI服务器不会执行 init_app()，不能等到第一次上传才处理
+# 上次遗留的任务和过期租约。spawn 出来的处理进程（__mp_main__）和 flask 命令行（加载时已有click上下文）里不启动，
+# 命令行需要处理任务时由 notify() 启动
+if __name__ != '__mp_main__' and click.get_current_context(silent=True) is None:
+    job_queue.start()
+
 # ====================== 15. 启动应用 ======================
 if __name__ == '__main__':
     init_app()
@@ -0,0 +1,126 @@
+"""
+缩略图生成性能对比
+原来的做法（Image.open -> exif_transpose -> copy -> thumbnail）先按原尺寸完整解码，
+image_processing.load_thumbnail 在解码时就缩小（JPEG用draft，其他格式用reduce）
+
+每种做法在单独的子进程里运行，分别统计每张图的CPU时间和进程峰值内存(RSS)
+用法: python bench_thumbnails.py [--repeat 5] [--output bench_output.txt]
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageOps
+
+import image_processing
+
+# 名称, 尺寸, 格式, 模式
+SAMPLES = [
+    ('24MP.jpg', (6000, 4000), 'JPEG', 'RGB'),
+    ('12MP.jpg', (4032, 3024), 'JPEG', 'RGB'),
+    ('12MP_rotated.jpg', (4032, 3024), 'JPEG', 'RGB'),
+    ('8MP_alpha.png', (3264, 2448), 'PNG', 'RGBA'),
+]
+
+
+def make_samples(directory, queue):
+    """生成测试图片：带噪声的渐变，接近真实照片的压缩率"""
+    paths = []
+    for name, size, fmt, mode in SAMPLES:
+        path = os.path.join(directory, name)
+        noise = Image.effect_noise(size, 40).convert('L')
+        gradient = Image.linear_gradient('L').resize(size)
+        img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        options = {}
+        if mode == 'RGBA':
+            img = img.convert('RGBA')
+            img.putalpha(gradient)
+        if 'rotated' in name:
+            # 手机竖拍的照片：像素横着存，EXIF里记录需要旋转
+            exif = Image.Exif()
+            exif[image_processing.ORIENTATION_TAG] = 6
+            options['exif'] = exif.tobytes()
+        img.save(path, fmt, quality=90, **options)
+        paths.append(path)
+    queue.put(paths)
+
+
+def baseline_thumbnail(source_path, max_size):
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img).copy()
+        img.thumbnail(max_size)
+        return image_processing._flatten_alpha(img)
+
+
+def fast_thumbnail(source_path, max_size):
+    return image_processing.load_thumbnail(source_path, max_size)
+
+
+METHODS = {'baseline': baseline_thumbnail, 'fast': fast_thumbnail}
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是KB，macOS 上是字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(method, source_path, max_size, repeat, queue):
+    """在子进程里执行：峰值内存从进程启动算起，减去开始前的值就是这种做法本身占用的"""
+    func = METHODS[method]
+    before = peak_rss_mb()
+    start = time.process_time()
+    for _ in range(repeat):
+        thumb = func(source_path, max_size)
+    cpu_ms = (time.process_time() - start) / repeat * 1000
+    queue.put((cpu_ms, peak_rss_mb() - before, thumb.size))
+
+
+def run(target, *args):
+    """
+    在新的spawn子进程里执行 target(*args, queue)，返回它放进队列的结果
+    Linux 上子进程会继承父进程的内存峰值，所以生成测试图片也放在子进程里，主进程保持很小
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=args + (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='缩略图生成性能对比')
+    parser.add_argument('--repeat', type=int, default=5, help='每张图重复次数，取平均CPU时间')
+    parser.add_argument('--output', help='结果同时写入这个文件')
+    args = parser.parse_args()
+
+    max_size = image_processing.THUMBNAIL_SIZE
+    lines = [f"缩略图 {max_size[0]}x{max_size[1]}，每张重复 {args.repeat} 次",
+             f"{'图片':<20}{'做法':<10}{'CPU(ms)':>10}{'峰值RSS增量(MB)':>14}{'输出尺寸':>12}"]
+    with tempfile.TemporaryDirectory() as directory:
+        for path in run(make_samples, directory):
+            results = {}
+            for method in METHODS:
+                cpu_ms, rss_mb, size = run(measure, method, path, max_size, args.repeat)
+                results[method] = (cpu_ms, rss_mb)
+                lines.append(f"{os.path.basename(path):<20}{method:<10}{cpu_ms:>10.1f}{rss_mb:>14.1f}"
+                             f"{size[0]:>7}x{size[1]}")
+            speedup = results['baseline'][0] / max(results['fast'][0], 0.001)
+            lines.append(f"{'':<20}{'加速':<10}{speedup:>9.1f}x")
+
+    report = '\n'.join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+按内容寻址的上传文件存储
+原图以 SHA-256 命名（<sha256>.<扩展名>），相同内容只存一份，缩略图和多尺寸版本也跟着共用；
+image_blobs 表记录每份内容被多少张图片引用，最后一个引用删除时才删文件
+文件名由内容决定，URL指向的内容永远不变，可以让浏览器和CDN永久缓存
+
+文件按哈希前缀分两级目录存放（ab/cd/<文件名>），每个目录的文件数保持在几百个以内；
+缩略图、多尺寸版本和原图在同一个目录
+"""
+
+import hashlib
+import os
+import re
+import uuid
+
+# 原图、缩略图（thumb_）、多尺寸版本（w640_）和它们的AVIF/WebP版本
+CONTENT_NAME = re.compile(r'^(?:thumb_|w\d+_)?([0-9a-f]{64})\.[a-z0-9]+(?:\.[a-z0-9]+)?$')
+
+DERIVED_PREFIX = re.compile(r'^(?:thumb_|w\d+_)')
+HEX_PREFIX = re.compile(r'^[0-9a-f]{4}')
+
+# 分片目录相对路径的样子，用于判断数据库里的路径是否已经迁移
+SHARDED_PATTERN = 'uploads/__/__/%'
+
+
+def blob_filename(content_hash, ext):
+    return f"{content_hash}.{ext}"
+
+
+def content_hash_of(filename):
+    """从文件名取出内容哈希，不是按内容命名的文件（旧的UUID文件名）返回None"""
+    match = CONTENT_NAME.match(filename)
+    return match.group(1) if match else None
+
+
+def content_etag(filename):
+    """
+    按内容命名的文件的强ETag：文件名由内容哈希（派生文件再加上前缀和格式）决定，内容不变ETag就不变
+    不是按内容命名的文件返回None，由调用方按修改时间和大小生成
+    """
+    return filename if content_hash_of(filename) else None
+
+
+def shard_key(filename):
+    """
+    决定分片目录的十六进制串：缩略图和多尺寸版本去掉前缀后和原图相同
+    按内容命名的文件和旧的UUID文件名本身就是随机十六进制，其他文件名取MD5
+    """
+    stem = DERIVED_PREFIX.sub('', filename)
+    if HEX_PREFIX.match(stem):
+        return stem
+    return hashlib.md5(stem.split('.', 1)[0].encode('utf-8')).hexdigest()
+
+
+def shard_path(filename):
+    """上传目录下的相对路径，用 / 分隔（同时用于URL和数据库里的 file_path）"""
+    key = shard_key(filename)
+    return f"{key[0:2]}/{key[2:4]}/{filename}"
+
+
+class TempBlob:
+    """
+    接收上传内容的临时文件：表单解析器把请求体按块直接写进来，写的同时计算SHA-256和大小，
+    并保留开头几个字节用于判断真实格式，之后不用再读一遍文件
+    其余文件操作（read/seek/close等）交给底层文件，可以直接给Pillow读文件头
+    """
+
+    def __init__(self, directory, head_bytes=16):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f".upload-{uuid.uuid4().hex}.tmp")
+        self.size = 0
+        self.head = b''
+        self._head_bytes = head_bytes
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, 'w+b')
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        if len(self.head) < self._head_bytes:
+            self.head += data[:self._head_bytes - len(self.head)]
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def discard(self):
+        """关闭并删除临时文件；已经移走时什么也不做"""
+        self._file.close()
+        discard_temp(self.path)
+
+
+def discard_temp(tmp_path):
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def acquire(cursor, content_hash, filename, file_size):
+    """
+    在调用方事务里增加一个引用，返回这份内容之前是否已经存在
+    INSERT ... ON DUPLICATE KEY UPDATE 会锁住这一行，和 release() 的删除互斥
+    """
+    cursor.execute("""
+        INSERT INTO image_blobs (sha256, filename, file_size, ref_count)
+        VALUES (%s, %s, %s, 1)
+        ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+    """, (content_hash, filename, file_size))
+    # 新插入时影响1行，更新已有行时影响2行
+    return cursor.rowcount == 2
+
+
+def release(cursor, content_hash):
+    """
+    在调用方事务里减少一个引用，返回这是否是最后一个引用（是则已删除记录，调用方负责删文件）
+    删文件应当在事务提交之前完成：行锁一直持有到提交，并发的上传会等删除结束后再重新写入文件
+    """
+    cursor.execute("SELECT ref_count FROM image_blobs WHERE sha256 = %s FOR UPDATE", (content_hash,))
+    row = cursor.fetchone()
+    if row is None:
+        # 没有引用记录：按独占处理
+        return True
+    if row['ref_count'] > 1:
+        cursor.execute("UPDATE image_blobs SET ref_count = ref_count - 1 WHERE sha256 = %s", (content_hash,))
+        return False
+    cursor.execute("DELETE FROM image_blobs WHERE sha256 = %s", (content_hash,))
+    return True
+
+
+def is_referenced(cursor, content_hash, lock=False):
+    """
+    lock=True 时加锁读，锁持有到调用方事务提交：记录存在时锁住这一行；
+    不存在时锁住这个位置（InnoDB间隙锁），期间同内容的 acquire() 插入会等待
+    """
+    cursor.execute("SELECT 1 FROM image_blobs WHERE sha256 = %s" + (" FOR UPDATE" if lock else ""),
+                   (content_hash,))
+    return cursor.fetchone() is not None
@@ -0,0 +1,177 @@
+"""
+进程内缓存
+带过期时间的LRU缓存，线程安全；支持并发未命中合并（single-flight）和按代失效
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同一个key同时只执行一次，其余并发调用等待并共享这次的结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class TTLCache:
+    """
+    LRU + TTL 缓存
+
+    maxsize: 最多缓存条目数，超出时淘汰最久未使用的
+    ttl: 条目存活秒数
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._flight = SingleFlight()
+
+    def _peek(self, key):
+        """不计入命中统计的读取（需持有锁）"""
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING or item[1] <= time.monotonic():
+            return _MISSING
+        return item[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        缓存未命中时调用loader并缓存结果；同一个key的并发未命中只调用一次loader
+        loader返回None（例如查询失败）时不缓存
+        """
+        # 直接调用TTLCache的实现，子类对key的包装只做一次
+        value = TTLCache.get(self, key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def load():
+            with self._lock:
+                value = self._peek(key)
+            if value is not _MISSING:
+                return value
+            value = loader()
+            if value is not None:
+                TTLCache.set(self, key, value, ttl)
+            return value
+
+        return self._flight.do(key, load)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self._flight.coalesced,
+            }
+
+
+class GenerationalCache(TTLCache):
+    """
+    按代失效的缓存：bump() 之后旧代的条目不再可见，随LRU自然淘汰
+    适合"任何写操作都可能影响结果"的场景，比如搜索结果
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        super().__init__(maxsize, ttl)
+        self.generation = 0
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+
+    def get(self, key, default=None):
+        return super().get((self.generation, key), default)
+
+    def set(self, key, value, ttl=None):
+        super().set((self.generation, key), value, ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        return super().get_or_load((self.generation, key), loader, ttl)
+
+    def delete(self, key):
+        super().delete((self.generation, key))
+
+    def stats(self):
+        data = super().stats()
+        data['generation'] = self.generation
+        return data
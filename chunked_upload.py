@@ -0,0 +1,271 @@
+"""
+分块断点续传
+客户端先创建上传拿到 upload_id，再按序号上传每一块（可以乱序、失败后重传），全部收到后合并成完整文件
+状态都在磁盘上：每个上传一个目录，meta.json 记录总大小、分块大小、所属用户等，每一块一个 <序号>.part 文件，
+进程重启后、请求落到共用这个目录的其他进程上都能继续；多台Web节点时目录要放在共享存储上或按用户固定节点
+超过 ttl 没有收到新分块的上传由 collect_garbage 清理
+每个用户同时未完成的上传个数和预留的总字节数有上限，避免一个用户创建大量上传占满磁盘
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER = 1024 * 1024
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+CLAIMED_SUFFIX = '.finalizing'
+CLAIM_TIMEOUT = 600  # 秒，合并超过这个时间还没结束，认为处理它的进程已经退出，允许重新合并
+
+
+class UploadNotFound(LookupError):
+    """上传不存在、已过期、已经合并或者不属于当前用户"""
+
+
+class ChunkRejected(ValueError):
+    """分块序号、大小不对，或者还有分块没有收到"""
+
+
+class QuotaExceeded(ChunkRejected):
+    """同一用户未完成的上传个数或总大小超过上限"""
+
+
+class UploadInProgress(Exception):
+    """上传正在合并（另一个 finalize 请求在处理）"""
+
+
+class ChunkStore:
+    """
+    directory: 存放未完成上传的目录
+    chunk_size: 除最后一块外每块的字节数
+    max_size: 单个文件的大小上限
+    ttl: 秒，最后一次写入后多久过期
+    max_sessions: 每个用户同时未完成的上传个数上限，None 表示不限
+    max_reserved: 每个用户未完成的上传声明的总字节数上限，None 表示不限
+    """
+
+    def __init__(self, directory, chunk_size, max_size, ttl, max_sessions=None, max_reserved=None):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_reserved = max_reserved
+        self._gc_lock = threading.Lock()
+        self._last_gc = 0
+        self._create_lock = threading.Lock()
+
+    def _path(self, upload_id, *names):
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise UploadNotFound(upload_id)
+        return os.path.join(self.directory, upload_id, *names)
+
+    def chunk_count(self, meta):
+        return max(1, -(-meta['size'] // meta['chunk_size']))
+
+    def expected_length(self, meta, index):
+        return min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+
+    def create(self, owner, filename, size, **extra):
+        """创建一个上传，返回 meta；extra 原样保存，合并后交给调用方（比如标题、描述）"""
+        if size <= 0:
+            raise ChunkRejected('文件大小必须大于0')
+        if size > self.max_size:
+            raise ChunkRejected(f"文件大小不能超过 {self.max_size // 1024 // 1024}MB")
+        self.collect_garbage(force=False)
+
+        # 检查和创建在同一把锁里，同一进程的并发请求不会一起越过上限；多进程之间最多超出进程数个
+        with self._create_lock:
+            self._check_quota(owner, size)
+            upload_id = uuid.uuid4().hex
+            meta = dict(extra, id=upload_id, owner=owner, filename=filename, size=size,
+                        chunk_size=self.chunk_size, created=time.time())
+            os.makedirs(self._path(upload_id))
+            tmp_path = self._path(upload_id, 'meta.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(upload_id, 'meta.json'))
+        return meta
+
+    def _check_quota(self, owner, size):
+        if self.max_sessions is None and self.max_reserved is None:
+            return
+        active = self.active_uploads(owner)
+        if self.max_sessions is not None and len(active) >= self.max_sessions:
+            raise QuotaExceeded(f"未完成的上传不能超过 {self.max_sessions} 个，请先完成或取消之前的上传")
+        reserved = sum(meta['size'] for meta in active)
+        if self.max_reserved is not None and reserved + size > self.max_reserved:
+            raise QuotaExceeded(f"未完成的上传总大小不能超过 {self.max_reserved // 1024 // 1024}MB，"
+                                f"请先完成或取消之前的上传")
+
+    def active_uploads(self, owner):
+        """owner 没有过期的上传（包括正在合并的），按目录逐个读取 meta.json"""
+        deadline = time.time() - self.ttl
+        active = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return active
+        for entry in entries:
+            path = os.path.join(entry.path, 'meta.json')
+            try:
+                if os.stat(path).st_mtime < deadline:
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                continue
+            if meta.get('owner') == owner:
+                active.append(meta)
+        return active
+
+    def load(self, upload_id, owner):
+        """
+        读取上传信息，不存在、已过期或者不属于 owner 时抛出UploadNotFound，正在合并时抛出UploadInProgress
+        合并超过 CLAIM_TIMEOUT 还没结束（处理的进程中途退出）时放回去，客户端可以重新合并
+        """
+        path = self._path(upload_id, 'meta.json')
+        try:
+            meta, expired = self._read_meta(path)
+        except FileNotFoundError:
+            claimed_path = os.path.join(self._path(upload_id) + CLAIMED_SUFFIX, 'meta.json')
+            try:
+                meta, expired = self._read_meta(claimed_path)
+            except FileNotFoundError:
+                raise UploadNotFound(upload_id) from None
+            if expired or meta['owner'] != owner:
+                raise UploadNotFound(upload_id)
+            if os.stat(claimed_path).st_mtime >= time.time() - CLAIM_TIMEOUT:
+                raise UploadInProgress(upload_id)
+            logger.warning(f"分块上传 {upload_id} 合并超时，放回重新合并")
+            try:
+                self.unclaim(meta)
+            except FileNotFoundError:
+                pass  # 另一个请求已经放回或者合并完成，按正常流程重新读取
+            return self.load(upload_id, owner)
+        if expired or meta['owner'] != owner:
+            raise UploadNotFound(upload_id)
+        return meta
+
+    def _read_meta(self, path):
+        """返回 (meta, 是否过期)；文件内容损坏按不存在处理"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                meta = json.load(f)
+            return meta, os.stat(path).st_mtime < time.time() - self.ttl
+        except ValueError:
+            raise FileNotFoundError(path) from None
+
+    def write_chunk(self, meta, index, stream):
+        """
+        从流里读出第 index 块写到磁盘，重传的块直接覆盖
+        先写临时文件，长度对了才改名，中途断开不会留下半块
+        """
+        if not 0 <= index < self.chunk_count(meta):
+            raise ChunkRejected(f"分块序号 {index} 超出范围")
+        expected = self.expected_length(meta, index)
+        part_path = self._path(meta['id'], f"{index}.part")
+        tmp_path = f"{part_path}.{uuid.uuid4().hex}.tmp"
+        written = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while written <= expected:
+                    data = stream.read(min(COPY_BUFFER, expected + 1 - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    written += len(data)
+            if written != expected:
+                raise ChunkRejected(f"第 {index} 块应为 {expected} 字节，收到 {written} 字节")
+            os.replace(tmp_path, part_path)
+        except FileNotFoundError:
+            # 目录已被清理或合并
+            raise UploadNotFound(meta['id']) from None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # meta.json 的修改时间就是最后活动时间，过期从这里算
+        os.utime(self._path(meta['id'], 'meta.json'))
+
+    def received(self, meta):
+        """已经收到的分块序号，客户端据此只补传缺少的块"""
+        try:
+            names = os.listdir(self._path(meta['id']))
+        except FileNotFoundError:
+            raise UploadNotFound(meta['id']) from None
+        return sorted(int(name[:-5]) for name in names if name.endswith('.part') and name[:-5].isdigit())
+
+    def claim(self, meta):
+        """
+        开始合并：把目录改名，同一个上传的并发合并请求只有一个能拿到，之后的分块上传也会失败
+        返回改名后的目录；合并失败可以用 unclaim 放回去让客户端重试
+        并发的另一个请求已经拿到时抛出UploadInProgress
+        """
+        claimed = self._path(meta['id']) + CLAIMED_SUFFIX
+        try:
+            missing = sorted(set(range(self.chunk_count(meta))) - set(self.received(meta)))
+            if missing:
+                raise ChunkRejected(f"还有 {len(missing)} 块没有上传: {missing[:20]}")
+            os.rename(self._path(meta['id']), claimed)
+        except (UploadNotFound, OSError):
+            # 目录不见了或者改名的目标已存在：另一个请求刚刚拿到
+            if os.path.isdir(claimed):
+                raise UploadInProgress(meta['id']) from None
+            raise UploadNotFound(meta['id']) from None
+        # 合并开始时间，load 据此判断合并是否超时
+        os.utime(os.path.join(claimed, 'meta.json'))
+        return claimed
+
+    def unclaim(self, meta):
+        """把认领的分块放回去；已被清理（过期、取消）时什么也不做"""
+        try:
+            os.rename(self._path(meta['id']) + CLAIMED_SUFFIX, self._path(meta['id']))
+            os.utime(self._path(meta['id'], 'meta.json'))
+        except FileNotFoundError:
+            pass
+
+    def assemble(self, meta, claimed, dest):
+        """按顺序把分块拷贝到 dest（可写的文件对象），每次只在内存里放一个缓冲区"""
+        for index in range(self.chunk_count(meta)):
+            with open(os.path.join(claimed, f"{index}.part"), 'rb') as f:
+                shutil.copyfileobj(f, dest, COPY_BUFFER)
+
+    def discard(self, upload_id):
+        for path in (self._path(upload_id), self._path(upload_id) + CLAIMED_SUFFIX):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def collect_garbage(self, force=True):
+        """
+        删除过期的上传，返回删除的个数
+        force=False 时距离上次清理不到 ttl 的十分之一就跳过，创建上传时顺便调用，不需要单独的定时任务
+        """
+        now = time.time()
+        with self._gc_lock:
+            if not force and now - self._last_gc < self.ttl / 10:
+                return 0
+            self._last_gc = now
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            try:
+                expired = os.stat(os.path.join(entry.path, 'meta.json')).st_mtime < now - self.ttl
+            except FileNotFoundError:
+                # 创建到一半的目录，或者合并中进程退出留下的目录
+                expired = entry.stat().st_mtime < now - self.ttl
+            if expired:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info(f"清理过期的分块上传 {removed} 个")
+        return removed
@@ -0,0 +1,104 @@
+"""
+数据库熔断器
+连续失败达到阈值后打开，打开期间直接快速失败；冷却结束进入半开状态，只放行一个探测请求
+"""
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    线程共享的熔断器
+
+    failure_threshold: 连续失败多少次后打开
+    reset_timeout: 打开后多少秒进入半开状态
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+
+    def _refresh(self):
+        """打开状态冷却结束后切换为半开（需持有锁）"""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probe_started = None
+            logger.info(f"熔断器[{self.name}]进入半开状态，允许探测请求")
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def retry_after(self):
+        """距离下一次允许探测的剩余秒数，未打开时为0"""
+        with self._lock:
+            self._refresh()
+            if self._state != OPEN:
+                return 0
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            return max(1, int(remaining + 0.999))
+
+    def allow_request(self):
+        """是否允许发起一次数据库操作；半开状态下同一时间只放行一个探测"""
+        with self._lock:
+            self._refresh()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN:
+                now = time.monotonic()
+                # 探测请求迟迟没有结果（例如借连接超时）时，允许再放行一个
+                if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                    self._probe_started = now
+                    return True
+            return False
+
+    def record_success(self):
+        # 快速路径：正常状态下不抢锁
+        if self._state == CLOSED and self._failures == 0:
+            return
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"熔断器[{self.name}]探测成功，恢复正常")
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning(
+                        f"熔断器[{self.name}]打开：连续失败{self._failures}次，"
+                        f"{self.reset_timeout}秒内快速失败")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+
+    def snapshot(self):
+        with self._lock:
+            self._refresh()
+            return {
+                'name': self.name,
+                'state': self._state,
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+            }
@@ -48,12 +48,18 @@ CREATE TABLE images (
     likes INT DEFAULT 0,
     is_active BOOLEAN DEFAULT TRUE,
     thumbnail_path VARCHAR(500),
+    processing_status VARCHAR(20) NOT NULL DEFAULT 'ready',
+    content_hash CHAR(64),
     user_id INT,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
-    INDEX idx_user_id (user_id),
-    INDEX idx_upload_time (upload_time DESC),
+    INDEX idx_user_time (user_id, upload_time DESC, id DESC),
+    INDEX idx_upload_time (upload_time DESC, id DESC),
+    INDEX idx_mime_time (mime_type, upload_time DESC, id DESC),
+    INDEX idx_likes (likes DESC, id DESC),
     INDEX idx_is_active (is_active),
-    INDEX idx_filename (filename(100))
+    INDEX idx_filename (filename(100)),
+    INDEX idx_content_hash (content_hash),
+    FULLTEXT INDEX ft_images_text (title, description) WITH PARSER ngram
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- 7. 创建点赞表
@@ -70,6 +76,52 @@ CREATE TABLE likes (
     INDEX idx_created_at (created_at DESC)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- 7.1 独立访客HyperLogLog寄存器表（每张图片512字节）
+CREATE TABLE image_unique_viewers (
+    image_id INT PRIMARY KEY,
+    registers VARBINARY(1024) NOT NULL,
+    unique_views INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- 7.2 多尺寸图片表（每张图片按配置的宽度各生成一份，前端用srcset选择）
+CREATE TABLE image_renditions (
+    image_id INT NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    file_size INT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (image_id, width)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- 7.3 后台图片处理任务表（缩略图等，由应用进程内的进程池执行）
+CREATE TABLE image_jobs (
+    id BIGINT PRIMARY KEY AUTO_INCREMENT,
+    image_id INT NOT NULL,
+    kind VARCHAR(50) NOT NULL,
+    payload TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_by VARCHAR(100),
+    locked_at DATETIME NULL,
+    last_error VARCHAR(500),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_status_run (status, run_after),
+    INDEX idx_image_id (image_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- 7.4 上传内容引用计数表（原图按SHA-256命名，相同内容只存一份，最后一个引用删除时才删文件）
+CREATE TABLE image_blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    filename VARCHAR(255) NOT NULL,
+    file_size BIGINT NOT NULL,
+    ref_count INT NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 -- 8. 创建标签表（可选）
 CREATE TABLE tags (
     id INT PRIMARY KEY AUTO_INCREMENT,
@@ -0,0 +1,242 @@
+"""
+MySQL连接池
+线程安全，借出时做健康检查，按最大存活时间/空闲时间回收连接，并记录耗尽等指标
+"""
+
+import threading
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(Exception):
+    """等待超时仍未借到连接"""
+
+
+class _PoolEntry:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class PooledConnection:
+    """借出的连接代理，close() 时归还连接池而不是真正断开"""
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+        self._broken = False
+
+    def __getattr__(self, name):
+        entry = self.__dict__.get('_entry')
+        if entry is None:
+            raise AttributeError(f"连接已归还，无法访问 {name}")
+        return getattr(entry.conn, name)
+
+    def invalidate(self):
+        """标记连接已损坏，归还时直接丢弃"""
+        self._broken = True
+
+    def close(self):
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool._release(entry, self._broken)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    固定上限的连接池
+
+    connect_func: 创建新连接的函数，失败时抛异常或返回None
+    size: 最大连接数（借出+空闲）
+    max_lifetime: 连接最长存活秒数，超过后在借出/归还时回收
+    max_idle: 连接最长空闲秒数，超过后在借出时回收
+    ping_interval: 空闲超过该秒数的连接在借出前先ping一次
+    borrow_timeout: 连接池耗尽时最长等待秒数
+    """
+
+    def __init__(self, connect_func, size=10, max_lifetime=1800, max_idle=300,
+                 ping_interval=30, borrow_timeout=5):
+        if size < 1:
+            raise ValueError("连接池大小必须大于0")
+        self._connect = connect_func
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        self.borrow_timeout = borrow_timeout
+
+        self._idle = deque()
+        self._total = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'recycled_lifetime': 0,
+            'recycled_idle': 0,
+            'health_check_failures': 0,
+            'connect_failures': 0,
+            'exhausted_waits': 0,
+            'exhausted_timeouts': 0,
+            'peak_in_use': 0,
+        }
+
+    # ---------- 借出 ----------
+    def get_connection(self, timeout=None):
+        """借出连接，返回 PooledConnection；无法建立连接时返回None"""
+        if timeout is None:
+            timeout = self.borrow_timeout
+        deadline = time.monotonic() + timeout
+
+        while True:
+            entry, need_create = self._take_or_reserve(deadline)
+            if need_create:
+                return self._create(reserved=True)
+
+            reason = self._stale_reason(entry)
+            if reason:
+                self._discard(entry, reason)
+                continue
+
+            if not self._healthy(entry):
+                self._discard(entry, 'health_check_failures')
+                continue
+
+            with self._cond:
+                self._stats['reused'] += 1
+            return PooledConnection(self, entry)
+
+    def _take_or_reserve(self, deadline):
+        """取一个空闲连接，或预占一个新建名额；池满时等待"""
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise RuntimeError("连接池已关闭")
+                if self._idle:
+                    # 后进先出：热连接优先复用，冷连接自然老化回收
+                    entry = self._idle.pop()
+                    self._track_in_use()
+                    return entry, False
+                if self._total < self.size:
+                    self._total += 1
+                    self._track_in_use()
+                    return None, True
+
+                if not waited:
+                    self._stats['exhausted_waits'] += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['exhausted_timeouts'] += 1
+                    raise PoolExhaustedError(
+                        f"连接池已耗尽（上限{self.size}），等待超时")
+                self._cond.wait(remaining)
+
+    def _track_in_use(self):
+        in_use = self._total - len(self._idle)
+        if in_use > self._stats['peak_in_use']:
+            self._stats['peak_in_use'] = in_use
+
+    def _create(self, reserved=False):
+        conn = None
+        try:
+            conn = self._connect()
+        except Exception as e:
+            logger.error(f"连接池新建连接失败: {e}")
+        if conn is None:
+            with self._cond:
+                self._stats['connect_failures'] += 1
+                if reserved:
+                    self._total -= 1
+                    self._cond.notify()
+            return None
+        with self._cond:
+            self._stats['created'] += 1
+        return PooledConnection(self, _PoolEntry(conn))
+
+    def _stale_reason(self, entry):
+        now = time.monotonic()
+        if self.max_lifetime and now - entry.created_at > self.max_lifetime:
+            return 'recycled_lifetime'
+        if self.max_idle and now - entry.last_used > self.max_idle:
+            return 'recycled_idle'
+        return None
+
+    def _healthy(self, entry):
+        if time.monotonic() - entry.last_used < self.ping_interval:
+            return True
+        try:
+            entry.conn.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logger.warning(f"连接健康检查失败，丢弃该连接: {e}")
+            return False
+
+    # ---------- 归还 ----------
+    def _release(self, entry, broken=False):
+        if not broken:
+            try:
+                if entry.conn.in_transaction:
+                    entry.conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or self._closed:
+            self._discard(entry, None)
+            return
+        if self.max_lifetime and time.monotonic() - entry.created_at > self.max_lifetime:
+            self._discard(entry, 'recycled_lifetime')
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def _discard(self, entry, reason):
+        """关闭连接并释放其占用的名额"""
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._total -= 1
+            if reason:
+                self._stats[reason] += 1
+            self._cond.notify()
+
+    # ---------- 管理 ----------
+    def stats(self):
+        """连接池指标快照"""
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                'size': self.size,
+                'total': self._total,
+                'idle': len(self._idle),
+                'in_use': self._total - len(self._idle),
+            })
+        return data
+
+    def close_all(self):
+        """关闭所有空闲连接，借出中的连接归还时关闭"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for entry in idle:
+            self._discard(entry, None)
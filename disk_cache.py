@@ -0,0 +1,176 @@
+"""
+磁盘文件缓存
+按总字节数限制容量，超出时淘汰最久未访问的文件；同一个key的并发未命中只生成一次
+多个进程可以共用同一个目录：各进程各自维护访问顺序，命中前检查文件是否还在，
+被其他进程淘汰掉的文件当作未命中重新生成
+容量是整个目录的：每个进程每隔 rescan_interval 秒重新扫描一次目录，把其他进程写入的文件也算进来，
+所以多个进程合计最多超出上限 一个扫描间隔内其他进程新写入的量
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """
+    directory: 缓存目录，key 是目录下的相对路径（比如 "12/640x0_contain.webp"）
+    max_bytes: 缓存目录的总大小上限（所有共用这个目录的进程合计）
+    rescan_interval: 秒，生成新文件时距离上次扫描超过这个时间就重新扫描目录
+    """
+
+    def __init__(self, directory, max_bytes, rescan_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self._last_scan = 0
+        self._entries = OrderedDict()  # key -> 文件大小，按访问顺序排列
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _scan(self, remove_tmp=False):
+        """目录里的全部缓存文件，按修改时间从旧到新：[(key, 大小)]"""
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name.endswith('.tmp'):
+                        if remove_tmp:
+                            # 上次生成到一半留下的临时文件
+                            os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, os.path.relpath(path, self.directory), stat.st_size))
+        return [(key, size) for _, key, size in sorted(found)]
+
+    def _load(self):
+        """第一次使用时扫描目录，按修改时间恢复大致的访问顺序（需持有锁）"""
+        self._loaded = True
+        self._last_scan = time.monotonic()
+        found = self._scan(remove_tmp=True)
+        for key, size in found:
+            self._entries[key] = size
+            self._bytes += size
+        if found:
+            logger.info(f"磁盘缓存 {self.directory}: {len(found)} 个文件, {self._bytes / 1024 / 1024:.1f}MB")
+        self._evict()
+
+    def _rescan(self):
+        """
+        按目录的实际内容重新统计：其他进程写入的文件排在最前面（本进程没访问过，先淘汰），
+        其余保持本进程的访问顺序；扫描在锁外进行，不阻塞命中
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_scan < self.rescan_interval:
+                return
+            self._last_scan = now
+        found = self._scan()
+        with self._lock:
+            on_disk = dict(found)
+            entries = OrderedDict((key, size) for key, size in found if key not in self._entries)
+            for key, size in self._entries.items():
+                # 扫描之后才写入的文件不在扫描结果里，仍然保留
+                if key in on_disk or os.path.exists(self.path(key)):
+                    entries[key] = on_disk.get(key, size)
+            self._entries = entries
+            self._bytes = sum(entries.values())
+            self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """命中返回文件路径，否则返回None"""
+        path = self.path(key)
+        exists = os.path.exists(path)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if key in self._entries:
+                if exists:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return path
+                # 已被其他进程淘汰
+                self._bytes -= self._entries.pop(key)
+            elif exists:
+                # 其他进程生成的文件，纳入本进程的统计
+                size = os.path.getsize(path)
+                self._entries[key] = size
+                self._bytes += size
+                self.hits += 1
+                self._evict()
+                return path
+            self.misses += 1
+        return None
+
+    def get_or_create(self, key, producer):
+        """
+        未命中时调用 producer(目标路径) 生成文件，返回文件路径
+        producer 负责先写临时文件再重命名到目标路径；同一个key的并发未命中只调用一次
+        """
+        path = self.get(key)
+        if path is not None:
+            return path
+        return self._flight.do(key, lambda: self._create(key, producer))
+
+    def _create(self, key, producer):
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            producer(path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._bytes += size - self._entries.get(key, 0)
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._evict()
+        self._rescan()
+        return path
+
+    def _evict(self):
+        """删除最久未访问的文件直到低于容量上限（需持有锁），刚写入的一个总是保留"""
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def delete_dir(self, subdir):
+        """删除某个子目录下的全部缓存文件（比如一张图片的所有变体）"""
+        prefix = subdir.rstrip('/') + os.sep
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._bytes -= self._entries.pop(key)
+        shutil.rmtree(self.path(subdir), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self._flight.coalesced,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,276 @@
+"""
+后台图片处理任务
+任务持久化在 image_jobs 表里，进程重启不会丢；调度线程领取任务后交给进程池执行，
+解码、缩放这类CPU密集的工作不再占用请求线程，也不受GIL影响
+失败按指数退避重试；多个应用进程同时运行时用条件UPDATE抢占，同一个任务只会被一个进程执行
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_RETRY_DELAY = 3600  # 秒
+
+
+class ProcessRunner:
+    """
+    第一次使用时才创建的进程池，用spawn启动子进程：
+    提交任务时本进程里已经有很多线程，fork可能复制到被其他线程持有的锁
+    子进程异常退出（比如内存不足被杀）会让整个进程池不可用，调用方捕获 BrokenProcessPool 后调用 reset() 重建
+    initializer/initargs: 每个子进程启动时执行一次，比如设置解码预算
+    """
+
+    def __init__(self, workers, initializer=None, initargs=()):
+        self.workers = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=self.initializer, initargs=self.initargs)
+            pool = self._pool
+        try:
+            return pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self.reset(pool)
+            raise
+
+    def reset(self, pool=None):
+        """丢弃已损坏的进程池，下次提交时重建；pool 用于避免并发时把刚重建的新池也丢掉"""
+        with self._lock:
+            if self._pool is not None and (pool is None or pool is self._pool):
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+class JobQueue:
+    """
+    execute: 与 app.execute_query 签名一致的查询函数
+    workers: 进程池大小
+    poll_interval: 没有新任务通知时多久查一次表（其他进程提交的任务、到期的重试）
+    max_attempts: 最多尝试次数，用完后标记为失败
+    lease: 任务运行超过这么多秒仍未结束，视为执行它的进程已经退出，放回队列重新执行
+    retry_delay: 第一次重试的等待秒数，之后每次翻倍
+    initializer/initargs: 传给进程池，见 ProcessRunner
+    """
+
+    def __init__(self, execute, workers=2, poll_interval=5, max_attempts=5, lease=300, retry_delay=10,
+                 initializer=None, initargs=()):
+        self.execute = execute
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.retry_delay = retry_delay
+
+        self._handlers = {}
+        self._running = {}  # future -> 任务
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+        self._runner = ProcessRunner(workers, initializer, initargs)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.completed = 0
+        self.failed = 0
+
+    def register(self, kind, func, on_success, on_failure=None, fatal=()):
+        """
+        func: 在子进程中执行，以提交时的payload作为关键字参数，必须是模块级函数（或绑定了可pickle参数的functools.partial）
+        on_success(image_id, result) / on_failure(image_id, error): 在调度线程中执行，负责回写数据库
+        fatal: 这些异常重试也不会成功（比如图片超出解码预算），直接标记为失败
+        """
+        self._handlers[kind] = (func, on_success, on_failure, fatal)
+
+    # ---------- 提交 ----------
+    def enqueue(self, cursor, kind, image_id, **payload):
+        """在调用方的事务里写入任务，和图片记录一起提交；提交后调用 notify() 让调度线程马上处理"""
+        cursor.execute(
+            "INSERT INTO image_jobs (image_id, kind, payload, status) VALUES (%s, %s, %s, %s)",
+            (image_id, kind, json.dumps(payload), PENDING))
+        return cursor.lastrowid
+
+    def submit(self, kind, image_id, **payload):
+        """单独提交一个任务，返回任务ID，失败返回None"""
+        job_id = self.execute(
+            "INSERT INTO image_jobs (image_id, kind, payload, status) VALUES (%s, %s, %s, %s)",
+            (image_id, kind, json.dumps(payload), PENDING), commit=True)
+        if job_id:
+            self.notify()
+        return job_id
+
+    def notify(self):
+        self.start()
+        self._wakeup.set()
+
+    # ---------- 调度 ----------
+    def start(self):
+        """启动调度线程；fork出来的子进程（比如 gunicorn --preload）里没有父进程的线程，会重新启动"""
+        with self._lock:
+            if self._stopped or (self._thread is not None and self._pid == os.getpid()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='image-jobs', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self._collect()
+                self._recover_expired()
+                self._claim()
+            except Exception as e:
+                logger.error(f"图片任务调度出错: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _recover_expired(self):
+        """
+        租约过期的任务放回队列（执行它的进程可能已经崩溃或重启）
+        次数已经用完的标记为失败：让处理进程崩溃的图片（内存不足被杀、解码器段错误）不会无限循环
+        """
+        rows = self.execute("""
+            SELECT id, image_id, kind, attempts FROM image_jobs
+            WHERE status = %s AND locked_at < NOW() - INTERVAL %s SECOND AND attempts >= %s
+        """, (RUNNING, self.lease, self.max_attempts), fetch_all=True)
+        for job in rows or []:
+            message = f"执行超过 {self.lease} 秒未结束（处理进程可能已退出），已尝试 {job['attempts']} 次"
+            # 条件更新：多个进程可能同时在回收同一个任务
+            failed = self.execute("""
+                UPDATE image_jobs SET status = %s, locked_by = NULL, last_error = %s
+                WHERE id = %s AND status = %s
+            """, (FAILED, message, job['id'], RUNNING), commit=True, rowcount=True)
+            if failed == 1:
+                self._final_failure(job, RuntimeError(message))
+
+        self.execute("""
+            UPDATE image_jobs SET status = %s, locked_by = NULL
+            WHERE status = %s AND locked_at < NOW() - INTERVAL %s SECOND AND attempts < %s
+        """, (PENDING, RUNNING, self.lease, self.max_attempts), commit=True)
+
+    def _claim(self):
+        free = self.workers - len(self._running)
+        if free <= 0:
+            return
+        rows = self.execute("""
+            SELECT id, image_id, kind, payload, attempts FROM image_jobs
+            WHERE status = %s AND run_after <= NOW()
+            ORDER BY id
+            LIMIT %s
+        """, (PENDING, free), fetch_all=True)
+
+        for job in rows or []:
+            # 条件更新抢占任务，其他进程已经领走的会返回0行
+            claimed = self.execute("""
+                UPDATE image_jobs
+                SET status = %s, attempts = attempts + 1, locked_by = %s, locked_at = NOW()
+                WHERE id = %s AND status = %s
+            """, (RUNNING, self.worker_id, job['id'], PENDING), commit=True, rowcount=True)
+            if claimed != 1:
+                continue
+            job['attempts'] += 1
+            self._dispatch(job)
+
+    def _dispatch(self, job):
+        handler = self._handlers.get(job['kind'])
+        if handler is None:
+            self._fail(job, f"未知的任务类型: {job['kind']}", final=True)
+            return
+        payload = json.loads(job['payload'] or '{}')
+        try:
+            future = self._runner.submit(handler[0], **payload)
+        except BrokenProcessPool as e:
+            self._fail(job, e)
+            return
+        self._running[future] = job
+        future.add_done_callback(lambda _: self._wakeup.set())
+
+    def _collect(self):
+        """处理已经结束的任务"""
+        for future in [f for f in self._running if f.done()]:
+            job = self._running.pop(future)
+            error = future.exception()
+            if error is None:
+                self._succeed(job, future.result())
+            else:
+                if isinstance(error, BrokenProcessPool):
+                    self._runner.reset()
+                self._fail(job, error, final=isinstance(error, self._handlers[job['kind']][3]))
+
+    def _succeed(self, job, result):
+        on_success = self._handlers[job['kind']][1]
+        try:
+            on_success(job['image_id'], result)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        self.execute("UPDATE image_jobs SET status = %s, last_error = NULL WHERE id = %s",
+                     (DONE, job['id']), commit=True)
+        self.completed += 1
+
+    def _fail(self, job, error, final=False):
+        message = str(error)[:500] or error.__class__.__name__
+        if final or job['attempts'] >= self.max_attempts:
+            self.execute("UPDATE image_jobs SET status = %s, last_error = %s WHERE id = %s",
+                         (FAILED, message, job['id']), commit=True)
+            self._final_failure(job, error)
+            return
+
+        delay = min(self.retry_delay * 2 ** (job['attempts'] - 1), MAX_RETRY_DELAY)
+        logger.warning(f"图片任务 {job['id']} 第{job['attempts']}次执行失败，{delay}秒后重试: {message}")
+        self.execute("""
+            UPDATE image_jobs
+            SET status = %s, last_error = %s, locked_by = NULL, run_after = NOW() + INTERVAL %s SECOND
+            WHERE id = %s
+        """, (PENDING, message, delay, job['id']), commit=True)
+
+    def _final_failure(self, job, error):
+        """任务已标记为失败：记日志并调用失败回调"""
+        message = str(error)[:500] or error.__class__.__name__
+        logger.error(f"图片任务 {job['id']} ({job['kind']}, 图片 {job['image_id']}) 最终失败: {message}")
+        self.failed += 1
+        on_failure = self._handlers.get(job['kind'], (None, None, None, ()))[2]
+        if on_failure:
+            try:
+                on_failure(job['image_id'], error)
+            except Exception as e:
+                logger.error(f"图片任务失败回调出错: {e}")
+
+    # ---------- 管理 ----------
+    def shutdown(self):
+        """停止调度；正在执行的任务租约过期后由其他进程（或下次启动）重新执行"""
+        self._stopped = True
+        self._wakeup.set()
+        self._runner.shutdown()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'running': len(self._running),
+            'completed': self.completed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,352 @@
+"""
+图片处理
+在后台进程池中执行的CPU密集型函数：只依赖Pillow和文件路径，不访问数据库，参数和返回值都可以直接pickle
+注意 spawn 启动的子进程会以 __mp_main__ 的名字重新导入父进程的主模块：直接 python app.py 运行时
+子进程也会执行一遍 app.py 的模块级代码（gunicorn等WSGI服务器下主模块不是app.py，不受影响），
+所以 app.py 里只应在服务进程做的事（比如启动任务调度线程）要跳过 __mp_main__
+"""
+
+import os
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+try:
+    # 可选依赖：安装 pillow-avif-plugin 后才能编码AVIF
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+THUMBNAIL_SIZE = (300, 200)
+
+# 解码预算：像素数决定解码后占多少内存（RGBA每像素4字节），超出的图片在解码前拒绝
+# 进程池子进程里由 init_worker() 按应用配置覆盖
+MAX_PIXELS = 40 * 1000 * 1000
+MAX_FRAMES = 200
+
+# 接受上传的格式 -> 存储用的扩展名：按实际内容而不是上传时的文件名决定
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+# 文件开头的魔数 -> 格式，上传时先用它判断真实类型，不相信客户端声明的Content-Type和扩展名
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+SNIFF_BYTES = 12  # WebP: RIFF????WEBP
+
+# 同时解码的图片数，所有处理进程共用；None表示不限制（比如在命令行里直接调用）
+_decode_slots = None
+
+# 预缩小时至少保留目标尺寸的这么多倍，剩下的再用LANCZOS精确缩放，画质和直接从原图缩放看不出差别
+REDUCING_GAP = 2.0
+
+# EXIF Orientation -> 摆正需要的变换（与 ImageOps.exif_transpose 一致）
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# 各格式保存参数；GIF可能是动图，缩放会丢帧，不生成多尺寸版本
+RENDITION_FORMATS = {
+    'jpg': ('JPEG', {'quality': 82, 'progressive': True, 'optimize': True}),
+    'jpeg': ('JPEG', {'quality': 82, 'progressive': True, 'optimize': True}),
+    'png': ('PNG', {'optimize': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+# 额外编码的现代格式（扩展名, Pillow格式名, 保存参数），按压缩率从高到低
+# 文件名是在原文件名后面再加扩展名，比如 w640_abc.jpg.webp，由服务端按Accept头选择
+MODERN_FORMATS = [
+    ('avif', 'AVIF', {'quality': 55, 'speed': 6}),
+    ('webp', 'WEBP', {'quality': 78, 'method': 4}),
+]
+Image.init()
+MODERN_FORMATS = [item for item in MODERN_FORMATS if item[1] in Image.SAVE]
+
+
+def variant_name(filename, ext):
+    return f"{filename}.{ext}"
+
+
+def variant_names(filename):
+    """某个文件所有可能存在的现代格式版本"""
+    return [variant_name(filename, ext) for ext, _, _ in MODERN_FORMATS]
+
+
+class ImageRejected(ValueError):
+    """图片不合法或超出解码预算，重试也不会成功"""
+
+
+def init_worker(decode_slots, max_pixels, max_frames):
+    """进程池的initializer：设置解码名额和预算"""
+    global _decode_slots, MAX_PIXELS, MAX_FRAMES
+    _decode_slots = decode_slots
+    MAX_PIXELS = max_pixels
+    MAX_FRAMES = max_frames
+    # Pillow自己在打开文件时也会检查，超过2倍直接抛出DecompressionBombError
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+
+def _too_large(max_pixels=None):
+    return f"超过 {(max_pixels or MAX_PIXELS) // 1000000} 百万像素的上限"
+
+
+def check_limits(img, max_pixels=None, max_frames=None):
+    """
+    只根据文件头检查尺寸和帧数，不解码像素；超出预算抛出ImageRejected
+    动图数帧只解析每一帧的头，不解码
+    """
+    max_pixels = max_pixels or MAX_PIXELS
+    max_frames = max_frames or MAX_FRAMES
+    width, height = img.size
+    if width * height > max_pixels:
+        raise ImageRejected(f"图片尺寸 {width}x{height} {_too_large(max_pixels)}")
+    frames = getattr(img, 'n_frames', 1)
+    if frames > max_frames:
+        raise ImageRejected(f"动图帧数 {frames} 超过 {max_frames} 帧的上限")
+    return {'format': img.format, 'mime_type': Image.MIME.get(img.format), 'mode': img.mode,
+            'width': width, 'height': height, 'frames': frames}
+
+
+def sniff_format(head):
+    """按文件开头的魔数判断格式，返回 FORMAT_EXTENSIONS 里的格式名，不认识的返回None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    for magic, fmt in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def inspect_image(source, max_pixels=None, max_frames=None, formats=None):
+    """
+    读取文件头返回 {'format', 'mime_type', 'mode', 'width', 'height', 'frames'}，用于上传时在解码前拒绝超大图片
+    source 可以是路径或文件对象；formats 限定只按这些格式解析（比如 sniff_format 的结果）
+    不是图片或超出预算时抛出ImageRejected
+    """
+    try:
+        with Image.open(source, formats=formats) as img:
+            return check_limits(img, max_pixels, max_frames)
+    except UnidentifiedImageError as e:
+        raise ImageRejected('无法识别的图片文件') from e
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(f"图片尺寸{_too_large(max_pixels)}") from e
+    except (OSError, SyntaxError) as e:
+        # 文件头损坏时Pillow可能抛出这两种异常
+        raise ImageRejected(f"图片文件已损坏: {e}") from e
+
+
+@contextmanager
+def open_image(source_path):
+    """
+    打开图片并在解码前检查预算；占用一个解码名额直到退出，
+    同时解码的图片数有上限，每个进程的内存峰值也就有上限
+    """
+    if _decode_slots is not None:
+        _decode_slots.acquire()
+    try:
+        try:
+            img = Image.open(source_path)
+        except Image.DecompressionBombError as e:
+            raise ImageRejected(f"图片尺寸{_too_large()}") from e
+        with img:
+            check_limits(img)
+            yield img
+    finally:
+        if _decode_slots is not None:
+            _decode_slots.release()
+
+
+def _oriented_size(img):
+    """按EXIF方向摆正后的宽高，只读文件头，不解码像素"""
+    if img.getexif().get(ORIENTATION_TAG) in (5, 6, 7, 8):
+        return img.height, img.width
+    return img.size
+
+
+def _fit_scale(size, box, cover=False):
+    """把 size 缩放到 box 内（cover 时填满 box）的比例，只缩小不放大；box 某一边为None表示不限"""
+    ratios = [target / current for target, current in zip(box, size) if target]
+    return min(1, max(ratios) if cover else min(ratios))
+
+
+def open_scaled(img, scale):
+    """
+    解码刚打开的图片并按EXIF方向摆正，解码时就缩小到大约 原尺寸 * scale * REDUCING_GAP
+    JPEG用 draft() 让解码器在DCT域直接输出1/2、1/4、1/8尺寸；其他格式解码后用 reduce() 做整数倍缩小，
+    之后所有的缩放、转换、透明通道处理都在小图上进行，不会再产生原尺寸的副本
+    """
+    orientation = img.getexif().get(ORIENTATION_TAG)
+    if scale * REDUCING_GAP < 1:
+        wanted = (max(1, int(img.width * scale * REDUCING_GAP)), max(1, int(img.height * scale * REDUCING_GAP)))
+        if img.format == 'JPEG':
+            img.draft(None, wanted)
+        if img.mode in ('1', 'P'):
+            # 这几种模式不支持 reduce，先转换
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        elif img.mode.startswith('I;16'):
+            img = img.convert('I')
+        factor = min(img.width // wanted[0], img.height // wanted[1])
+        if factor >= 2:
+            img = img.reduce(factor)
+    img.load()
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    return img.transpose(method) if method is not None else img
+
+
+def _flatten_alpha(img):
+    """带透明通道的图片铺白底，JPEG不支持透明"""
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img
+
+
+def _save_atomic(img, path, fmt, **options):
+    """先写临时文件再重命名，其他请求不会读到写了一半的文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        img.save(tmp_path, fmt, **options)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(path)
+
+
+def rendition_name(filename, width):
+    return f"w{width}_{filename}"
+
+
+def _save_modern(img, path, source_format):
+    """把同一张图再编码成AVIF/WebP，返回生成的格式列表；原本就是该格式的跳过"""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    formats = []
+    for ext, fmt, options in MODERN_FORMATS:
+        if fmt == source_format:
+            continue
+        _save_atomic(img, variant_name(path, ext), fmt, **options)
+        formats.append(ext)
+    return formats
+
+
+def load_thumbnail(source_path, max_size=THUMBNAIL_SIZE):
+    """解码并缩小到 max_size 以内，返回摆正方向、透明部分铺了白底的缩略图"""
+    with open_image(source_path) as img:
+        img = open_scaled(img, _fit_scale(_oriented_size(img), max_size))
+        img.thumbnail(max_size, Image.LANCZOS)
+        return _flatten_alpha(img)
+
+
+def make_thumbnail(source_path, dest_dir, max_size=THUMBNAIL_SIZE):
+    """
+    生成缩略图，返回缩略图文件名
+    先写临时文件再重命名，其他请求不会读到写了一半的缩略图；失败时直接抛出异常，由任务队列决定是否重试
+    """
+    return _write_thumbnail(load_thumbnail(source_path, max_size), source_path, dest_dir)
+
+
+def _write_thumbnail(img, source_path, dest_dir):
+    """保存已经缩小好的缩略图"""
+    thumbnail_name = f"thumb_{os.path.basename(source_path)}"
+    os.makedirs(dest_dir, exist_ok=True)
+    thumbnail_path = os.path.join(dest_dir, thumbnail_name)
+    # 原格式版本保留给不支持新格式的浏览器
+    if thumbnail_name.lower().endswith(('.jpg', '.jpeg')):
+        _save_atomic(img, thumbnail_path, 'JPEG', quality=85)
+    else:
+        _save_atomic(img, thumbnail_path, 'PNG')
+    _save_modern(img, thumbnail_path, None)
+    return thumbnail_name
+
+
+def make_renditions(source_path, dest_dir, widths, max_size=THUMBNAIL_SIZE):
+    """
+    一次解码生成缩略图和多个宽度的版本
+    解码时直接缩小到最大一档够用的尺寸（见 open_scaled）；只生成比原图窄的宽度，
+    从大到小依次缩放，每一档和最后的缩略图都从上一档缩小，比每次都从原图缩快得多
+    每一档除了原格式，还会编码AVIF（可用时）和WebP版本
+    返回 {'thumbnail': 缩略图文件名, 'renditions': [{'width', 'height', 'filename', 'file_size', 'formats'}, ...]}
+    """
+    filename = os.path.basename(source_path)
+    ext = filename.rsplit('.', 1)[-1].lower()
+    renditions = []
+    os.makedirs(dest_dir, exist_ok=True)
+
+    with open_image(source_path) as img:
+        size = _oriented_size(img)
+        fmt = RENDITION_FORMATS.get(ext)
+        if fmt is None or getattr(img, 'is_animated', False):
+            targets = []
+        else:
+            targets = sorted({width for width in widths if width < size[0]}, reverse=True)
+        # 没有要生成的宽度时只需要缩略图大小
+        scale = targets[0] / size[0] if targets else _fit_scale(size, max_size)
+        current = open_scaled(img, scale)
+
+    # 调色板图片只能用最近邻缩放，先转成RGBA
+    if current.mode in ('1', 'P'):
+        current = current.convert('RGBA')
+    for width in targets:
+        height = max(1, round(current.height * width / current.width))
+        current = current.resize((width, height), Image.LANCZOS)
+        out = _flatten_alpha(current) if fmt[0] == 'JPEG' else current
+        name = rendition_name(filename, width)
+        path = os.path.join(dest_dir, name)
+        file_size = _save_atomic(out, path, fmt[0], **fmt[1])
+        formats = _save_modern(current, path, fmt[0])
+        renditions.append({'width': width, 'height': height, 'filename': name,
+                           'file_size': file_size, 'formats': formats})
+
+    current.thumbnail(max_size, Image.LANCZOS)
+    thumbnail_name = _write_thumbnail(_flatten_alpha(current), source_path, dest_dir)
+
+    renditions.reverse()
+    return {'thumbnail': thumbnail_name, 'renditions': renditions}
+
+
+# 按需变换支持的输出格式（参数名 -> Pillow格式名, 保存参数, MIME类型）
+TRANSFORM_FORMATS = {
+    'jpeg': ('JPEG', {'quality': 82, 'progressive': True}, 'image/jpeg'),
+    'png': ('PNG', {}, 'image/png'),
+    'webp': ('WEBP', {'quality': 78, 'method': 4}, 'image/webp'),
+    'avif': ('AVIF', {'quality': 55, 'speed': 6}, 'image/avif'),
+}
+TRANSFORM_FORMATS = {key: value for key, value in TRANSFORM_FORMATS.items() if value[0] in Image.SAVE}
+
+
+def transform_image(source_path, dest_path, width=None, height=None, fit='contain', fmt='jpeg'):
+    """
+    按需生成一个尺寸/格式变体，写到 dest_path
+    contain: 等比缩放到框内；cover: 等比缩放并居中裁剪，正好填满 width x height
+    只缩小不放大：原图比目标小时，cover 按原图能提供的最大尺寸裁剪同样的比例
+    """
+    pil_format, options, _ = TRANSFORM_FORMATS[fmt]
+    cover = bool(width and height and fit == 'cover')
+    with open_image(source_path) as img:
+        img = open_scaled(img, _fit_scale(_oriented_size(img), (width, height), cover))
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+
+        if cover:
+            scale = min(1, img.width / width, img.height / height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            img = ImageOps.fit(img, size, Image.LANCZOS)
+        else:
+            img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+
+        if pil_format == 'JPEG':
+            img = _flatten_alpha(img)
+        _save_atomic(img, dest_path, pil_format, **options)
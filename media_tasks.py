@@ -0,0 +1,39 @@
+"""
+在处理进程里执行的图片任务：从存储后端取原图，处理结果写回存储后端
+存储对象由 functools.partial 绑定为第一个参数（可以pickle），其余参数来自任务的payload；
+本地存储时直接读写上传目录，对象存储时先下载到临时目录处理，再把生成的文件上传
+"""
+
+import blob_store
+import image_processing
+
+
+def resolve_key(storage, key):
+    """
+    执行时再确定原图位置：任务提交时记录的平铺key（uploads-migrate 之前的旧文件），
+    在排队期间可能已经被迁移命令移到分片目录
+    """
+    if '/' not in key and not storage.exists(key):
+        return blob_store.shard_path(key)
+    return key
+
+
+def make_renditions(storage, key=None, widths=(), max_size=image_processing.THUMBNAIL_SIZE,
+                    source_path=None, dest_dir=None):
+    """
+    生成缩略图和多尺寸版本，返回值同 image_processing.make_renditions
+    生成的文件总是写到分片目录（和数据库里记录的 thumbnail_path 一致），原图还没迁移时也一样
+    source_path/dest_dir 是改用存储后端之前提交的任务（只有本地存储），原样处理
+    """
+    if source_path is not None:
+        return image_processing.make_renditions(source_path, dest_dir, widths, max_size)
+    key = resolve_key(storage, key)
+    prefix = blob_store.shard_path(key.rsplit('/', 1)[-1]).rsplit('/', 1)[0]
+    with storage.local_copy(key) as path, storage.writable_dir(prefix) as directory:
+        return image_processing.make_renditions(path, directory, widths, max_size)
+
+
+def transform_image(storage, key, dest_path, **options):
+    """按需变换：结果写到本机的变换缓存 dest_path，参数同 image_processing.transform_image"""
+    with storage.local_copy(resolve_key(storage, key)) as path:
+        image_processing.transform_image(path, dest_path, **options)
@@ -0,0 +1,182 @@
+"""
+图片全文搜索
+基于 MySQL FULLTEXT 索引 + ngram 分词（默认二元切分，中文不需要额外分词），按相关度排序
+索引由InnoDB在INSERT/UPDATE/DELETE时自动增量维护，rebuild() 用于清理删除残留或修改分词参数后重建
+筛选条件（作者、日期、文件类型、最少点赞数）都落在 images 的组合索引上，分面统计一条SQL算完
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'ft_images_text'
+NGRAM_TOKEN_SIZE = 2  # 与MySQL的ngram_token_size保持一致
+
+LIKES_BUCKETS = (100, 10, 1)  # "最少点赞数"筛选的档位，从大到小
+FACET_USER_LIMIT = 10         # 作者分面最多列出几位
+FACET_MONTH_LIMIT = 12        # 日期分面最多列出几个月
+
+# BOOLEAN MODE 下有特殊含义的字符
+_BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]')
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class FulltextSearch:
+    """
+    execute: 与 app.execute_query 签名一致的查询函数
+
+    build() 生成的子查询统一输出这些列，外层按 (sort_column(), id) 倒序负责分页和排序：
+    id, filename, original_name, file_path, thumbnail_path, mime_type, title, description,
+    upload_time, views, likes, user_id, username, score
+
+    filters 是 app.parse_search_filters() 的结果，支持的键：
+    user（用户名）、mime_type、date_from、date_to（不含）、min_likes
+    """
+
+    COLUMNS = """
+        i.id, i.filename, i.original_name, i.file_path, i.thumbnail_path, i.mime_type,
+        i.title, i.description, i.upload_time, i.views, i.likes, i.user_id, u.username
+    """
+
+    def __init__(self, execute):
+        self.execute = execute
+
+    # ---------- 索引维护 ----------
+    def has_index(self):
+        rows = self.execute(
+            "SHOW INDEX FROM images WHERE Key_name = %s", (INDEX_NAME,), fetch_all=True)
+        return bool(rows)
+
+    def ensure_index(self):
+        """索引不存在时创建（已有数据量大时会比较慢，只在初始化时调用）"""
+        if self.has_index():
+            return False
+        self.execute(
+            f"ALTER TABLE images ADD FULLTEXT INDEX {INDEX_NAME} (title, description) WITH PARSER ngram",
+            commit=True)
+        logger.info(f"创建全文索引 {INDEX_NAME} 成功")
+        return True
+
+    def rebuild(self):
+        """删除并重建全文索引"""
+        if self.has_index():
+            self.execute(f"ALTER TABLE images DROP INDEX {INDEX_NAME}", commit=True)
+        return self.ensure_index()
+
+    # ---------- 查询 ----------
+    @staticmethod
+    def sort_column(query_text):
+        """
+        结果的排序列：有关键词按相关度；只有筛选条件时相关度都是0，按上传时间，
+        这时子查询没有UNION，MySQL会把它合并进外层查询，排序直接用上 idx_user_time/idx_mime_time/idx_upload_time
+        """
+        return 'score' if query_text else 'upload_time'
+
+    def _match_clause(self, query_text):
+        """
+        生成 MATCH 条件和参数
+        关键词短于ngram长度时自然语言模式搜不到，改用布尔模式前缀匹配；
+        只有布尔运算符（比如 "*"、'""'）时返回 (None, None)：布尔模式下单独的 "*" 是语法错误
+        """
+        compact = ''.join(query_text.split())
+        term = _BOOLEAN_OPERATORS.sub('', compact)
+        if not term:
+            return None, None
+        if len(compact) < NGRAM_TOKEN_SIZE:
+            return "MATCH(i.title, i.description) AGAINST (%s IN BOOLEAN MODE)", f"{term}*"
+        return "MATCH(i.title, i.description) AGAINST (%s IN NATURAL LANGUAGE MODE)", query_text
+
+    @staticmethod
+    def _filter_clause(filters):
+        """
+        生成筛选条件，每个条件都能用上对应的组合索引：
+        作者 idx_user_time、类型 idx_mime_time、日期 idx_upload_time、点赞 idx_likes；
+        前三个索引的 (upload_time, id) 顺序同时用于没有关键词时的排序，翻页不用额外排序
+        """
+        conditions = []
+        params = []
+        if filters.get('user'):
+            # 标量子查询只执行一次，结果当常量用，i.user_id 可以走索引
+            conditions.append("i.user_id = (SELECT id FROM users WHERE username = %s)")
+            params.append(filters['user'])
+        if filters.get('mime_type'):
+            conditions.append("i.mime_type = %s")
+            params.append(filters['mime_type'])
+        if filters.get('date_from'):
+            conditions.append("i.upload_time >= %s")
+            params.append(filters['date_from'])
+        if filters.get('date_to'):
+            conditions.append("i.upload_time < %s")
+            params.append(filters['date_to'])
+        if filters.get('min_likes'):
+            conditions.append("i.likes >= %s")
+            params.append(filters['min_likes'])
+        return ''.join(f" AND {condition}" for condition in conditions), params
+
+    def build(self, query_text, filters=None):
+        """
+        返回 (子查询SQL, 参数)
+        标题/描述走全文索引并按相关度打分；用户名走 idx_username 前缀匹配，
+        只补充全文没有命中的图片，两部分不会重复
+        没有关键词只有筛选条件时直接按筛选条件查，相关度都为0
+        关键词只有布尔运算符、不可能有结果时返回 (None, ())，调用方不用查询数据库
+        """
+        filter_sql, filter_params = self._filter_clause(filters or {})
+
+        if not query_text:
+            sql = f"""
+                SELECT {self.COLUMNS}, 0 AS score
+                FROM images i
+                LEFT JOIN users u ON i.user_id = u.id
+                WHERE 1 = 1{filter_sql}
+            """
+            return sql, tuple(filter_params)
+
+        match_sql, match_param = self._match_clause(query_text)
+        if match_sql is None:
+            return None, ()
+        username_param = f"{_escape_like(query_text)}%"
+
+        sql = f"""
+            SELECT {self.COLUMNS}, ROUND({match_sql}, 6) AS score
+            FROM images i
+            LEFT JOIN users u ON i.user_id = u.id
+            WHERE {match_sql}{filter_sql}
+            UNION ALL
+            SELECT {self.COLUMNS}, 0 AS score
+            FROM users u
+            JOIN images i ON i.user_id = u.id
+            WHERE u.username LIKE %s AND NOT {match_sql}{filter_sql}
+        """
+        params = (match_param, match_param, *filter_params,
+                  username_param, match_param, *filter_params)
+        return sql, params
+
+    @staticmethod
+    def facets(search_sql):
+        """
+        分面统计SQL：搜索结果物化一次（CTE），再按类型/作者/月份/点赞档位分别分组，
+        一次查询返回所有分面，每行是 (facet, value, hits)
+        类型分面覆盖全部结果，各值之和就是结果总数，不需要再单独COUNT
+        """
+        likes_case = ' '.join(f"WHEN likes >= {n} THEN {n}" for n in LIKES_BUCKETS)
+        return f"""
+            WITH r AS ({search_sql})
+            SELECT 'type' AS facet, mime_type AS value, COUNT(*) AS hits
+            FROM r GROUP BY mime_type
+            UNION ALL
+            (SELECT 'user', username, COUNT(*) AS hits
+             FROM r WHERE username IS NOT NULL GROUP BY username
+             ORDER BY hits DESC LIMIT {FACET_USER_LIMIT})
+            UNION ALL
+            (SELECT 'month', DATE_FORMAT(upload_time, '%%Y-%%m') AS month, COUNT(*)
+             FROM r WHERE upload_time IS NOT NULL GROUP BY month
+             ORDER BY month DESC LIMIT {FACET_MONTH_LIMIT})
+            UNION ALL
+            SELECT 'likes', CAST(CASE {likes_case} ELSE 0 END AS CHAR) AS bucket, COUNT(*)
+            FROM r GROUP BY bucket
+        """
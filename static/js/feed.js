@@ -0,0 +1,80 @@
+// 首页无限滚动：#feedMore 进入视口时按游标请求 /api/feed，把新卡片追加到 #feedGrid
+(function() {
+    var grid = document.getElementById('feedGrid');
+    var more = document.getElementById('feedMore');
+    if (!grid || !more || !window.fetch || !('IntersectionObserver' in window)) {
+        return;
+    }
+
+    var loading = false;
+    // 与 _macros.html 中 show_image 的默认 sizes 保持一致
+    var CARD_SIZES = '(min-width: 992px) 33vw, (min-width: 768px) 50vw, 100vw';
+
+    function escapeHtml(text) {
+        var div = document.createElement('div');
+        div.textContent = text == null ? '' : String(text);
+        return div.innerHTML;
+    }
+
+    function renderCard(item) {
+        var fallback = "this.onerror=null;this.removeAttribute('srcset');this.src='" + item.image_url + "';";
+        var html = '<div class="col"><div class="card h-100 shadow-sm">' +
+            '<div class="img-container"><a href="/image/' + item.id + '">' +
+            '<img src="' + escapeHtml(item.thumbnail_url || item.image_url) + '" class="card-img-top" loading="lazy"' +
+            (item.srcset ? ' srcset="' + escapeHtml(item.srcset) + '" sizes="' + CARD_SIZES + '"' : '') +
+            ' alt="' + escapeHtml(item.title) + '" onerror="' + escapeHtml(fallback) + '"></a></div>' +
+            '<div class="card-body">' +
+            '<h5 class="card-title">' + escapeHtml(item.title) + '</h5>' +
+            '<p class="card-text text-truncate-2">' + escapeHtml(item.description || '暂无描述') + '</p>' +
+            '</div>' +
+            '<div class="card-footer bg-transparent">' +
+            '<div class="d-flex justify-content-between align-items-center"><div>' +
+            '<a href="/like/' + item.id + '" class="btn btn-outline-primary btn-sm js-like' + (item.liked_by_me ? ' active' : '') +
+            '" data-image-id="' + item.id + '"><i class="bi bi-hand-thumbs-up"></i> <span class="js-like-count">' + item.likes + '</span></a>' +
+            '<a href="/image/' + item.id + '" class="btn btn-outline-secondary btn-sm ms-1"><i class="bi bi-eye"></i> ' + item.views + '</a>' +
+            '</div><small class="text-muted"><i class="bi bi-calendar"></i> ' + escapeHtml(item.upload_time || '未知时间') + '</small></div>';
+        if (item.can_delete) {
+            html += '<form action="/delete/' + item.id + '" method="POST" class="mt-2" onsubmit="return confirm(\'确定要删除这张图片吗？\');">' +
+                '<button type="submit" class="btn btn-danger btn-sm w-100"><i class="bi bi-trash"></i> 删除</button></form>';
+        }
+        return html + '</div></div></div>';
+    }
+
+    function loadMore() {
+        var cursor = more.dataset.nextCursor;
+        if (loading || !cursor) {
+            return;
+        }
+        loading = true;
+        fetch('/api/feed?cursor=' + encodeURIComponent(cursor), {credentials: 'same-origin'})
+            .then(function(response) {
+                if (!response.ok) {
+                    throw new Error('HTTP ' + response.status);
+                }
+                return response.json();
+            })
+            .then(function(data) {
+                grid.insertAdjacentHTML('beforeend', data.items.map(renderCard).join(''));
+                if (data.next_cursor) {
+                    more.dataset.nextCursor = data.next_cursor;
+                    more.querySelector('a').href = '/?cursor=' + encodeURIComponent(data.next_cursor);
+                } else {
+                    observer.disconnect();
+                    more.remove();
+                }
+            })
+            .catch(function() {
+                // 失败时保留“加载更多”链接，用户可以手动翻页
+            })
+            .finally(function() {
+                loading = false;
+            });
+    }
+
+    var observer = new IntersectionObserver(function(entries) {
+        if (entries[0].isIntersecting) {
+            loadMore();
+        }
+    }, {rootMargin: '600px 0px'});
+    observer.observe(more);
+})();
@@ -0,0 +1,47 @@
+// 点赞按钮：通过 /api/like/<id> 异步切换，只更新按钮本身，不再整页跳转
+// 按钮写法：<a href="/like/1" class="js-like" data-image-id="1"><span class="js-like-count">3</span></a>
+document.addEventListener('click', function(event) {
+    var button = event.target.closest('.js-like');
+    if (!button || !window.fetch) {
+        return;
+    }
+    event.preventDefault();
+    if (button.dataset.pending) {
+        return;
+    }
+    button.dataset.pending = '1';
+
+    var imageId = button.dataset.imageId;
+    fetch('/api/like/' + imageId, {
+        method: 'POST',
+        headers: {'X-Requested-With': 'XMLHttpRequest'},
+        credentials: 'same-origin'
+    }).then(function(response) {
+        return response.json().then(function(data) {
+            return {status: response.status, data: data};
+        });
+    }).then(function(result) {
+        if (result.status === 401) {
+            window.location.href = result.data.login_url + '?next=' + encodeURIComponent(window.location.pathname);
+            return;
+        }
+        if (result.status !== 200) {
+            alert(result.data.error || '操作失败，请稍后重试');
+            return;
+        }
+        document.querySelectorAll('.js-like[data-image-id="' + imageId + '"]').forEach(function(el) {
+            el.classList.toggle('active', result.data.liked);
+            el.querySelectorAll('.js-like-count').forEach(function(count) {
+                count.textContent = result.data.likes;
+            });
+        });
+        document.querySelectorAll('.js-like-total[data-image-id="' + imageId + '"]').forEach(function(el) {
+            el.textContent = result.data.likes;
+        });
+    }).catch(function() {
+        // 接口不可用时退回普通链接
+        window.location.href = button.href;
+    }).finally(function() {
+        delete button.dataset.pending;
+    });
+});
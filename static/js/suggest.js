@@ -0,0 +1,53 @@
+// 搜索框联想：输入时请求 /api/suggest，用 datalist 展示候选词
+(function() {
+    if (!window.fetch) {
+        return;
+    }
+
+    var cache = {};
+
+    function attach(input, index) {
+        var list = document.createElement('datalist');
+        list.id = 'searchSuggest' + index;
+        input.setAttribute('list', list.id);
+        input.setAttribute('autocomplete', 'off');
+        input.parentNode.appendChild(list);
+
+        var timer = null;
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            var q = input.value.trim();
+            if (!q) {
+                list.innerHTML = '';
+                return;
+            }
+            timer = setTimeout(function() {
+                if (cache[q]) {
+                    render(list, cache[q]);
+                    return;
+                }
+                fetch('/api/suggest?q=' + encodeURIComponent(q))
+                    .then(function(response) { return response.json(); })
+                    .then(function(data) {
+                        cache[q] = data.suggestions || [];
+                        if (input.value.trim() === q) {
+                            render(list, cache[q]);
+                        }
+                    })
+                    .catch(function() {});
+            }, 120);
+        });
+    }
+
+    function render(list, suggestions) {
+        list.innerHTML = '';
+        suggestions.forEach(function(item) {
+            var option = document.createElement('option');
+            option.value = item.text;
+            option.label = item.type === 'user' ? '用户' : (item.type === 'tag' ? '标签' : '图片');
+            list.appendChild(option);
+        });
+    }
+
+    document.querySelectorAll('form[action="/search"] input[name="q"]').forEach(attach);
+})();
@@ -0,0 +1,446 @@
+"""
+上传文件存储后端
+LocalStorage: 本机目录（默认），文件可以直接交给静态文件服务
+S3Storage: 兼容S3 API的对象存储（AWS S3、MinIO、COS/OSS的S3兼容接口等），多台Web节点共用一份图片；
+    只用标准库实现（http.client + SigV4签名），不引入SDK
+
+key 是上传目录下的相对路径（比如 "ab/cd/<文件名>"），两种后端一致
+存储对象只保存配置，可以pickle后传给处理进程
+"""
+
+import base64
+import hashlib
+import hmac
+import http.client
+import mimetypes
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StorageError(Exception):
+    """存储后端出错"""
+
+
+class ObjectNotFound(StorageError, FileNotFoundError):
+    """对象不存在；同时是 FileNotFoundError，按文件处理的调用方不用区分后端"""
+
+
+class RangeNotSatisfiable(StorageError):
+    """请求的范围起点超出对象大小"""
+
+
+class StoredObject:
+    """
+    读取结果：body 是按块产生数据的迭代器，读完或调用 close() 后释放连接/文件
+    start/end 是实际返回的字节范围（含两端），size 是对象总大小
+    """
+
+    def __init__(self, body, size, start, end, content_type=None, etag=None, last_modified=None, close=None):
+        self.body = body
+        self.size = size
+        self.start = start
+        self.end = end
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self._close = close
+
+    @property
+    def length(self):
+        return self.end - self.start + 1 if self.size else 0
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+
+def join_key(prefix, name):
+    """拼接key，prefix 为空表示根目录"""
+    return f"{prefix}/{name}" if prefix else name
+
+
+def _iter_file(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _resolve_range(size, start, end):
+    """把请求的范围限制在对象大小以内；start 为None表示从头读"""
+    if start is None:
+        return 0, size - 1
+    if start >= size:
+        raise RangeNotSatisfiable(f"范围起点 {start} 超出对象大小 {size}")
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+class LocalStorage:
+    """本机目录；local_root 不为None，调用方可以直接按路径读写（静态文件服务、Pillow）"""
+
+    name = 'local'
+
+    def __init__(self, root):
+        self.local_root = root
+
+    def path(self, key):
+        return os.path.join(self.local_root, *key.split('/'))
+
+    def put(self, key, stream, size=None, content_type=None):
+        """从文件对象流式写入：先写临时文件再重命名，读的一方不会看到写了一半的文件"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_file(self, key, source_path, content_type=None, move=False):
+        """上传本地文件；move=True 时直接重命名过去（同一文件系统上不复制）"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if move:
+            os.replace(source_path, path)
+        else:
+            with open(source_path, 'rb') as f:
+                self.put(key, f)
+
+    def get(self, key, start=None, end=None):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise ObjectNotFound(key) from None
+        stat = os.fstat(f.fileno())
+        try:
+            start, end = _resolve_range(stat.st_size, start, end)
+        except RangeNotSatisfiable:
+            f.close()
+            raise
+        f.seek(start)
+        return StoredObject(_iter_file(f, end - start + 1), stat.st_size, start, end,
+                            etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                            last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                            close=f.close)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        """对象的字节数，不存在返回None"""
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete_many(self, keys):
+        """删除一批对象，不存在的忽略，返回删除的个数"""
+        deleted = 0
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    @contextmanager
+    def local_copy(self, key):
+        """本地文件路径，用于Pillow等只认路径的代码；本地后端直接返回原文件"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise ObjectNotFound(key)
+        yield path
+
+    @contextmanager
+    def writable_dir(self, prefix):
+        """往某个目录写一批文件：本地后端直接给出目标目录"""
+        path = self.path(prefix) if prefix else self.local_root
+        os.makedirs(path, exist_ok=True)
+        yield path
+
+
+class S3Storage:
+    """
+    endpoint: 服务地址，比如 https://s3.amazonaws.com 或 http://minio:9000；用路径风格访问（/bucket/key）
+    prefix: 对象key的公共前缀，多个环境共用一个bucket时用来区分
+    part_size: 超过这个大小的对象用分片上传，每次只在内存里保留一个分片
+    每个请求用一个新连接，对象可以跨线程、跨进程使用
+    """
+
+    name = 's3'
+    local_root = None
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', prefix='',
+                 timeout=30, part_size=16 * 1024 * 1024):
+        parts = urlsplit(endpoint)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip('/')
+        self.timeout = timeout
+        self.part_size = part_size
+
+    # ---------- 签名与请求 ----------
+    def _object_name(self, key):
+        return join_key(self.prefix, key)
+
+    def _object_path(self, key):
+        return '/' + quote(self.bucket, safe='') + '/' + quote(self._object_name(key), safe='/~')
+
+    def _sign(self, method, path, query, headers, payload_hash):
+        """AWS Signature Version 4，返回 Authorization 头"""
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        headers['host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+
+        signed = sorted(name for name in headers if name in ('host', 'content-md5') or name.startswith('x-amz-'))
+        canonical_query = '&'.join(
+            f"{quote(k, safe='~')}={quote(str(v), safe='~')}" for k, v in sorted(query.items()))
+        canonical_request = '\n'.join([
+            method, path, canonical_query,
+            ''.join(f"{name}:{str(headers[name]).strip()}\n" for name in signed),
+            ';'.join(signed), payload_hash,
+        ])
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                f"SignedHeaders={';'.join(signed)}, Signature={signature}")
+
+    def _request(self, method, path, query=None, headers=None, body=None, payload_hash='UNSIGNED-PAYLOAD',
+                 expect=(200,)):
+        """发送请求，状态码在 expect 中时返回 (连接, 响应)，由调用方读完响应后关闭连接"""
+        query = query or {}
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        headers['authorization'] = self._sign(method, path, query, headers, payload_hash)
+        url = path
+        if query:
+            url += '?' + '&'.join(
+                f"{quote(k, safe='~')}={quote(str(v), safe='~')}" if v != '' else quote(k, safe='~')
+                for k, v in sorted(query.items()))
+
+        conn_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        conn = conn_class(self.host, timeout=self.timeout)
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise StorageError(f"对象存储请求失败: {method} {path}: {e}") from e
+
+        if response.status in expect:
+            return conn, response
+        detail = response.read()
+        conn.close()
+        if response.status == 404:
+            raise ObjectNotFound(path)
+        raise StorageError(f"对象存储返回 {response.status}: {method} {path}: {self._error_message(detail)}")
+
+    @staticmethod
+    def _error_message(body):
+        try:
+            root = ElementTree.fromstring(body)
+            return f"{root.findtext('Code')}: {root.findtext('Message')}"
+        except ElementTree.ParseError:
+            return body[:200].decode('utf-8', 'replace')
+
+    def _call(self, method, path, **kwargs):
+        conn, response = self._request(method, path, **kwargs)
+        try:
+            return response, response.read()
+        finally:
+            conn.close()
+
+    # ---------- 写入 ----------
+    def put(self, key, stream, size=None, content_type=None):
+        """从文件对象流式上传；不知道大小或超过 part_size 时分片上传"""
+        headers = {'content-type': content_type or mimetypes.guess_type(key)[0] or 'application/octet-stream'}
+        if size is not None and size <= self.part_size:
+            headers['content-length'] = str(size)
+            self._call('PUT', self._object_path(key), headers=headers, body=stream)
+            return
+        self._put_multipart(key, stream, headers)
+
+    def _put_multipart(self, key, stream, headers):
+        path = self._object_path(key)
+        _, body = self._call('POST', path, query={'uploads': ''}, headers=headers)
+        upload_id = self._find(ElementTree.fromstring(body), 'UploadId')
+        parts = []
+        try:
+            while True:
+                chunk = stream.read(self.part_size)
+                if not chunk and parts:
+                    break
+                number = len(parts) + 1
+                response, _ = self._call('PUT', path, query={'partNumber': number, 'uploadId': upload_id},
+                                         headers={'content-length': str(len(chunk))}, body=chunk,
+                                         payload_hash=hashlib.sha256(chunk).hexdigest())
+                parts.append((number, response.getheader('ETag')))
+                if len(chunk) < self.part_size:
+                    break
+            xml = '<CompleteMultipartUpload>' + ''.join(
+                f"<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>" for n, etag in parts
+            ) + '</CompleteMultipartUpload>'
+            data = xml.encode()
+            self._call('POST', path, query={'uploadId': upload_id}, body=data,
+                       headers={'content-length': str(len(data))}, payload_hash=hashlib.sha256(data).hexdigest())
+        except BaseException:
+            try:
+                self._call('DELETE', path, query={'uploadId': upload_id}, expect=(200, 204))
+            except StorageError:
+                pass
+            raise
+
+    @staticmethod
+    def _find(root, tag):
+        """忽略XML命名空间查找第一个同名元素的文本"""
+        for element in root.iter():
+            if element.tag.rsplit('}', 1)[-1] == tag:
+                return element.text
+        return None
+
+    def put_file(self, key, source_path, content_type=None, move=False):
+        """上传本地文件；move=True 时上传成功后删除本地文件"""
+        with open(source_path, 'rb') as f:
+            self.put(key, f, size=os.fstat(f.fileno()).st_size, content_type=content_type)
+        if move:
+            os.remove(source_path)
+
+    # ---------- 读取 ----------
+    def get(self, key, start=None, end=None):
+        headers = {}
+        if start is not None:
+            headers['range'] = f"bytes={start}-{'' if end is None else end}"
+        conn, response = self._request('GET', self._object_path(key), headers=headers, expect=(200, 206, 416))
+        if response.status == 416:
+            conn.close()
+            raise RangeNotSatisfiable(f"范围起点 {start} 超出对象大小")
+
+        length = int(response.getheader('Content-Length', 0))
+        if response.status == 206:
+            # Content-Range: bytes 0-99/1234
+            range_part, total = response.getheader('Content-Range').split(' ', 1)[1].split('/')
+            first, last = (int(v) for v in range_part.split('-'))
+            size = int(total)
+        else:
+            first, last, size = 0, length - 1, length
+        modified = response.getheader('Last-Modified')
+
+        def body():
+            try:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                conn.close()
+
+        return StoredObject(body(), size, first, last,
+                            content_type=response.getheader('Content-Type'),
+                            etag=response.getheader('ETag'),
+                            last_modified=parsedate_to_datetime(modified) if modified else None,
+                            close=conn.close)
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def size(self, key):
+        """对象的字节数（HEAD请求），不存在返回None"""
+        try:
+            response, _ = self._call('HEAD', self._object_path(key))
+        except ObjectNotFound:
+            return None
+        return int(response.getheader('Content-Length', 0))
+
+    # ---------- 删除 ----------
+    def delete_many(self, keys):
+        """批量删除（DeleteObjects，每批最多1000个），不存在的对象不算错误，返回请求删除的个数"""
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            objects = ''.join(
+                f"<Object><Key>{xml_escape(self._object_name(key))}</Key></Object>"
+                for key in batch)
+            data = f'<Delete><Quiet>true</Quiet>{objects}</Delete>'.encode()
+            _, body = self._call('POST', '/' + quote(self.bucket, safe=''), query={'delete': ''}, body=data,
+                                 headers={'content-length': str(len(data)),
+                                          'content-md5': base64.b64encode(hashlib.md5(data).digest()).decode()},
+                                 payload_hash=hashlib.sha256(data).hexdigest())
+            error = self._find(ElementTree.fromstring(body), 'Error') if body else None
+            if error is not None:
+                raise StorageError(f"批量删除失败: {body[:300].decode('utf-8', 'replace')}")
+        return len(keys)
+
+    # ---------- 本地处理 ----------
+    @contextmanager
+    def local_copy(self, key):
+        """下载到临时目录供Pillow读取（文件名和key的最后一段相同），退出时删除"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, key.rsplit('/', 1)[-1])
+            obj = self.get(key)
+            with open(path, 'wb') as f:
+                for chunk in obj.body:
+                    f.write(chunk)
+            yield path
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @contextmanager
+    def writable_dir(self, prefix):
+        """先写到临时目录，正常退出时把目录里的文件都上传到 prefix 下"""
+        directory = tempfile.mkdtemp()
+        try:
+            yield directory
+            for name in os.listdir(directory):
+                self.put_file(join_key(prefix, name), os.path.join(directory, name))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def create_storage(config):
+    """按应用配置创建存储后端"""
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if backend == 's3':
+        return S3Storage(
+            config['STORAGE_S3_ENDPOINT'], config['STORAGE_S3_BUCKET'],
+            config['STORAGE_S3_ACCESS_KEY'], config['STORAGE_S3_SECRET_KEY'],
+            region=config.get('STORAGE_S3_REGION') or 'us-east-1',
+            prefix=config.get('STORAGE_S3_PREFIX') or '')
+    raise ValueError(f"未知的存储后端: {backend}")
+
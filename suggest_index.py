@@ -0,0 +1,209 @@
+"""
+搜索联想
+内存中的前缀索引（有序数组 + bisect），覆盖图片标题、标签名和用户名，按热度排序
+查询完全不访问数据库；上传/删除时增量更新，定时从数据库全量刷新热度
+"""
+
+import bisect
+import heapq
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_SCAN = 5000        # 单次查询最多扫描的前缀匹配条目数
+RETRY_INTERVAL = 30    # 加载失败后多少秒内不再重试
+RESULT_CACHE_SIZE = 2048
+SHORT_PREFIX = 2       # 不超过这个长度的前缀匹配项太多，预先算好热度前TOP_K名
+TOP_K = 20
+
+
+def normalize(text):
+    return ' '.join((text or '').split()).lower()
+
+
+class _Term:
+    __slots__ = ('kind', 'text', 'contrib', 'score')
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+        self.contrib = {}   # 来源ID -> 热度，同名标题/用户名按来源累加
+        self.score = 0
+
+
+class SuggestIndex:
+    """
+    loader: 全量加载函数，返回 [(kind, text, source_id, score), ...]，
+            kind 为 'image' / 'tag' / 'user'；加载失败返回None
+    refresh_interval: 全量刷新间隔（秒）
+    """
+
+    def __init__(self, loader, refresh_interval=600):
+        self._loader = loader
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._keys = []     # 有序的 (前缀键, term_key)
+        self._terms = {}    # term_key -> _Term
+        self._results = {}  # (前缀, limit) -> 结果缓存，索引变动时清空
+        self._top = {}      # 短前缀 -> 按热度排好的 term_key 列表
+        self._loaded_at = None
+        self._attempted_at = None
+        self._loading = False
+
+    # ---------- 构建 ----------
+    @staticmethod
+    def _prefix_keys(text):
+        """整段文本，以及每个词开头的后缀，都可以作为前缀匹配的起点"""
+        words = text.split(' ')
+        return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+    def _build(self, rows):
+        terms = {}
+        for kind, text, source_id, score in rows:
+            norm = normalize(text)
+            if not norm:
+                continue
+            term = terms.get((kind, norm))
+            if term is None:
+                term = terms[(kind, norm)] = _Term(kind, text)
+            term.contrib[source_id] = score or 0
+
+        keys = []
+        for term_key, term in terms.items():
+            term.score = sum(term.contrib.values())
+            for prefix_key in self._prefix_keys(term_key[1]):
+                keys.append((prefix_key, term_key))
+        keys.sort()
+
+        top = {}
+        for prefix_key, term_key in keys:
+            for n in range(1, min(SHORT_PREFIX, len(prefix_key)) + 1):
+                top.setdefault(prefix_key[:n], set()).add(term_key)
+        for short, candidates in top.items():
+            top[short] = heapq.nlargest(TOP_K, candidates, key=lambda k: terms[k].score)
+        return keys, terms, top
+
+    def _update_top(self, term_key, norm, removed=False):
+        """增量更新短前缀的热度榜（需持有锁）"""
+        shorts = set()
+        for prefix_key in self._prefix_keys(norm):
+            for n in range(1, min(SHORT_PREFIX, len(prefix_key)) + 1):
+                shorts.add(prefix_key[:n])
+        for short in shorts:
+            ranked = [k for k in self._top.get(short, []) if k != term_key]
+            if not removed:
+                ranked.append(term_key)
+                ranked.sort(key=lambda k: self._terms[k].score, reverse=True)
+                del ranked[TOP_K:]
+            self._top[short] = ranked
+
+    def refresh(self):
+        """从数据库全量重建，构建完成后整体替换，构建期间查询不受影响"""
+        started = time.monotonic()
+        rows = self._loader()
+        if rows is None:
+            with self._lock:
+                self._loading = False
+            return False
+        keys, terms, top = self._build(rows)
+        with self._lock:
+            self._keys, self._terms, self._top = keys, terms, top
+            self._results = {}
+            self._loaded_at = time.monotonic()
+            self._loading = False
+        logger.info(f"搜索联想索引刷新完成: {len(terms)} 个词条, 耗时 {time.monotonic() - started:.2f}s")
+        return True
+
+    def _ensure_fresh(self):
+        """第一次使用或到期时在后台线程刷新，不阻塞请求"""
+        with self._lock:
+            now = time.monotonic()
+            if self._loading:
+                return
+            if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+                return
+            if self._attempted_at is not None and now - self._attempted_at < RETRY_INTERVAL:
+                return
+            self._loading = True
+            self._attempted_at = now
+        threading.Thread(target=self.refresh, name='suggest-index-refresh', daemon=True).start()
+
+    @property
+    def ready(self):
+        return self._loaded_at is not None
+
+    # ---------- 增量更新 ----------
+    def add(self, kind, text, source_id, score=0):
+        norm = normalize(text)
+        if not norm:
+            return
+        term_key = (kind, norm)
+        with self._lock:
+            term = self._terms.get(term_key)
+            if term is None:
+                term = self._terms[term_key] = _Term(kind, text)
+                for prefix_key in self._prefix_keys(norm):
+                    bisect.insort(self._keys, (prefix_key, term_key))
+            term.contrib[source_id] = score
+            term.score = sum(term.contrib.values())
+            self._update_top(term_key, norm)
+            self._results = {}
+
+    def remove(self, kind, text, source_id):
+        norm = normalize(text)
+        term_key = (kind, norm)
+        with self._lock:
+            term = self._terms.get(term_key)
+            if term is None or source_id not in term.contrib:
+                return
+            del term.contrib[source_id]
+            if term.contrib:
+                term.score = sum(term.contrib.values())
+                self._update_top(term_key, norm)
+            else:
+                self._update_top(term_key, norm, removed=True)
+                del self._terms[term_key]
+                for prefix_key in self._prefix_keys(norm):
+                    i = bisect.bisect_left(self._keys, (prefix_key, term_key))
+                    if i < len(self._keys) and self._keys[i] == (prefix_key, term_key):
+                        del self._keys[i]
+            self._results = {}
+
+    # ---------- 查询 ----------
+    def suggest(self, prefix, limit=8):
+        """返回 [{'text':..., 'type':...}]，按热度从高到低"""
+        self._ensure_fresh()
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            cache_key = (prefix, limit)
+            cached = self._results.get(cache_key)
+            if cached is not None:
+                return cached
+
+            if len(prefix) <= SHORT_PREFIX and limit <= TOP_K:
+                best = [self._terms[k] for k in self._top.get(prefix, [])[:limit]]
+            else:
+                keys = self._keys
+                seen = set()
+                i = bisect.bisect_left(keys, (prefix,))
+                end = min(len(keys), i + MAX_SCAN)
+                while i < end and keys[i][0].startswith(prefix):
+                    seen.add(keys[i][1])
+                    i += 1
+                best = heapq.nlargest(limit, (self._terms[k] for k in seen), key=lambda t: t.score)
+            result = [{'text': t.text, 'type': t.kind} for t in best]
+
+            if len(self._results) >= RESULT_CACHE_SIZE:
+                self._results = {}
+            self._results[cache_key] = result
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {'terms': len(self._terms), 'keys': len(self._keys), 'ready': self.ready}
@@ -0,0 +1,123 @@
+"""
+对象存储后端测试脚本：对一个兼容S3的服务跑一遍 S3Storage 的读写删
+可以用 MinIO，或者本机的替身服务（moto）：
+    pip install "moto[server]"
+    moto_server -p 5999
+    python test_storage.py http://127.0.0.1:5999
+访问密钥、bucket 从环境变量 STORAGE_S3_ACCESS_KEY/STORAGE_S3_SECRET_KEY/STORAGE_S3_BUCKET 读取，
+bucket 不存在时自动创建；测试结束删除写入的对象
+"""
+
+import io
+import os
+import sys
+import tempfile
+import uuid
+
+from storage import ObjectNotFound, RangeNotSatisfiable, S3Storage, StorageError
+
+
+def check(name, ok, detail=''):
+    if ok:
+        print(f"   ✅ {name}")
+    else:
+        print(f"   ❌ {name} {detail}")
+    return ok
+
+
+def check_s3_storage(endpoint):
+    """测试S3存储后端"""
+    prefix = f"test-{uuid.uuid4().hex[:8]}"
+    # 分片大小取S3允许的最小值5MB，下面的大文件会分成3片
+    s3 = S3Storage(endpoint, os.environ.get('STORAGE_S3_BUCKET', 'pic-share-test'),
+                   os.environ.get('STORAGE_S3_ACCESS_KEY', 'test'), os.environ.get('STORAGE_S3_SECRET_KEY', 'test'),
+                   region=os.environ.get('STORAGE_S3_REGION', 'us-east-1'), prefix=prefix,
+                   part_size=5 * 1024 * 1024)
+    passed = True
+
+    print("1. 创建bucket...")
+    try:
+        s3._call('PUT', '/' + s3.bucket, expect=(200, 409))
+        print(f"   ✅ bucket {s3.bucket} 可用")
+    except StorageError as e:
+        print(f"   ❌ 无法连接对象存储: {e}")
+        return False
+
+    print("\n2. 上传和读取...")
+    small = os.urandom(1000)
+    big = os.urandom(12 * 1024 * 1024)
+    big_path = os.path.join(tempfile.gettempdir(), f"{prefix}.bin")
+    with open(big_path, 'wb') as f:
+        f.write(big)
+    try:
+        s3.put('ab/small.png', io.BytesIO(small), size=len(small), content_type='image/png')
+        s3.put_file('ab/big.bin', big_path, move=True)
+        passed &= check("上传后删除本地文件(move=True)", not os.path.exists(big_path))
+
+        obj = s3.get('ab/small.png')
+        data = b''.join(obj.body)
+        passed &= check("小文件内容一致", data == small)
+        passed &= check("Content-Type", obj.content_type == 'image/png', obj.content_type)
+
+        obj = s3.get('ab/big.bin')
+        passed &= check("分片上传的大文件内容一致", b''.join(obj.body) == big and obj.size == len(big))
+
+        obj = s3.get('ab/big.bin', 100, 199)
+        data = b''.join(obj.body)
+        passed &= check("范围读取", data == big[100:200] and (obj.start, obj.end) == (100, 199))
+
+        obj = s3.get('ab/small.png', 900)
+        passed &= check("只给起点的范围读取", b''.join(obj.body) == small[900:])
+
+        try:
+            s3.get('ab/small.png', 5000)
+            passed &= check("范围超出对象大小", False, "没有抛出RangeNotSatisfiable")
+        except RangeNotSatisfiable:
+            passed &= check("范围超出对象大小", True)
+
+        print("\n3. 存在检查和本地副本...")
+        passed &= check("exists 已上传的对象", s3.exists('ab/small.png'))
+        passed &= check("exists 不存在的对象", not s3.exists('ab/nope.png'))
+        try:
+            s3.get('ab/nope.png')
+            passed &= check("读取不存在的对象", False, "没有抛出ObjectNotFound")
+        except ObjectNotFound:
+            passed &= check("读取不存在的对象", True)
+
+        with s3.local_copy('ab/small.png') as path:
+            with open(path, 'rb') as f:
+                passed &= check("local_copy", f.read() == small and path.endswith('small.png'))
+        passed &= check("local_copy 退出后删除临时文件", not os.path.exists(path))
+
+        with s3.writable_dir('cd') as directory:
+            with open(os.path.join(directory, 'out.webp'), 'wb') as f:
+                f.write(small)
+        passed &= check("writable_dir 上传生成的文件", s3.exists('cd/out.webp'))
+
+        print("\n4. 删除...")
+        s3.delete_many(['ab/small.png', 'ab/big.bin', 'cd/out.webp', 'ab/nope.png'])
+        passed &= check("批量删除（含不存在的对象）",
+                        not any(s3.exists(key) for key in ('ab/small.png', 'ab/big.bin', 'cd/out.webp')))
+    except StorageError as e:
+        print(f"   ❌ 请求失败: {e}")
+        passed = False
+    finally:
+        if os.path.exists(big_path):
+            os.remove(big_path)
+
+    print("\n" + "=" * 50)
+    print("测试通过！" if passed else "测试失败！")
+    return passed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        endpoint = sys.argv[1]
+    else:
+        endpoint = os.environ.get('STORAGE_S3_ENDPOINT', 'http://127.0.0.1:9000')
+
+    print(f"对象存储测试脚本")
+    print(f"目标地址: {endpoint}")
+    print("=" * 50)
+
+    sys.exit(0 if check_s3_storage(endpoint) else 1)
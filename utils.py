@@ -1,9 +1,9 @@
 import os
 import uuid
-from PIL import Image as PILImage
 from werkzeug.utils import secure_filename
 from flask import current_app
 from models import db, Tag, ImageTag
+from image_processing import load_thumbnail
 import re
 
 
@@ -48,17 +48,8 @@ def save_uploaded_file(file, user_id):
 def create_thumbnail(source_path, thumbnail_path, max_size=(300, 300)):
     """创建缩略图"""
     try:
-        img = PILImage.open(source_path)
-
-        # 保持宽高比调整大小
-        img.thumbnail(max_size, PILImage.Resampling.LANCZOS)
-
-        # 如果是PNG保留透明度
-        if img.mode in ('RGBA', 'LA'):
-            background = PILImage.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = background
-
+        # 解码时就缩小（JPEG用draft，其他格式用reduce），透明部分已铺白底
+        img = load_thumbnail(source_path, max_size)
         img.save(thumbnail_path, 'JPEG' if thumbnail_path.lower().endswith(('.jpg', '.jpeg')) else 'PNG')
         return True
     except Exception as e:
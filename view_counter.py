@@ -0,0 +1,142 @@
+"""
+浏览统计写回聚合
+浏览记录先在内存中累加，由后台线程定时（或攒够一定数量后）批量写回数据库
+"""
+
+import abc
+import threading
+import logging
+
+from hyperloglog import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+
+class _BatchWriter(abc.ABC):
+    """
+    按key聚合、后台批量写回的基类，子类实现 _combine 决定同一key的两个值如何合并
+
+    flush_func: 接收 {key: 聚合值} 的函数，写入成功返回True
+    flush_interval: 定时写回间隔（秒）
+    max_pending: 未写回的事件数达到该值时立即触发写回
+    """
+
+    thread_name = 'batch-writer-flush'
+
+    def __init__(self, flush_func, flush_interval=2.0, max_pending=500):
+        self._flush_func = flush_func
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._pending = {}
+        self._pending_events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    @abc.abstractmethod
+    def _combine(self, current, value):
+        """合并同一key的已有值和新值，返回合并结果"""
+
+    def _record(self, key, value, events=1):
+        with self._lock:
+            current = self._pending.get(key)
+            self._pending[key] = value if current is None else self._combine(current, value)
+            self._pending_events += events
+            full = self._pending_events >= self.max_pending
+            if self._thread is None and not self._stopped:
+                self._start()
+        if full:
+            self._wakeup.set()
+
+    def _start(self):
+        # 第一次有记录时才启动线程（需持有self._lock）
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """把当前累计的数据写回数据库，失败时合并回去等下次再写"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, {}
+                events, self._pending_events = self._pending_events, 0
+
+            ok = False
+            try:
+                ok = self._flush_func(batch)
+            except Exception as e:
+                logger.error(f"{self.thread_name} 写回失败: {e}")
+
+            if not ok:
+                with self._lock:
+                    for key, value in batch.items():
+                        current = self._pending.get(key)
+                        self._pending[key] = value if current is None else self._combine(value, current)
+                    self._pending_events += events
+
+    def shutdown(self):
+        """停止后台线程并做最后一次写回（进程退出时调用）"""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+class ViewCounter(_BatchWriter):
+    """浏览量计数：同一图片的增量直接相加"""
+
+    thread_name = 'view-counter-flush'
+
+    def _combine(self, current, value):
+        return current + value
+
+    def add(self, image_id, count=1):
+        """记录一次浏览"""
+        self._record(image_id, count, count)
+
+    def pending(self, image_id):
+        """尚未写回数据库的浏览增量，页面展示时加上它"""
+        with self._lock:
+            return self._pending.get(image_id, 0)
+
+
+class UniqueViewerTracker(_BatchWriter):
+    """独立访客统计：每张图片一个HyperLogLog草图，写回时与数据库中的寄存器合并"""
+
+    thread_name = 'unique-viewer-flush'
+
+    def __init__(self, flush_func, flush_interval=30.0, max_pending=5000, precision=None):
+        super().__init__(flush_func, flush_interval, max_pending)
+        self.precision = precision
+
+    def _new_sketch(self):
+        return HyperLogLog() if self.precision is None else HyperLogLog(self.precision)
+
+    def _combine(self, current, value):
+        return current.merge(value)
+
+    def add(self, image_id, viewer_key):
+        """记录一个访客（登录用户ID或匿名指纹）"""
+        with self._lock:
+            sketch = self._pending.get(image_id)
+            if sketch is not None:
+                sketch.add(viewer_key)
+                self._pending_events += 1
+                full = self._pending_events >= self.max_pending
+                if full:
+                    self._wakeup.set()
+                return
+        sketch = self._new_sketch()
+        sketch.add(viewer_key)
+        self._record(image_id, sketch)